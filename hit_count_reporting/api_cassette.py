@@ -0,0 +1,151 @@
+from __future__ import print_function
+import json, socket, sys, time
+import threading, collections, gzip
+from datetime import date
+
+"""
+Author: Joe Audet
+Date Created: 2026OCT18
+Last Modified: 2026OCT18
+Ver: 0.1
+
+Usage:
+Record / replay of the API exchanges of a run, used by --record-cassette and --replay-cassette of chkp_hit_count_to_csv_reporting.py and
+chkp_hit_count_to_csv_reporting_MDS_v2.py. Keep this file next to the scripts - without it they run as before, only those options are refused.
+A session recorded by either script can be replayed by the other
+"""
+
+#Recording writes every request and response that goes over the wire, with the time it took, to a gzip compressed JSON lines file - passwords are
+#left out of the requests and SIDs in the responses are replaced by placeholders. Replaying answers each request from the file instead of the
+#server after the recorded time (times latency_scale), so a production session can be run again as a repeatable benchmark, or to compare the
+#reports of two versions of a script. A request is matched on server, command and payload (user, password, session name and empty fields aside).
+#Identical requests (retries, keepalives) get their recorded responses in turn, the last one again once they run out. A request that was never
+#recorded gets a 404. Replayed responses are made with the calling script's response_class (its ApiResponse)
+class ApiCassette:
+  version = 1
+  unmatched_fields = ('user', 'password', 'session-name')
+  unrecorded_headers = ('content-encoding', 'content-length', 'set-cookie')
+
+  def __init__(self, path, response_class, replay=False, latency_scale=1.0):
+    self.path = path
+    self.response_class = response_class
+    self.replaying = replay
+    self.latency_scale = latency_scale
+    self.lock = threading.Lock()
+    self.exchanges = 0
+    self.misses = 0
+    self.sids = 0
+    #Recorded SID -> the cassette-sid-N it was recorded as
+    self.sessions = {}
+    self.file = None
+    if replay:
+      self.load()
+    else:
+      self.recorded_date = date.today()
+      self.file = gzip.open(path, 'wt', encoding='utf-8')
+      self.write({"cassette" : self.version, "recorded" : str(self.recorded_date)})
+
+  def load(self):
+    try:
+      with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        entries = [json.loads(line) for line in file]
+    except (OSError, ValueError, EOFError) as error:
+      print(f"Unable to read cassette {self.path}: {error}")
+      sys.exit(1)
+    if header.get("cassette") != self.version:
+      print(f"{self.path} is not a cassette written by --record-cassette")
+      sys.exit(1)
+    self.recorded_date = date.fromisoformat(header["recorded"])
+    #A session recorded from a single server can be replayed whatever server address the replay is given
+    self.single_server = len(set(entry["server"] for entry in entries)) <= 1
+    #Requests are matched within their session (so the same request to two domains gets each domain's answer) unless the cassette was
+    #recorded before sessions were recorded
+    self.by_session = any("session" in entry for entry in entries)
+    self.responses = {}
+    self.page_limits = {}
+    for entry in entries:
+      self.responses.setdefault(self.match_key(entry["server"], entry["command"], entry["request"], entry.get("session")), collections.deque()).append(entry)
+      if entry["command"] == 'show-access-rulebase':
+        page = (None if self.single_server else entry["server"], entry["request"].get("uid"), entry["request"].get("offset"))
+        self.page_limits[page] = max(self.page_limits.get(page, 0), entry["request"].get("limit", 0))
+
+  #Largest page recorded for a layer at an offset. The adaptive page size depends on timing, so a replay pages through each layer the way the
+  #recorded run did instead (the one rule pages used to size layers are smaller than the real page at offset 0)
+  def recorded_page_limit(self, server, uid, offset):
+    return self.page_limits.get((None if self.single_server else server, uid, offset))
+
+  def match_key(self, server, command, request, session=None):
+    request = {key : value for key, value in request.items() if key not in self.unmatched_fields and value != ''}
+    return (None if self.single_server else server, session or None if self.by_session else None, command, json.dumps(request, sort_keys=True))
+
+  def record(self, server, command, json_payload, sid, seconds, response=None, error=None):
+    entry = {"server" : server, "session" : self.sessions.get(sid), "command" : command, "request" : self.scrubbed_request(json_payload), "seconds" : round(seconds, 4)}
+    if error is not None:
+      entry["error"] = 'timeout' if isinstance(error, socket.timeout) else 'connection'
+      entry["message"] = str(error) or type(error).__name__
+    else:
+      entry["status"] = response.status
+      entry["headers"] = [[name, value] for name, value in response.headers if name.lower() not in self.unrecorded_headers]
+      entry["body"] = self.scrubbed_body(response.data).decode('utf-8', 'surrogateescape')
+      #chkp_hit_count_to_csv_reporting.py does not time the first byte
+      if response.time_to_first_byte is not None:
+        entry["time_to_first_byte"] = round(response.time_to_first_byte, 4)
+      entry["wire_bytes"] = response.wire_bytes
+    self.write(entry)
+
+  def scrubbed_request(self, json_payload):
+    request = json.loads(json_payload) if json_payload else {}
+    request.pop('password', None)
+    return request
+
+  def scrubbed_body(self, data):
+    if b'"sid"' not in data:
+      return data
+    try:
+      body = json.loads(data.decode('utf-8'))
+    except ValueError:
+      return data
+    if not isinstance(body, dict) or 'sid' not in body:
+      return data
+    with self.lock:
+      self.sids += 1
+      self.sessions[body['sid']] = f"cassette-sid-{self.sids}"
+      body['sid'] = self.sessions[body['sid']]
+    return json.dumps(body).encode('utf-8')
+
+  def write(self, entry):
+    with self.lock:
+      #Keepalives can still come in from the session threads after the cassette is closed
+      if self.file is not None:
+        self.file.write(json.dumps(entry) + '\n')
+        self.exchanges += 1
+
+  def replay(self, server, command, json_payload, sid):
+    key = self.match_key(server, command, json.loads(json_payload) if json_payload else {}, sid)
+    with self.lock:
+      self.exchanges += 1
+      responses = self.responses.get(key)
+      if not responses:
+        self.misses += 1
+        entry = None
+      else:
+        entry = responses.popleft() if len(responses) > 1 else responses[0]
+    if entry is None:
+      return self.response_class(404, json.dumps({"code" : "cassette_no_recorded_response", "message" : f"No recorded response for {command} {json_payload}"}).encode('utf-8'), [])
+    time.sleep(entry["seconds"] * self.latency_scale)
+    if "error" in entry:
+      raise (socket.timeout if entry["error"] == 'timeout' else ConnectionError)(entry["message"])
+    #Without a recorded time to first byte the whole response time is taken, and without bytes on the wire the size of the body
+    return self.response_class(entry["status"], entry["body"].encode('utf-8', 'surrogateescape'), [tuple(header) for header in entry["headers"]],
+      entry.get("time_to_first_byte", entry["seconds"]), 0, entry.get("wire_bytes"))
+
+  def close(self):
+    if self.replaying:
+      print(f"Replayed {self.exchanges} API requests from {self.path}, {self.misses} without a recorded response")
+      return
+    with self.lock:
+      file, self.file = self.file, None
+    if file is not None:
+      file.close()
+      print(f"Recorded {self.exchanges - 1} API requests to {self.path}")
@@ -0,0 +1,239 @@
+from __future__ import print_function
+import json, http.client, ssl
+import sys, os, re, time, glob, gzip
+import argparse, subprocess, tempfile, shutil
+
+import mock_mgmt_api_server
+
+"""
+Author: Joe Audet
+Date Created: 2026OCT18
+Last Modified: 2026OCT18
+Ver: 0.1
+
+Usage:
+Throughput benchmark for the hit count reporting script. For each policy size a mock management server (mock_mgmt_api_server.py) is started
+locally, the script is run headless (--all-domains) against it in a separate process, and rules/sec, API calls, bytes transferred and the
+peak RSS of the script are reported:
+  python3 benchmark_hit_count.py --sizes 1000,10000,100000 --latency-ms 20
+
+Any extra options after -- are passed to the script, e.g. to compare settings:
+  python3 benchmark_hit_count.py --sizes 10000 -- --domain-workers 1
+
+A session recorded from a real server with --record-cassette can be replayed instead of the mock, as a repeatable benchmark. --compare-script
+replays it with a second script as well and compares the reports of the two byte for byte (a script without --all-domains is driven through
+its menu, collecting all policies):
+  python3 benchmark_hit_count.py --cassette prod_session.jsonl.gz --compare-script chkp_hit_count_to_csv_reporting.py -- --max-page-size 50
+"""
+
+default_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chkp_hit_count_to_csv_reporting_MDS_v2.py')
+
+#Runs the script in the child process and reports its own peak RSS on exit, so each size is measured on its own. VmHWM is used because
+#ru_maxrss survives exec and would include the memory of the benchmark process (and its mock server) the child was forked from
+child_wrapper = """
+import os, resource, runpy, sys
+script = sys.argv[1]
+sys.argv = [script] + sys.argv[2:]
+#As when the script is run itself, modules next to it (api_cassette.py) can be imported
+sys.path[0] = os.path.dirname(os.path.abspath(script))
+try:
+  runpy.run_path(script, run_name='__main__')
+finally:
+  peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  try:
+    with open('/proc/self/status') as status:
+      peak_rss_kb = int([line for line in status if line.startswith('VmHWM:')][0].split()[1])
+  except (OSError, IndexError):
+    pass
+  sys.stderr.write('\\nBENCHMARK_PEAK_RSS_KB=%d\\n' % peak_rss_kb)
+"""
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description="Benchmark the hit count reporting script against a local mock management API server")
+  parser.add_argument('--script', default=default_script, help="Script to benchmark (must support --all-domains)")
+  parser.add_argument('--sizes', default='1000,10000,100000', help="Comma separated number of rules in the benchmarked policy")
+  parser.add_argument('--domains', type=int, default=0, help="MDS domains served by the mock, 0 for a SMS")
+  parser.add_argument('--layers', type=int, default=1, help="Ordered layers per domain")
+  parser.add_argument('--inline-every', type=int, default=50)
+  parser.add_argument('--shared-layers', type=int, default=1)
+  parser.add_argument('--latency-ms', type=float, default=0, help="Latency the mock adds to each show-access-rulebase page")
+  parser.add_argument('--latency-per-rule-ms', type=float, default=0)
+  parser.add_argument('--port', type=int, default=0, help="Port for the mock server, 0 picks a free one")
+  parser.add_argument('--json', help="Also write the results to this JSON file")
+  parser.add_argument('--keep-output', action='store_true', help="Keep the CSV files the script wrote")
+  parser.add_argument('--cassette', help="Replay this session recorded with --record-cassette instead of starting the mock (--sizes and the mock options are not used)")
+  parser.add_argument('--latency-scale', type=float, default=0.0, help="With --cassette, multiply the recorded response times by this (default: %(default)s, as fast as possible)")
+  parser.add_argument('--compare-script', help="With --cassette, also replay with this script and compare the reports of both scripts byte for byte")
+  parser.add_argument('script_args', nargs='*', help="Extra arguments for the script (after --)")
+  return parser.parse_args()
+
+def mock_options(args, rules):
+  return mock_mgmt_api_server.parse_arguments(['--port', str(args.port), '--rules', str(rules), '--domains', str(args.domains), '--layers', str(args.layers),
+    '--inline-every', str(args.inline_every), '--shared-layers', str(args.shared_layers), '--latency-ms', str(args.latency_ms),
+    '--latency-per-rule-ms', str(args.latency_per_rule_ms)])
+
+def mock_stats(address):
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+  context.check_hostname = False
+  context.verify_mode = ssl.CERT_NONE
+  conn = http.client.HTTPSConnection(address, context=context)
+  conn.request("POST", "/web_api/mock-stats", '{}', {'Content-Type' : 'application/json'})
+  return json.loads(conn.getresponse().read().decode('utf-8'))
+
+def count_csv_rows(directory):
+  rows = 0
+  for csv_file in glob.glob(os.path.join(directory, '*.csv')):
+    with open(csv_file) as file:
+      rows += max(0, sum(1 for line in file) - 1)
+  return rows
+
+#Runs the script in its own process from the output directory, returns the completed process, seconds taken and peak RSS in KB
+def run_script(script, script_args, output_directory, input_text=None):
+  environment = dict(os.environ, CHKP_API_PASSWORD='benchmark')
+  command = [sys.executable, '-c', child_wrapper, script] + script_args
+  started = time.monotonic()
+  result = subprocess.run(command, cwd=output_directory, env=environment, input=input_text, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  elapsed = time.monotonic() - started
+
+  if result.returncode != 0:
+    print(result.stdout[-2000:])
+    print(result.stderr[-2000:])
+    raise SystemExit(f"Benchmark run of {script} failed with exit code {result.returncode}")
+
+  peak_rss_kb = 0
+  for line in result.stderr.splitlines():
+    if line.startswith('BENCHMARK_PEAK_RSS_KB='):
+      peak_rss_kb = int(line.split('=', 1)[1])
+  return result, elapsed, peak_rss_kb
+
+def run_benchmark(args, rules):
+  server = mock_mgmt_api_server.start_server(mock_options(args, rules))
+  address = '127.0.0.1:{}'.format(server.server_address[1])
+  output_directory = tempfile.mkdtemp(prefix='hit_count_benchmark_')
+  try:
+    before = mock_stats(address)
+    result, elapsed, peak_rss_kb = run_script(args.script, ['--server', address, '--user', 'benchmark', '--all-domains'] + args.script_args, output_directory)
+    after = mock_stats(address)
+  finally:
+    server.shutdown()
+    server.server_close()
+
+  rows = count_csv_rows(output_directory)
+  if args.keep_output:
+    print(f"CSV output kept in {output_directory}")
+  else:
+    shutil.rmtree(output_directory, ignore_errors=True)
+
+  #The connection opened for the second mock-stats call is not the script's
+  return {
+    "policy_rules" : rules,
+    "rows_written" : rows,
+    "seconds" : round(elapsed, 3),
+    "rules_per_second" : round(rows / elapsed, 1) if elapsed else 0,
+    "api_calls" : after.get("requests", 0) - before.get("requests", 0),
+    "api_calls_by_command" : {key.split(':', 1)[1] : after[key] - before.get(key, 0) for key in after if key.startswith('command:') and after[key] != before.get(key, 0)},
+    "tls_connections" : after.get("connections", 0) - before.get("connections", 0) - 1,
+    "response_bytes" : after.get("bytes", 0) - before.get("bytes", 0),
+    "peak_rss_mb" : round(peak_rss_kb / 1024.0, 1),
+  }
+
+#Menu answers for a script without --all-domains: any server and user (nothing is sent in a replay), collect all policies, then Exit - the
+#last entry of the menu, after the layers that are neither shared nor inline in the recorded show-access-layers response
+def menu_input(cassette):
+  with gzip.open(cassette, 'rt', encoding='utf-8') as file:
+    for line in file:
+      entry = json.loads(line)
+      if entry.get("command") == 'show-access-layers' and entry.get("status") == 200:
+        layers = json.loads(entry["body"])["access-layers"]
+        policies = [layer for layer in layers if not layer["shared"] and 'parent-layer' not in layer]
+        return "replay\nreplay\n0\n{}\n".format(len(policies) + 1)
+  raise SystemExit(f"{cassette} has no show-access-layers response to drive the menu with")
+
+def run_replay(args, script, script_args):
+  output_directory = tempfile.mkdtemp(prefix='hit_count_replay_')
+  replay_args = ['--replay-cassette', os.path.abspath(args.cassette), '--replay-latency-scale', str(args.latency_scale)]
+  with open(script) as file:
+    headless = '--all-domains' in file.read()
+  if headless:
+    result, elapsed, peak_rss_kb = run_script(script, replay_args + ['--server', 'replay', '--user', 'replay', '--all-domains'] + script_args, output_directory)
+  else:
+    result, elapsed, peak_rss_kb = run_script(script, replay_args + script_args, output_directory, menu_input(args.cassette))
+  replayed = re.search(r'Replayed (\d+) API requests from .*, (\d+) without a recorded response', result.stdout)
+  rows = count_csv_rows(output_directory)
+  return {
+    "script" : script,
+    "output_directory" : output_directory,
+    "rows_written" : rows,
+    "seconds" : round(elapsed, 3),
+    "rules_per_second" : round(rows / elapsed, 1) if elapsed else 0,
+    "api_calls" : int(replayed.group(1)) if replayed else 0,
+    "unrecorded_api_calls" : int(replayed.group(2)) if replayed else 0,
+    "peak_rss_mb" : round(peak_rss_kb / 1024.0, 1),
+  }
+
+#Reports by name without the time stamp, which differs between runs
+def report_files(directory):
+  return {re.sub(r'_\d{4}[A-Z][a-z]{2}\d{2}_\d{4}(?=\.)', '', os.path.basename(path)) : path for path in glob.glob(os.path.join(directory, '*_hit_count_*'))}
+
+def compare_reports(first_directory, second_directory):
+  first = report_files(first_directory)
+  second = report_files(second_directory)
+  differences = {}
+  for name in sorted(set(first) | set(second)):
+    if name not in first or name not in second:
+      differences[name] = 'only written by ' + ('the first script' if name in first else 'the second script')
+      continue
+    with open(first[name], 'rb') as file_a, open(second[name], 'rb') as file_b:
+      if file_a.read() != file_b.read():
+        differences[name] = 'different'
+  return len(set(first) & set(second)), differences
+
+def replay_main(args):
+  scripts = [(args.script, args.script_args)] + ([(args.compare_script, [])] if args.compare_script else [])
+  results = []
+  print(f"{'ROWS':>8} {'SECONDS':>9} {'RULES/SEC':>10} {'API CALLS':>10} {'UNRECORDED':>11} {'PEAK RSS MB':>12}  SCRIPT")
+  for script, script_args in scripts:
+    result = run_replay(args, os.path.abspath(script), script_args)
+    results.append(result)
+    print(f"{result['rows_written']:>8} {result['seconds']:>9.2f} {result['rules_per_second']:>10.0f} {result['api_calls']:>10} {result['unrecorded_api_calls']:>11} {result['peak_rss_mb']:>12.1f}  {os.path.basename(script)}")
+
+  differences = {}
+  if args.compare_script:
+    compared, differences = compare_reports(results[0]["output_directory"], results[1]["output_directory"])
+    for name, difference in sorted(differences.items()):
+      print(f"  {name}: {difference}")
+    print(f"{compared - sum(difference == 'different' for difference in differences.values())} of {compared} report(s) the same byte for byte")
+
+  for result in results:
+    if args.keep_output:
+      print(f"Reports of {os.path.basename(result['script'])} kept in {result['output_directory']}")
+    else:
+      shutil.rmtree(result.pop("output_directory"), ignore_errors=True)
+
+  if args.json:
+    with open(args.json, 'w') as file:
+      json.dump({"cassette" : args.cassette, "latency_scale" : args.latency_scale, "script_args" : args.script_args, "results" : results, "report_differences" : differences}, file, indent=2)
+    print(f"Wrote benchmark results to {args.json}")
+  if differences:
+    raise SystemExit(1)
+
+def main():
+  args = parse_arguments()
+  if args.cassette:
+    replay_main(args)
+    return
+  sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+  results = []
+  print(f"{'RULES':>8} {'ROWS':>8} {'SECONDS':>9} {'RULES/SEC':>10} {'API CALLS':>10} {'CONNS':>6} {'MB RECEIVED':>12} {'PEAK RSS MB':>12}")
+  for rules in sizes:
+    result = run_benchmark(args, rules)
+    results.append(result)
+    print(f"{result['policy_rules']:>8} {result['rows_written']:>8} {result['seconds']:>9.2f} {result['rules_per_second']:>10.0f} {result['api_calls']:>10} {result['tls_connections']:>6} {result['response_bytes'] / 1048576.0:>12.2f} {result['peak_rss_mb']:>12.1f}")
+
+  if args.json:
+    with open(args.json, 'w') as file:
+      json.dump({"script" : args.script, "latency_ms" : args.latency_ms, "script_args" : args.script_args, "results" : results}, file, indent=2)
+    print(f"Wrote benchmark results to {args.json}")
+
+if __name__ == "__main__":
+  main()
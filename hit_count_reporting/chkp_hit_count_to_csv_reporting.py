@@ -1,20 +1,33 @@
 from __future__ import print_function
 import json, http.client, ssl
-import sys, os, re
-import getpass
+import sys, os, re, socket, random, time
+import threading, concurrent.futures, atexit
+import getpass, argparse
 from datetime import datetime, date
 import datetime
 import csv
+#api_cassette.py, shared with the MDS v2 script, is only needed for --record-cassette / --replay-cassette so the script still runs on its own
+try:
+  from api_cassette import ApiCassette
+except ImportError:
+  ApiCassette = None
 
 """
 Author: Joe Audet
 Date Created: 2022NOV02
-Last Modified: 2023FEB23
-Ver: 0.9
+Last Modified: 2026OCT18
+Ver: 0.92
 
 Usage:
 This script will login to a SMS (Not MDS at this time - coming soon) and retrieve all of the non-shared and non-inline access policy layers, then present 
 a menu where the user can select a policy (or all), which will create a CSV output for each selected rulebase
+
+2026OCT - api_call reuses pooled keep-alive HTTPS connections per management server instead of a new TLS handshake per request
+        - Fetch the remaining pages of each rulebase concurrently once the first page gives the total
+        - Connect / read timeouts on every API request and jittered exponential backoff retries of read-only commands
+        - Add --record-cassette / --replay-cassette to record every API exchange (passwords and SIDs left out) and replay it later without a server,
+          with api_cassette.py next to the script (shared by both scripts)
+        - Rules in sections of an inline layer are numbered under the parent rule, as in the MDS v2 script
 """
 
 #Header line to insert into the top of each CSV
@@ -33,10 +46,43 @@ last_hit_empty='No last hit to show date for'
 first_hit_empty='No first hit to show date for'
 last_delta_empty='No last hit to compare'
 first_delta_empty='No first hit to compare'
+#Keep-alive connection pools, one per management server (see api_call)
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+max_idle_connections = 8
+#Socket timeouts in seconds for API requests - to connect, and for each read of a response
+connect_timeout = 10
+read_timeout = 120
+#Read-only commands (show-*) that time out, fail to connect or get a 429/5xx are sent again up to api_retries times with jittered exponential backoff
+api_retries = 3
+retry_backoff_base = 0.5
+retry_backoff_max = 10.0
+retry_statuses = (429, 500, 502, 503, 504)
+#Number of rulebase pages fetched at the same time for each layer
+page_fetch_workers = 4
+#API exchanges recorded to or replayed from a file instead of the server (see ApiCassette in api_cassette.py)
+api_cassette = None
 
 #csv_file_name='demo_csv_output.csv'
 
 def main():
+  global api_cassette,todays_date
+  args = parse_arguments()
+  if args.record_cassette and args.replay_cassette:
+    print("--record-cassette and --replay-cassette cannot be used together")
+    sys.exit(1)
+  if (args.record_cassette or args.replay_cassette) and ApiCassette is None:
+    print("--record-cassette and --replay-cassette need api_cassette.py in the same directory as the script")
+    sys.exit(1)
+  if args.record_cassette:
+    api_cassette = ApiCassette(args.record_cassette, ApiResponse)
+  elif args.replay_cassette:
+    api_cassette = ApiCassette(args.replay_cassette, ApiResponse, replay=True, latency_scale=args.replay_latency_scale)
+    #Days since last hit are worked out from the day the session was recorded, so replayed reports are the same whatever day they are made
+    todays_date = api_cassette.recorded_date
+  if api_cassette is not None:
+    atexit.register(api_cassette.close)
+
   # getting server / login details from the user
   global mgmt_server
   mgmt_server = input("Enter server IP address [Press ENTER for localhost]:")
@@ -48,7 +94,10 @@ def main():
   if username == '':
     username = 'admin'
 
-  if sys.stdin.isatty():
+  if api_cassette is not None and api_cassette.replaying:
+    #Never sent anywhere
+    password = ''
+  elif sys.stdin.isatty():
     password = getpass.getpass(f"Enter password for {username}: ")
   else:
     print("Attention! Your password will be shown on the screen!")
@@ -60,6 +109,16 @@ def main():
 
   create_interactive_access_policy_menu()
 
+  #Close the pooled keep-alive connections and report how many handshakes were avoided
+  close_connection_pools()
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description="Export Check Point access-layer hit counts to CSV from the interactive menu")
+  parser.add_argument('--record-cassette', metavar='FILE', help="Record every API request and response of the run (passwords and SIDs left out) to this gzip compressed file, for --replay-cassette")
+  parser.add_argument('--replay-cassette', metavar='FILE', help="Answer API requests from a file written by --record-cassette instead of the server, e.g. to benchmark or compare reports without touching a production server")
+  parser.add_argument('--replay-latency-scale', type=float, default=1.0, help="With --replay-cassette, multiply the recorded response times by this. 0 replays as fast as possible (default: %(default)s)")
+  return parser.parse_args()
+
 # Display a list of all access policies for the user to select from, including an option for 'All Policies' and an 'Exit' option
 def create_interactive_access_policy_menu():
   #Create list of non shared layers name and uid fields (shared layers will be accessed by their UID which is in key 'inline-layer' within the 'show-access-rulebase' output)
@@ -165,43 +224,21 @@ def convert_datestring_to_date(datestr):
   return datetime.datetime.strptime(str.group(), '%Y-%m-%d').date()
 
 def loop_policy_rulebase(policyuid, policy_name):
-  finished = False  # will become true after getting all the data
   #all_objects = {}  # accumulate all the objects from all the API calls
   global all_rules_object
   all_rules_object = []
   all_rules_object.append(csv_header)
-  iterations = 0  # number of times we've made an API call
-  limit = 50 # page size to get for each api call
-  offset = 0 # skip n objects in the database
-  payload = {}
-
-  payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : policyuid, "details-level" : "standard", "show-hits" : True})
-  response = api_call(mgmt_server, "show-access-rulebase", payload, session_id)
-  response_data = response.read()
-
-  if response.status == 200:
-    response_data = json.loads(response_data.decode('utf-8'))
-    loop_rules(response_data,'','')
-
-    while not finished:
-      total_objects = response_data['total']  # total number of objects
-      received_objects = response_data['to']  # number of objects we got so far
 
-      if received_objects == total_objects:
-        break
+  pages, error_data = get_rulebase_pages(policyuid, session_id)
 
-      iterations += 1
-      
-      payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : policyuid, "details-level" : "standard", "show-hits" : True})
-      response = api_call(mgmt_server, "show-access-rulebase", payload, session_id)
-      response_data = response.read()
-      response_data = json.loads(response_data.decode('utf-8'))
+  if pages is not None:
+    for response_data in pages:
       loop_rules(response_data,'','')
     
     print_rules(policy_name)
 
   else:
-    print('Error occurred while trying to show-access-rulebase: {}'.format(response_data.decode('utf-8')))
+    print('Error occurred while trying to show-access-rulebase: {}'.format(error_data.decode('utf-8')))
 
 def loop_rules(data, parent_rule_number, policy_name):
   #Due to how access-sections work, we need to store the policy name from the access-rulebase object and pass it back if an access-section is present when
@@ -212,7 +249,7 @@ def loop_rules(data, parent_rule_number, policy_name):
   for access_rule in data['rulebase']:
     if (access_rule['type'] == 'access-section'):
       #If an access-section is present it output the rules of the section as an array within the object, so we have to interate that sub-array to print those rules
-      loop_rules(access_rule,'',policy_name)
+      loop_rules(access_rule,parent_rule_number,policy_name)
     else:
       if 'name' in access_rule:
         rule_name = access_rule['name'].replace('\n',' ')
@@ -257,34 +294,44 @@ def loop_rules(data, parent_rule_number, policy_name):
 
     
 def get_inline_layer_info(uid,sid,rulenumber):
-  finished = False  # will become true after getting all the data
-  iterations = 0  # number of times we've made an API call
-  limit = 50 # page size to get for each api call
-  offset = 0 # skip n objects in the database
-  payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : uid, "details-level" : "standard", "show-hits" : True})
-  response = api_call(mgmt_server, 'show-access-rulebase', payload, sid)
-  response_data = response.read()
-  if response.status == 200:
-    response_data = json.loads(response_data.decode('utf-8'))
-    loop_rules(response_data,rulenumber,'')
-
-    while not finished:
-      total_objects = response_data['total']  # total number of objects
-      received_objects = response_data['to']  # number of objects we got so far
-
-      if received_objects == total_objects:
-        break
-
-      iterations += 1
-      
-      payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : uid, "details-level" : "standard", "show-hits" : True})
-      response = api_call(mgmt_server, "show-access-rulebase", payload, session_id)
-      response_data = response.read()
-      response_data = json.loads(response_data.decode('utf-8'))
+  pages, error_data = get_rulebase_pages(uid, sid)
+  if pages is not None:
+    for response_data in pages:
       loop_rules(response_data,rulenumber,'')
       
   else:
-    print('Error occurred while trying to inline layer: {}'.format(response_data.decode('utf-8')))
+    print('Error occurred while trying to inline layer: {}'.format(error_data.decode('utf-8')))
+
+#Fetch every page of a rulebase. The first response gives us the total, so the remaining offsets are requested at the same time through a bounded
+#worker pool instead of waiting on each page in turn. Pages are returned in offset order so loop_rules numbers the rules exactly as before
+def get_rulebase_pages(uid, sid):
+  limit = 50 # page size to get for each api call
+  status, data = get_rulebase_page(uid, sid, 0, limit)
+  if status != 200:
+    return None, data
+
+  first_page = json.loads(data.decode('utf-8'))
+  pages = [first_page]
+  total_objects = first_page['total']  # total number of objects
+  offsets = list(range(limit, total_objects, limit))
+  if offsets:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(page_fetch_workers, len(offsets))) as executor:
+      results = list(executor.map(lambda offset: get_rulebase_page(uid, sid, offset, limit), offsets))
+    for offset, (status, data) in zip(offsets, results):
+      if status == 200:
+        pages.append(json.loads(data.decode('utf-8')))
+      else:
+        print('Error occurred while trying to show-access-rulebase at offset {}: {}'.format(offset, data.decode('utf-8')))
+  return pages, None
+
+def get_rulebase_page(uid, sid, offset, limit):
+  payload = json.dumps({"limit": limit, "offset": offset, "uid" : uid, "details-level" : "standard", "show-hits" : True})
+  #A page that still fails after the retries is reported by the caller like any other failed page instead of ending the layer
+  try:
+    response = api_call(mgmt_server, "show-access-rulebase", payload, sid)
+  except (http.client.HTTPException, OSError) as error:
+    return 0, 'Request failed: {}'.format(error or type(error).__name__).encode('utf-8')
+  return response.status, response.read()
 
 def print_rules(policy_name):
 
@@ -334,22 +381,153 @@ def logout(sid):
     print('Error occurred while trying to logout: {}'.format(data.decode('utf-8')))
     sys.exit()
 
-def api_call(ip_addr, command, json_payload, sid):
-  #Use SSLContect object to disable certificate verification allowing self signed certs
-  context = ssl.SSLContext()
-  context.check_hostname = False
-  context.verify_mode = ssl.CERT_NONE
-  conn = http.client.HTTPSConnection(ip_addr, context=context )
+#Keep-alive HTTPS connections are pooled per management server and reused by every api_call, so each page no longer pays for a new TCP + TLS handshake
+#Pools are thread safe so concurrent requests each check out their own connection
+class ApiResponse:
+  #The response body is read in full inside api_call so the connection can go straight back into the pool, callers still use .status and .read()
+  #A replayed response (see ApiCassette) is made with all of the MDS v2 script's fields, of which this script only uses the body and status
+  def __init__(self, status, data, headers, time_to_first_byte=None, retries=0, wire_bytes=None):
+    self.status = status
+    self.data = data
+    self.headers = headers
+    self.time_to_first_byte = time_to_first_byte
+    self.retries = retries
+    self.wire_bytes = len(data) if wire_bytes is None else wire_bytes
+
+  def read(self):
+    return self.data
+
+class ApiConnectionPool:
+  def __init__(self, ip_addr, max_idle_connections):
+    self.ip_addr = ip_addr
+    self.max_idle_connections = max_idle_connections
+    #Use SSLContect object to disable certificate verification allowing self signed certs - created once per server instead of once per call
+    self.context = ssl.SSLContext()
+    self.context.check_hostname = False
+    self.context.verify_mode = ssl.CERT_NONE
+    self.idle_connections = []
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.handshakes = 0
+    self.reused = 0
+    self.reconnects = 0
+
+  def new_connection(self):
+    with self.lock:
+      self.handshakes += 1
+    return http.client.HTTPSConnection(self.ip_addr, context=self.context, timeout=connect_timeout)
+
+  def acquire(self):
+    with self.lock:
+      if self.idle_connections:
+        self.reused += 1
+        return self.idle_connections.pop(), True
+    return self.new_connection(), False
+
+  def release(self, conn):
+    with self.lock:
+      if len(self.idle_connections) < self.max_idle_connections:
+        self.idle_connections.append(conn)
+        return
+    conn.close()
+
+  def request(self, command, json_payload, request_headers):
+    if api_cassette is None:
+      return self.send(command, json_payload, request_headers)
+    sid = request_headers.get('X-chkp-sid', '')
+    if api_cassette.replaying:
+      return api_cassette.replay(self.ip_addr, command, json_payload, sid)
+    started = time.monotonic()
+    try:
+      response = self.send(command, json_payload, request_headers)
+    except (http.client.HTTPException, OSError) as error:
+      api_cassette.record(self.ip_addr, command, json_payload, sid, time.monotonic() - started, error=error)
+      raise
+    api_cassette.record(self.ip_addr, command, json_payload, sid, time.monotonic() - started, response)
+    return response
+
+  def send(self, command, json_payload, request_headers):
+    with self.lock:
+      self.requests += 1
+    conn, reused = self.acquire()
+    try:
+      res, data = send_api_request(conn, command, json_payload, request_headers)
+    except (http.client.HTTPException, OSError) as error:
+      conn.close()
+      #A timeout means the server is slow rather than that the connection went stale - retrying is left to api_call
+      if not reused or isinstance(error, socket.timeout):
+        raise
+      #The server closed the idle keep-alive connection - reconnect transparently and send the request once more
+      with self.lock:
+        self.reconnects += 1
+      conn = self.new_connection()
+      try:
+        res, data = send_api_request(conn, command, json_payload, request_headers)
+      except (http.client.HTTPException, OSError):
+        conn.close()
+        raise
+
+    if res.will_close:
+      conn.close()
+    else:
+      self.release(conn)
+    return ApiResponse(res.status, data, res.getheaders())
+
+  def close(self):
+    with self.lock:
+      idle_connections = self.idle_connections
+      self.idle_connections = []
+    for conn in idle_connections:
+      conn.close()
 
+def send_api_request(conn, command, json_payload, request_headers):
+  #We have left the vX.X out of the API call to ensure it uses the latest version
+  #The connect timeout applies while connecting, the read timeout from then on
+  if conn.sock is None:
+    conn.connect()
+  conn.sock.settimeout(read_timeout)
+  conn.request("POST", "/web_api/{}".format(command), json_payload, request_headers)
+  res = conn.getresponse()
+  #Read the whole body so the connection is free for the next request
+  data = res.read()
+  return res, data
+
+def get_connection_pool(ip_addr):
+  with connection_pools_lock:
+    if ip_addr not in connection_pools:
+      connection_pools[ip_addr] = ApiConnectionPool(ip_addr, max_idle_connections)
+    return connection_pools[ip_addr]
+
+def close_connection_pools():
+  with connection_pools_lock:
+    pools = list(connection_pools.values())
+    connection_pools.clear()
+  for pool in pools:
+    pool.close()
+    print(f"API connections to {pool.ip_addr}: {pool.handshakes} TLS handshakes for {pool.requests} requests, {pool.reused} handshakes avoided by keep-alive reuse, {pool.reconnects} stale connections reconnected")
+
+def api_call(ip_addr, command, json_payload, sid):
   if command == 'login':
     request_headers = {'Content-Type' : 'application/json'}
   else:
     request_headers = {'Content-Type' : 'application/json', 'X-chkp-sid' : sid}
 
-  #We have left the vX.X out of the API call to ensure it uses the latest version
-  conn.request("POST", "/web_api/{}".format(command), json_payload, request_headers)
-  res = conn.getresponse()
-  return res
+  #Only read-only commands are retried - sending login, logout or a change twice is not safe
+  attempts = api_retries + 1 if command.startswith('show-') else 1
+  for attempt in range(attempts):
+    last_attempt = attempt + 1 == attempts
+    try:
+      response = get_connection_pool(ip_addr).request(command, json_payload, request_headers)
+    except (http.client.HTTPException, OSError) as error:
+      if last_attempt:
+        raise
+      print(f"API {command} to {ip_addr} failed ({error or type(error).__name__}), retrying")
+    else:
+      if response.status not in retry_statuses or last_attempt:
+        return response
+      print(f"API {command} to {ip_addr} returned {response.status}, retrying")
+    #Full jitter, so requests that failed together do not all come back at the same moment
+    time.sleep(random.uniform(0, min(retry_backoff_max, retry_backoff_base * 2 ** attempt)))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,7 +1,29 @@
 from __future__ import print_function
 import json, http.client, ssl
-import sys, os, re
-import getpass
+import sys, os, re, socket, random
+import threading, concurrent.futures, queue, collections, time, array
+import sqlite3, codecs, gzip, io, mmap, atexit, logging
+
+#orjson is optional - when installed it is used to decode API responses, it is faster than the json module and decodes straight from bytes
+try:
+  import orjson
+except ImportError:
+  orjson = None
+#pyarrow (parquet / arrow output) and zstandard (csv.zst output) are optional too, only needed for those --output-format choices
+try:
+  import pyarrow, pyarrow.parquet, pyarrow.ipc
+except ImportError:
+  pyarrow = None
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+#api_cassette.py, shared with chkp_hit_count_to_csv_reporting.py, is only needed for --record-cassette / --replay-cassette
+try:
+  from api_cassette import ApiCassette
+except ImportError:
+  ApiCassette = None
+import getpass, argparse
 from datetime import datetime, date
 import datetime
 import csv
@@ -9,8 +31,8 @@ import csv
 """
 Author: Joe Audet
 Date Created: 2022NOV02
-Last Modified: 2024AUG15
-Ver: 0.92
+Last Modified: 2026OCT18
+Ver: 0.93
 
 Usage:
 This script will login to a Check Point management server and retrieve all of the non-shared and non-inline access policy layers, then present 
@@ -19,78 +41,598 @@ a menu where the user can select a policy (or all), which will create a CSV outp
 2024AUG - Reconfigure existing functions to make script MDS capable in addition to running on SMS
         - Add selection menu for domains
         - 
+2026OCT - api_call reuses pooled keep-alive HTTPS connections per management server instead of a new TLS handshake per request
+        - Fetch the remaining pages of each rulebase concurrently once the first page gives the total
+        - Add --all-domains headless mode collecting every layer of every domain in parallel, biggest domains and layers first
+        - Fetch each inline / shared layer once per run and re-number its cached rules under every parent rule that uses it
+        - Stream rows page by page into a background CSV writer thread instead of holding every row until the layer is finished
+        - Add --snapshot-db SQLite rule snapshots and --delta mode writing only new, changed and deleted rules and hit count increases
+        - Record per API command wall time, time to first byte, bytes, JSON decode time and retries, exported with --metrics-json / --metrics-prometheus
+        - Walk rulebase pages incrementally one rule at a time, skipping the unused objects-dictionary (orjson used for whole pages when installed)
+        - Collect each page into a columnar rule table, dates parsed once per distinct day and days since last hit worked out per page, per layer hit count summary
+        - Add --output-format to write csv, csv.gz, csv.zst, jsonl, parquet and arrow reports in one pass (parquet / arrow need pyarrow, csv.zst zstandard)
+        - Keep one session per domain, reused when a domain is selected again, kept alive while idle, re-authenticated when rejected and logged out at exit
+        - Add --journal / --resume to record finished layers and pages and continue an interrupted run from the last good page
+        - Cap API requests in flight per server with an adaptive (AIMD) limit driven by latency and errors, --max-in-flight / --server-max-in-flight
+        - Connect / read timeouts on every API request, jittered exponential backoff retries of read-only commands and optional hedged page requests
+        - Add --lean to fetch rulebase pages without the objects-dictionary (use-object-dictionary false), gzip compressed, reporting the bytes saved per page
+        - Rulebase page size adapts to how long the server takes per page, growing from 50 toward the API maximum of 500 and shrinking on slow or failed pages
+        - Add HitCountClient holding the server, credentials and sessions per instance with domains / layers / rules generators, the menus and --all-domains use it
+        - Walk sections with an explicit stack and queue inline layers as soon as a page references them, fetched in parallel with the rest of the layer
+          by inline layer workers of the client, as many for each domain it works on at the same time
+        - Add --inventory fleet mode collecting every server of a JSON inventory at the same time, with per server caps and one status summary
+        - Add --offline to report on directories of show-access-rulebase JSON dumps without a server, memory-mapped, streamed and spread over the CPU cores
+        - Add --record-cassette / --replay-cassette to record every API exchange (passwords and SIDs left out) and replay it later without a server,
+          with api_cassette.py next to the script (shared by both scripts)
+        - Add --metadata-cache keeping domain and access layer lists on disk, reused until a TTL runs out or the domain is published to
+        - Plan --all-domains runs (and Collect All Policies with --plan) first - rules, API calls, bytes and ETA per domain and layer from timed one rule
+          pages, --plan-only
+        - Add --consolidated-index, a SQLite index holding each rule once by RULE_UID with the domains and policies using it and hit counts summed across domains
+        - Login and logout raise ApiError instead of exiting, HitCountClient session and skipped layer messages go through logging
+        - --delta compares every use of a shared layer rule with the snapshot the run started from, snapshots are kept per management server
+        - Run state (formats, snapshot store, journal, indexes, per server limits and page sizes) lives on a CollectionRun, inline layer caches and hedging state
+          on each HitCountClient, and failed pages are counted per layer read. The menus report layers through HitCountClient.report_layer
 """
 
 #Header line to insert into the top of each CSV
 csv_header=["LAYER_NAME","RULE_NUMBER","RULE_NAME","HIT_COUNT","DATE_LAST_HIT","DAYS_SINCE_LAST_HIT","RULE_ENABLED","MODIFIED_DATE","MODIFIED_BY","RULE_UID"]
 
-#Get today's date
-todays_date = date.today()
+#Login, logout, session and skipped layer messages of HitCountClient - quiet when it is used from another script, main() prints them
+logger = logging.getLogger('chkp_hit_count_to_csv_reporting')
+
 username = ''
 password = ''
 policy_info = []
 mgmt_server = ''
 all_policies_object = {"name" : "Collect All Policies", "uid" : "n/a"}
-all_rules_object = []
 exit_object = {"name" : "Exit", "uid" : "n/a"}
 session_id = ''
-domain_specific_session_id = ''
 last_hit_empty='No last hit to show date for'
 first_hit_empty='No first hit to show date for'
 last_delta_empty='No last hit to compare'
 first_delta_empty='No first hit to compare'
-is_mds=False
+#Keep-alive connection pools, one per management server (see api_call)
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+max_idle_connections = 8
+#API exchanges recorded to or replayed from a file instead of the server (see ApiCassette in api_cassette.py)
+api_cassette = None
+#Socket timeouts in seconds for API requests - to connect, and for each read of a response (a big page can take the server a while to produce)
+connect_timeout = 10
+read_timeout = 120
+#Read-only commands (show-*, keepalive) that time out, fail to connect or get a 429/5xx are sent again up to api_retries times, waiting a random
+#time up to retry_backoff_base * 2^attempt seconds (capped at retry_backoff_max) or the server's Retry-After first
+api_retries = 3
+retry_backoff_base = 0.5
+retry_backoff_max = 10.0
+#Rulebase page requests still running after this percentile of recent page latencies are sent a second time and whichever answers first is used
+#(--hedge-percentile, 0 is off). Needs hedge_min_samples pages to have finished first, the last hedge_history pages of each client are kept
+hedge_percentile = 0
+hedge_min_samples = 20
+hedge_history = 200
+#Requests in flight to each management server are capped by an adaptive limit (see AdaptiveConcurrencyLimit) that starts at initial_in_flight and
+#moves between 1 and max_in_flight, or the server's own cap from --server-max-in-flight
+initial_in_flight = 4
+max_in_flight = 16
+server_max_in_flight = {}
+#Per-command API metrics for this run (see ApiMetrics)
+api_metrics = None
+#Idle sessions are sent a keepalive once they have been idle for half their session-timeout, checked this often
+keepalive_check_seconds = 30
+#How show-access-rulebase pages are decoded - 'stream' walks each page incrementally (see load_rulebase_page), 'orjson' / 'json' decode whole pages,
+#'auto' picks orjson when it is installed and stream otherwise
+rulebase_json_decoder = 'auto'
+#Text decoded at a time when walking a page incrementally
+json_stream_chunk_size = 65536
+json_whitespace = re.compile(r'[ \t\n\r]*')
+json_stream_decoder = json.JSONDecoder()
+#Rulebase page size (the show-access-rulebase limit) starts at initial_page_size and adapts between min_page_size and max_page_size (see
+#AdaptivePageSize) to keep the time the server takes per page under page_target_seconds and a page's response under page_max_bytes
+initial_page_size = 50
+min_page_size = 10
+max_page_size = 500
+api_max_page_size = 500
+page_target_seconds = 5.0
+page_max_bytes = 4 * 1048576
+#Number of rulebase pages fetched at the same time for each layer
+page_fetch_workers = 4
+#Number of domains processed at the same time in --all-domains mode
+domain_workers = 4
+#--plan-only prints the collection plan (see estimate_plan) without collecting, --plan also plans Collect All Policies in the menu before collecting
+plan_only = False
+plan_policies = False
+password_environment_variable = 'CHKP_API_PASSWORD'
+#Number of management servers collected at the same time in --inventory (fleet) mode
+fleet_workers = 8
+#Offline mode (--offline) - the reader of each worker process (see OfflineReader), and the session id prefix naming the domain whose dumps are read
+offline_reader = None
+offline_session_prefix = 'offline:'
+offline_workers = os.cpu_count() or 1
+#Inline layers fetched at the same time for each domain a client works on (see InlineLayerCache), and the pages of a layer read ahead while the
+#inline layers of an earlier page are still being fetched
+inline_layer_workers = 4
+inline_lookahead_pages = 8
+#Rows are handed to the CSV writer thread in batches of writer_batch_rows, with at most writer_queue_batches batches waiting to be written
+writer_batch_rows = 500
+writer_queue_batches = 8
+#Report formats written for every layer in one pass unless --output-format says otherwise (see print_rules), with the extension each one replaces .csv with
+default_output_formats = ['csv']
+output_format_extensions = {'csv' : '.csv', 'csv.gz' : '.csv.gz', 'csv.zst' : '.csv.zst', 'jsonl' : '.jsonl', 'parquet' : '.parquet', 'arrow' : '.arrow'}
+#Column types for the typed formats (jsonl, parquet, arrow), any column not listed is a string
+integer_columns = ("HIT_COUNT", "DAYS_SINCE_LAST_HIT", "HIT_COUNT_INCREASE")
+date_columns = ("DATE_LAST_HIT", "MODIFIED_DATE")
+boolean_columns = ("RULE_ENABLED",)
+#Rule snapshot store used by --snapshot-db / --delta (see SnapshotStore)
+default_snapshot_db = 'hit_count_snapshots.db'
+delta_csv_header = csv_header + ["CHANGE","HIT_COUNT_INCREASE"]
+#Journal of finished layers and pages used by --journal / --resume (see RunJournal)
+default_journal_file = 'hit_count_journal.jsonl'
+#Domain and access layer lists kept on disk between runs (--metadata-cache), see MetadataCache
+default_metadata_cache = 'hit_count_metadata_cache.json'
+metadata_cache_ttl = 86400
+#Cross-domain rule index used by --consolidated-index (see ConsolidatedIndex)
+default_consolidated_index = 'hit_count_index.db'
+#Formats whose files can be cut back to the last journal checkpoint and appended to - a layer written in any other format is redone from its
+#first page on resume
+appendable_output_formats = ('csv', 'jsonl')
+#Dates are parsed once per distinct day for the whole run (see RuleTable.enrich), '' is a rule that was never hit
+day_ordinal_cache = {'' : 0}
+day_text_cache = {}
 domain_names = []
-active_domain_name = ''
 
 #csv_file_name='demo_csv_output.csv'
 
 def main():
-  # getting server / login details from the user
-  global mgmt_server,username,password
-  mgmt_server = input("Enter server IP address [Press ENTER for localhost]:")
+  global mgmt_server,username,password,domain_workers,api_metrics,rulebase_json_decoder,max_in_flight
+  global connect_timeout,read_timeout,api_retries,hedge_percentile,max_page_size,page_target_seconds
+  global api_cassette,plan_only,plan_policies
+  args = parse_arguments()
+  logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+  if args.record_cassette and args.replay_cassette:
+    print("--record-cassette and --replay-cassette cannot be used together")
+    sys.exit(1)
+  if (args.record_cassette or args.replay_cassette) and ApiCassette is None:
+    print("--record-cassette and --replay-cassette need api_cassette.py in the same directory as the script")
+    sys.exit(1)
+  run = CollectionRun(check_output_formats(args.output_format), delta=args.delta, skip_unmodified_layers=args.skip_unmodified_layers, lean=args.lean)
+  if args.record_cassette:
+    api_cassette = ApiCassette(args.record_cassette, ApiResponse)
+  elif args.replay_cassette:
+    api_cassette = ApiCassette(args.replay_cassette, ApiResponse, replay=True, latency_scale=args.replay_latency_scale)
+    #Days since last hit are worked out from the day the session was recorded, so replayed reports are the same whatever day they are made
+    run.todays_date = api_cassette.recorded_date
+  if api_cassette is not None:
+    atexit.register(api_cassette.close)
+  if not min_page_size <= args.max_page_size <= api_max_page_size:
+    print(f"Invalid --max-page-size {args.max_page_size}, expected {min_page_size} to {api_max_page_size}")
+    sys.exit(1)
+  page_target_seconds = args.page_target_seconds
+  max_page_size = args.max_page_size
+  max_in_flight = args.max_in_flight
+  connect_timeout = args.connect_timeout
+  read_timeout = args.read_timeout
+  api_retries = args.retries
+  hedge_percentile = args.hedge_percentile
+  for server_limit in args.server_max_in_flight:
+    server, separator, limit = server_limit.rpartition('=')
+    if not separator or not limit.isdigit() or int(limit) < 1:
+      print(f"Invalid --server-max-in-flight {server_limit}, expected SERVER=NUMBER")
+      sys.exit(1)
+    server_max_in_flight[server] = int(limit)
+  api_metrics = ApiMetrics()
+  rulebase_json_decoder = args.json_decoder
+  if rulebase_json_decoder == 'orjson' and orjson is None:
+    print("orjson is not installed, decoding rulebase pages incrementally with the json module")
+    rulebase_json_decoder = 'stream'
+  elif rulebase_json_decoder == 'auto':
+    rulebase_json_decoder = 'orjson' if orjson is not None else 'stream'
+  domain_workers = args.domain_workers
+  plan_only = args.plan_only
+  plan_policies = args.plan or args.plan_only
+
+  if args.inventory:
+    #Fleet - every server of the inventory at the same time, no prompts or menus
+    fleet = load_inventory(args.inventory)
+    open_run_files(run, args)
+    fleet_results = run_fleet(fleet, args.fleet_workers, run)
+    finish_run(run, args)
+    print_fleet_summary(fleet_results)
+    if args.fleet_summary:
+      write_file_atomically(args.fleet_summary, json.dumps(fleet_results, indent=2))
+      print(f"Wrote fleet summary to {args.fleet_summary}")
+    if any(result["status"] != "ok" for result in fleet_results):
+      sys.exit(1)
+    return
+
+  if args.offline:
+    #Offline - reports from rulebase dumps, no server, prompts or menus
+    if args.journal or args.resume or args.snapshot_db or args.delta or args.consolidated_index:
+      print("--journal, --resume, --snapshot-db, --delta and --consolidated-index are not supported with --offline")
+      sys.exit(1)
+    #Dumps are memory-mapped and always walked one rule at a time, whatever their size
+    rulebase_json_decoder = 'stream'
+    if not run_offline(args.offline, args.offline_workers, run):
+      sys.exit(1)
+    return
+
+  # getting server / login details from the user (command line options skip the prompts so the script can run from cron)
+  mgmt_server = args.server
+  if mgmt_server is None:
+    mgmt_server = input("Enter server IP address [Press ENTER for localhost]:")
   if mgmt_server == '':
     mgmt_server = '127.0.0.1'
   print(f'Connecting to Management Server IP: {mgmt_server}')
 
-  username = input("Enter username (Press ENTER to use admin): ")
+  username = args.user
+  if username is None:
+    username = input("Enter username (Press ENTER to use admin): ")
   if username == '':
     username = 'admin'
 
-  if sys.stdin.isatty():
+  if os.environ.get(password_environment_variable):
+    password = os.environ[password_environment_variable]
+  elif api_cassette is not None and api_cassette.replaying:
+    #Never sent anywhere
+    password = ''
+  elif sys.stdin.isatty():
     password = getpass.getpass(f"Enter password for {username}: ")
   else:
     print("Attention! Your password will be shown on the screen!")
     password = input(f"Enter password for {username}: ")
 
-  #Login to mgmt server - store session ID for subsequent calls and logout
-  session_id = login(username,password,'')
+  #Login to mgmt server - the client keeps the session for subsequent calls, every session is logged out at the end however the script stops
+  client = HitCountClient(mgmt_server, username, password, run=run)
+  try:
+    client.session()
+  except ApiError as error:
+    print(error)
+    sys.exit()
+  collected_completely = True
+  try:
+    #Check if the server we are connecting to is an MDS
+    check_if_mds(client)
+    open_run_files(run, args)
 
-  #Check if the server we are connecting to is an MDS
-  check_if_mds(session_id)
-  
-  #If MDS, loop domains and create a selection menu, if not go right to policy loop
-  if (is_mds):
-    create_interactive_domain_list_menu(session_id)
-  else:
-    create_interactive_access_policy_menu(session_id)
+    if args.all_domains:
+      #Headless - every layer of every domain, no menus. The exit code is 1 if a domain or layer was not collected completely
+      summary = process_all_domains(client)
+      collected_completely = not summary["failed_domains"] and not summary["incomplete_layers"]
+    #If MDS, loop domains and create a selection menu, if not go right to policy loop
+    elif client.is_mds():
+      create_interactive_domain_list_menu(client)
+    else:
+      create_interactive_access_policy_menu(client)
+  finally:
+    client.close()
+  finish_run(run, args)
+  if not collected_completely:
+    sys.exit(1)
 
-def check_if_mds(sid):
-  global is_mds
-  payload = json.dumps({ })
-  response = api_call(mgmt_server, "show-mdss", payload, sid)
-  response_data = response.read()
+#Snapshot store, journal, metadata cache and consolidated index shared by every server and domain of the run
+def open_run_files(run, args):
+  if args.metadata_cache:
+    run.metadata_cache = MetadataCache(args.metadata_cache, args.metadata_cache_ttl)
 
-  #Set is_mds to True if show-mdss call returns a 200, SMS will return a 404 error of command cannot be run unless on MDS
-  if response.status == 200:
-    is_mds=True
-  else:
+  if args.consolidated_index:
+    run.consolidated_index = ConsolidatedIndex(args.consolidated_index)
+
+  if args.snapshot_db or run.delta:
+    run.snapshot_store = SnapshotStore(args.snapshot_db or default_snapshot_db)
+
+  if args.journal or args.resume:
+    run.journal = RunJournal(args.journal or default_journal_file, args.resume)
+
+#End of run - close the snapshot store and journal, then report on the run
+def finish_run(run, args):
+  run.print_inline_layer_stats()
+
+  if run.snapshot_store is not None:
+    run.snapshot_store.close()
+
+  if run.journal is not None:
+    run.journal.close()
+
+  if run.consolidated_index is not None:
+    run.consolidated_index.close()
+
+  if run.metadata_cache is not None:
+    run.metadata_cache.print_stats()
+
+  api_metrics.print_summary()
+  if args.metrics_json:
+    api_metrics.write_json(args.metrics_json)
+    print(f"Wrote API metrics summary to {args.metrics_json}")
+  if args.metrics_prometheus:
+    api_metrics.write_prometheus(args.metrics_prometheus)
+    print(f"Wrote Prometheus API metrics to {args.metrics_prometheus}")
+
+  run.print_concurrency_limits()
+  run.print_page_sizes()
+  if args.lean:
+    print_lean_stats()
+  if hedge_percentile:
+    print(f"Hedged rulebase page requests: {run.stats['hedges-sent']} sent, {run.stats['hedges-won']} answered first")
+
+  #Close the pooled keep-alive connections and report how many handshakes were avoided
+  close_connection_pools()
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description="Export Check Point access-layer hit counts to CSV. Runs the interactive menus unless --all-domains is given")
+  parser.add_argument('--server', help="Management server IP address (prompted for if not given)")
+  parser.add_argument('--user', help="Management API username (prompted for if not given). The password is read from the {} environment variable when set".format(password_environment_variable))
+  parser.add_argument('--all-domains', action='store_true', help="Headless mode - collect every access layer of every domain (or of the SMS) without menus")
+  parser.add_argument('--inventory', help="Fleet mode - collect every layer of every server listed in this JSON inventory file at the same time, without prompts or menus (see README)")
+  parser.add_argument('--fleet-workers', type=int, default=fleet_workers, help="Number of servers collected at the same time in --inventory mode (default: %(default)s)")
+  parser.add_argument('--fleet-summary', help="Also write the --inventory status summary to this JSON file")
+  parser.add_argument('--offline', action='append', metavar='PATH', help="Offline mode - report on show-access-rulebase JSON dumps instead of a server. PATH is a dump file or a directory of them, dumps in its subdirectories belong to the domain named after the subdirectory. Can be given more than once (see README)")
+  parser.add_argument('--offline-workers', type=int, default=offline_workers, help="Processes reading dumps at the same time in --offline mode (default: %(default)s, the number of CPUs)")
+  parser.add_argument('--plan-only', action='store_true', help="Size every layer and print the collection plan (rules, API calls, bytes and ETA per domain and layer) without collecting. Applies to --all-domains, --inventory and Collect All Policies")
+  parser.add_argument('--plan', action='store_true', help="Print the collection plan before Collect All Policies in the menu collects, which sends a one rule page per layer and one timed page more. --all-domains and --inventory always plan")
+  parser.add_argument('--domain-workers', type=int, default=domain_workers, help="Number of domains processed at the same time in --all-domains mode (default: %(default)s)")
+  parser.add_argument('--snapshot-db', help="SQLite file keeping a snapshot of every rule's hit count between runs (default with --delta: {})".format(default_snapshot_db))
+  parser.add_argument('--delta', action='store_true', help="Only write new, changed and deleted rules and hit count increases since the last snapshot, to <layer>_hit_count_delta_<date>.csv")
+  parser.add_argument('--output-format', default=','.join(default_output_formats), help="Comma separated report formats written for every layer in one pass: {} (default: %(default)s). parquet / arrow need pyarrow and csv.zst needs zstandard".format(', '.join(output_format_extensions)))
+  parser.add_argument('--max-in-flight', type=int, default=max_in_flight, help="Most API requests in flight to a management server at once. The actual limit adapts to the server's latency and errors up to this (default: %(default)s)")
+  parser.add_argument('--server-max-in-flight', action='append', default=[], metavar='SERVER=NUMBER', help="--max-in-flight for one server, e.g. for a smaller appliance. Can be given more than once")
+  parser.add_argument('--connect-timeout', type=float, default=connect_timeout, help="Seconds to wait to connect to the management server (default: %(default)s)")
+  parser.add_argument('--read-timeout', type=float, default=read_timeout, help="Seconds to wait for each read of an API response before giving up on the request (default: %(default)s)")
+  parser.add_argument('--retries', type=int, default=api_retries, help="Times a read-only request that timed out, failed or got a 429/5xx is sent again, with jittered exponential backoff (default: %(default)s)")
+  parser.add_argument('--hedge-percentile', type=float, default=hedge_percentile, help="Send a rulebase page request a second time when it is still running after this percentile of recent page latencies, e.g. 95. 0 turns hedging off (default: %(default)s)")
+  parser.add_argument('--max-page-size', type=int, default=max_page_size, help="Largest number of rules asked for in one rulebase page. The page size starts at {} and grows toward this while pages come back quickly (default: %(default)s, the API maximum)".format(initial_page_size))
+  parser.add_argument('--page-target-seconds', type=float, default=page_target_seconds, help="Time the server may take to answer one rulebase page before the page size is cut (default: %(default)s)")
+  parser.add_argument('--lean', action='store_true', help="Fetch rulebase pages without the objects-dictionary (use-object-dictionary false) and gzip compressed")
+  parser.add_argument('--record-cassette', metavar='FILE', help="Record every API request and response of the run (passwords and SIDs left out) to this gzip compressed file, for --replay-cassette")
+  parser.add_argument('--replay-cassette', metavar='FILE', help="Answer API requests from a file written by --record-cassette instead of the server, e.g. to benchmark or compare reports without touching a production server")
+  parser.add_argument('--replay-latency-scale', type=float, default=1.0, help="With --replay-cassette, multiply the recorded response times by this. 0 replays as fast as possible (default: %(default)s)")
+  parser.add_argument('--journal', help="Record finished layers and pages in this file so an interrupted run can be continued with --resume (default with --resume: {})".format(default_journal_file))
+  parser.add_argument('--resume', action='store_true', help="Continue the run recorded in the journal - finished layers are skipped and a partly written layer carries on from its last recorded page")
+  parser.add_argument('--metadata-cache', nargs='?', const=default_metadata_cache, metavar='FILE', help="Keep the domain and access layer lists in this file between runs instead of fetching them at every start (default file: {})".format(default_metadata_cache))
+  parser.add_argument('--metadata-cache-ttl', type=float, default=metadata_cache_ttl, help="Seconds a cached list is used for before it is fetched again. Within that a list is fetched again as soon as its domain has been published to (default: %(default)s)")
+  parser.add_argument('--consolidated-index', nargs='?', const=default_consolidated_index, metavar='FILE', help="Also keep every rule collected in this SQLite file once by RULE_UID, with the servers, domains and policies using it and its hit counts added up across domains (default file: {})".format(default_consolidated_index))
+  parser.add_argument('--metrics-json', help="Write per API command timing, payload, retry and error metrics for the run to this JSON file")
+  parser.add_argument('--metrics-prometheus', help="Write the same metrics in Prometheus text format to this file (e.g. for the node exporter textfile collector)")
+  parser.add_argument('--json-decoder', choices=['auto', 'stream', 'orjson', 'json'], default=rulebase_json_decoder, help="How rulebase pages are decoded: stream walks each page one rule at a time, orjson / json decode whole pages. auto uses orjson when installed, otherwise stream (default: %(default)s)")
+  parser.add_argument('--skip-unmodified-layers', action='store_true', help="With --delta, skip layers whose last-modify-time has not changed since the last snapshot. Hit counts of skipped layers are not refreshed")
+  return parser.parse_args()
+
+def check_output_formats(formats):
+  selected = []
+  for output_format in formats.split(','):
+    output_format = output_format.strip()
+    if output_format not in output_format_extensions:
+      print(f"Unknown output format {output_format}, choose from {', '.join(output_format_extensions)}")
+      sys.exit(1)
+    if output_format in ('parquet', 'arrow') and pyarrow is None:
+      print(f"Output format {output_format} needs pyarrow, install it with: pip3 install pyarrow")
+      sys.exit(1)
+    if output_format == 'csv.zst' and zstandard is None:
+      print("Output format csv.zst needs zstandard, install it with: pip3 install zstandard")
+      sys.exit(1)
+    if output_format not in selected:
+      selected.append(output_format)
+  return selected
+
+#What one collection run shares between its clients and domain threads - the report formats and modes, the day DAYS_SINCE_LAST_HIT counts from,
+#the snapshot store, journal, metadata cache and consolidated index (see open_run_files), the adaptive concurrency limit and page size of each
+#management server and the run's counters. main() makes one from the command line, a HitCountClient made without one gets its own with the
+#defaults, so clients of different runs in one process share nothing
+class CollectionRun:
+  def __init__(self, output_formats=None, delta=False, skip_unmodified_layers=False, lean=False):
+    self.output_formats = list(output_formats or default_output_formats)
+    self.delta = delta
+    self.skip_unmodified_layers = skip_unmodified_layers
+    self.lean = lean
+    self.todays_date = date.today()
+    self.snapshot_store = None
+    self.journal = None
+    self.metadata_cache = None
+    self.consolidated_index = None
+    self.lock = threading.Lock()
+    self.concurrency_limits = {}
+    self.page_sizes = {}
+    self.stats = {"inline-fetched" : 0, "inline-hits" : 0, "hedges-sent" : 0, "hedges-won" : 0}
+
+  def count(self, name):
+    with self.lock:
+      self.stats[name] += 1
+
+  def concurrency_limit(self, server):
+    with self.lock:
+      if server not in self.concurrency_limits:
+        self.concurrency_limits[server] = AdaptiveConcurrencyLimit(server, server_max_in_flight.get(server, max_in_flight))
+      return self.concurrency_limits[server]
+
+  def page_size(self, server):
+    with self.lock:
+      if server not in self.page_sizes:
+        self.page_sizes[server] = AdaptivePageSize(server, initial_page_size, max_page_size)
+      return self.page_sizes[server]
+
+  def print_concurrency_limits(self):
+    with self.lock:
+      limits = list(self.concurrency_limits.values())
+    for limit in limits:
+      print(f"API concurrency for {limit.ip_addr}: limit {int(limit.limit)} of {limit.max_limit} (lowest {int(limit.lowest_limit)}), {limit.decreases} decreases, peak {limit.peak_in_flight} in flight, {limit.waits} requests waited {limit.wait_seconds:.1f} s for a slot")
+
+  def print_page_sizes(self):
+    with self.lock:
+      page_sizes = list(self.page_sizes.values())
+    for page_size in page_sizes:
+      page_size.print_stats()
+
+  def print_inline_layer_stats(self):
+    with self.lock:
+      if self.stats["inline-fetched"]:
+        print(f"Inline layers: {self.stats['inline-fetched']} fetched, {self.stats['inline-hits']} further references served from cache")
+
+#Hit count client for one management server, for use from other scripts as well as by the menus and --all-domains below. It holds the server, the
+#credentials, one session per domain (see SessionManager) and the inline layers read through them, so clients for several servers, and several
+#domains of one client, can be worked on from different threads at once. What is written where is up to the run (see CollectionRun), clients
+#given the same run share its files and each server's request limit and page size. A request the API refuses raises ApiError:
+#  client = HitCountClient('192.0.2.10', 'admin', password)
+#  for domain in client.domains():
+#    for layer in client.layers(domain['name']):
+#      for rule in client.rules(layer['uid'], domain['name']):
+#        print(rule['RULE_NUMBER'], rule['HIT_COUNT'])
+#  client.close()
+class HitCountClient:
+  def __init__(self, server, username, password, output_directory='', run=None, workers=None):
+    self.server = server
+    self.username = username
+    self.password = password
+    #Where the reports of this server are written (see loop_policy_rulebase)
+    self.output_directory = output_directory
+    #Domains of this server worked on at the same time (see process_all_domains), --domain-workers unless the inventory gives the server its own
+    self.domain_workers = workers or domain_workers
+    self.run = run if run is not None else CollectionRun()
+    self.concurrency_limit = self.run.concurrency_limit(server)
+    self.page_size = self.run.page_size(server)
+    #Each client has its own inline layer workers, as many for every domain it works on at the same time, so neither the domains of a server nor the
+    #servers of a fleet run wait on each other's inline layers
+    self.inline_layers = InlineLayerCache(self, inline_layer_workers * self.domain_workers)
+    self.lock = threading.Lock()
+    #Recent rulebase page latencies and the threads sending hedged requests (see hedged_api_call)
+    self.hedge_latencies = collections.deque(maxlen=hedge_history)
+    self.hedge_executor = None
+    self.sessions = SessionManager(self)
+    self.mds = None
+
+  #SID of the session for a domain ('' is the MDS / SMS itself), logging in the first time it is asked for
+  def session(self, domain_name=''):
+    return self.sessions.get(domain_name)
+
+  #show-mdss only succeeds on an MDS, a SMS answers 404
+  def is_mds(self):
+    if self.mds is None:
+      response = api_call(self, 'show-mdss', json.dumps({}), self.session())
+      self.mds = response.status == 200
+    return self.mds
+
+  def show(self, command, payload, domain_name=''):
+    response = api_call(self, command, json.dumps(payload), self.session(domain_name))
+    data = response.read()
+    if response.status != 200:
+      raise ApiError(command, data.decode('utf-8'))
+    return load_api_json(command, data, self.server)
+
+  #Domains of an MDS, none on a SMS
+  def domains(self):
+    if not self.is_mds():
+      return
+    for domain in self.cached_metadata('domains', '', lambda: [{"name" : domain["name"], "uid" : domain.get("uid")} for domain in self.show('show-domains', {})['objects']]):
+      yield dict(domain)
+
+  #Ordered access layers of a domain - shared and inline layers are not reported on their own, their rules are read through the rules that use them
+  def layers(self, domain_name=''):
+    for accesslayer in self.cached_metadata('access-layers', domain_name, lambda: self.access_layers(domain_name)):
+      if (accesslayer['shared']):
+        logger.info('Skipping Shared Layer - {}'.format(accesslayer["name"]))
+        continue
+      if accesslayer['inline']:
+        logger.info('Skipping Inline Layer - {}'.format(accesslayer["name"]))
+        continue
+      yield {"name": accesslayer["name"], "uid" : accesslayer["uid"], "last-modify-time" : accesslayer["last-modify-time"]}
+
+  #The fields of each access layer the report uses
+  def access_layers(self, domain_name=''):
+    return [{"name" : accesslayer["name"], "uid" : accesslayer["uid"], "shared" : accesslayer['shared'], "inline" : 'parent-layer' in accesslayer,
+      "last-modify-time" : accesslayer.get('meta-info', {}).get('last-modify-time', {}).get('posix')}
+      for accesslayer in self.show('show-access-layers', {"details-level": "full"}, domain_name)['access-layers']]
+
+  #A list from the metadata cache while it is fresh, otherwise fetched (and cached)
+  def cached_metadata(self, kind, domain_name, fetch):
+    metadata_cache = self.run.metadata_cache
+    if metadata_cache is None:
+      return fetch()
+    published = self.last_published(domain_name)
+    data = metadata_cache.get(self.server, domain_name, kind, published)
+    if data is None:
+      data = fetch()
+      metadata_cache.put(self.server, domain_name, kind, published, data)
+    return data
+
+  #When the domain (or the MDS / SMS) was last published to, as posix milliseconds - every change to a layer has to be published, so a list cached
+  #at the same publish time is still right. None if the server cannot say, the cache then goes by its TTL alone
+  def last_published(self, domain_name=''):
+    try:
+      return self.show('show-last-published-session', {}, domain_name).get('publish-time', {}).get('posix')
+    except ApiError:
+      return None
+
+  #Number of rules in a layer, from a one rule page, with how long the page took and its size in bytes
+  def probe_layer(self, layer_uid, domain_name=''):
+    sid = self.session(domain_name)
+    started = time.monotonic()
+    status, data = get_rulebase_page(self, layer_uid, sid, 0, 1, measure=False)
+    seconds = time.monotonic() - started
+    if status != 200:
+      raise ApiError('show-access-rulebase', data.decode('utf-8'))
+    return {"total" : load_api_json('show-access-rulebase', data, self.server)['total'], "probe-seconds" : seconds, "probe-bytes" : len(data)}
+
+  def layer_size(self, layer_uid, domain_name=''):
+    return self.probe_layer(layer_uid, domain_name)["total"]
+
+  #The rules of a layer one page at a time, inline and shared layers numbered under the rules that use them. Pages that failed are reported as they
+  #happen and ApiError is raised once the pages that did arrive have been yielded
+  def rule_tables(self, layer_uid, domain_name=''):
+    sid = self.session(domain_name)
+    errors = RulebaseErrors()
+    pages, error_data = self.rulebase_pages(layer_uid, sid, 0, errors)
+    if pages is None:
+      raise ApiError('show-access-rulebase', error_data.decode('utf-8'))
+    for response_data, rule_table in resolved_pages(self, pages, sid, errors):
+      rule_table.enrich()
+      yield rule_table
+    if errors.count:
+      raise ApiError('show-access-rulebase', 'some pages of layer {} could not be read'.format(layer_uid))
+
+  #Flattened rule records keyed by the report columns, typed like the jsonl report (ints, dates, RULE_ENABLED as a boolean, None for no value)
+  def rules(self, layer_uid, domain_name=''):
+    converters = column_converters(csv_header)
+    for rule_table in self.rule_tables(layer_uid, domain_name):
+      for row in rule_table.rows(self.run.todays_date):
+        yield {column : convert(value) for column, convert, value in zip(csv_header, converters, row)}
+
+  #Write the reports of a layer as the run asks (see loop_policy_rulebase) - True if every page of it and its inline layers was read
+  def report_layer(self, layer_uid, policy_name, domain_name='', layer_modified=None):
+    return loop_policy_rulebase(self, layer_uid, policy_name, self.session(domain_name), domain_name.replace(' ','_'), layer_modified)
+
+  #Pages of a layer read through a session of this client, see get_rulebase_pages
+  def rulebase_pages(self, layer_uid, sid, start_offset, errors):
+    return get_rulebase_pages(self, layer_uid, sid, start_offset, errors)
+
+  #Threads sending hedged rulebase page requests, started with the first of them - enough for every page fetch worker of every domain worker of
+  #the client to have a request and its hedge out at once
+  def hedge_pool(self):
+    with self.lock:
+      if self.hedge_executor is None:
+        self.hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=page_fetch_workers * self.domain_workers * 2)
+      return self.hedge_executor
+
+  #Log out of a domain nothing else needs, the next session() for it logs in again. Its cached inline layers are dropped with the session (see logout)
+  def release(self, domain_name):
+    self.sessions.release(domain_name)
+
+  #Inline layers still queued are not fetched, they would only keep the sessions busy, then every session is logged out
+  def close(self):
+    self.inline_layers.cancel()
+    self.sessions.close()
+    if self.hedge_executor is not None:
+      self.hedge_executor.shutdown(wait=False)
+
+#Raised by HitCountClient when the API refuses a request - the menus print it and stop as they did before
+class ApiError(Exception):
+  def __init__(self, command, message):
+    super().__init__('Error occurred while trying to {}: {}'.format(command, message))
+    self.command = command
+
+def check_if_mds(client):
+  if not client.is_mds():
     print("SMS server, skipping domain selection screen\n")
-    print('Error occurred while trying to show-mdss: {}'.format(response_data.decode('utf-8')))
 
-def create_interactive_domain_list_menu(sid):
-  global domain_names,domain_specific_session_id,active_domain_name
-  domain_names = get_domain_names(sid)
+def create_interactive_domain_list_menu(client):
+  global domain_names
+  domain_names = get_domain_names(client)
   clear_console()
   print_domain_names()
 
@@ -99,15 +641,13 @@ def create_interactive_domain_list_menu(sid):
     try:
         #policy_info[selected_policy_number]
         if (domain_names[selected_domain_number]["name"] == 'Exit'):
-          logout(sid)
           break
         else:
           clear_console()
           domain_name = domain_names[selected_domain_number]['name'].replace(' ','_')
           print(f"Processing domain: {domain_name}")
-          active_domain_name = domain_name
-          domain_specific_session_id = login(username,password,domain_name)
-          create_interactive_access_policy_menu(domain_specific_session_id)
+          #Coming back to a domain reuses its session rather than logging in again
+          create_interactive_access_policy_menu(client, domain_name)
           print_domain_names()
           continue
 
@@ -122,24 +662,16 @@ def create_interactive_domain_list_menu(sid):
       print_domain_names()
       continue
 
-def get_domain_names(sid):
-  domain_names = []
-  payload = json.dumps({ })
+def get_domain_names(client):
   # Get names of domains - store for iteration
-  response = api_call(mgmt_server, 'show-domains', payload, sid)
-  data = response.read()
-  if response.status == 200:
-    response_data = json.loads(data.decode('utf-8'))
-    for domain in response_data['objects']:
-      domain_names.append({"name": domain["name"]})
-
-    #Add this as final entry for users to cleanly close out of the loop
-    domain_names.insert(len(domain_names),exit_object)
-    return domain_names
-  else:
-    print('Error occurred while trying to show-domains: {}'.format(data.decode('utf-8')))
-    logout(sid)
-    sys.exit()  
+  try:
+    domain_names = [{"name": domain["name"]} for domain in client.domains()]
+  except ApiError as error:
+    print(error)
+    sys.exit()
+  #Add this as final entry for users to cleanly close out of the loop
+  domain_names.insert(len(domain_names),exit_object)
+  return domain_names
 
 def print_domain_names():
   print("\n===== Domain Names =====")
@@ -149,11 +681,432 @@ def print_domain_names():
       domain_counter+=1
   print("\n")
 
+#Headless collection of every layer in every domain. Each domain is worked on by its own thread with its own session, up to the client's domain_workers at a time.
+#Domains are planned first (one single-rule page per layer gives its total, see estimate_plan) so the biggest domains, and the biggest layers within
+#them, start first and the long ones do not finish last. A domain is logged out once planned and logged in again when collected, so no more than
+#domain_workers domain sessions are open at once however many domains the MDS has
+def process_all_domains(client):
+  workers = client.domain_workers
+  if client.is_mds():
+    domains = [domain["name"] for domain in get_domain_names(client) if domain["name"] != exit_object["name"]]
+  else:
+    domains = ['']
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    domain_plans = [plan for plan in executor.map(lambda domain: plan_domain(client, domain, release=True), domains) if plan is not None]
+  domain_plans.sort(key=lambda plan: plan["total"], reverse=True)
+  estimate = estimate_plan(client, domain_plans, workers)
+  #The page timed for the estimate logged in to the domain of the biggest layer again
+  for plan in domain_plans:
+    if plan["name"]:
+      client.release(plan["name"])
+  print_plan(domain_plans, estimate)
+  failed = sorted(set(domains) - set(plan["name"] for plan in domain_plans))
+  summary = {"domains" : len(domains), "failed_domains" : failed, "incomplete_layers" : [], "layers" : sum(len(plan['layers']) for plan in domain_plans),
+    "rules" : sum(plan['total'] for plan in domain_plans), "planned_seconds" : round(estimate["seconds"], 1) if estimate else None}
+  if plan_only:
+    return summary
+
+  started = time.monotonic()
+  print(f"Collecting {summary['rules']} rules from {summary['layers']} layers in {len(domain_plans)} domain(s) using {workers} worker(s)")
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    incomplete = list(executor.map(collect_domain, [client] * len(domain_plans), domain_plans))
+
+  failed = [plan["name"] for plan, layers in zip(domain_plans, incomplete) if layers is None] + failed
+  summary["failed_domains"] = failed
+  summary["incomplete_layers"] = [layer for layers in incomplete if layers for layer in layers]
+  print(f"Finished {len(domains) - len(failed)} of {len(domains)} domain(s) in {format_seconds(time.monotonic() - started)}" + (f" (planned {format_seconds(estimate['seconds'])})" if estimate else '') +
+    (f" - failed: {', '.join(failed)}" if failed else '') + (f" - incomplete layers: {', '.join(summary['incomplete_layers'])}" if summary["incomplete_layers"] else ''))
+  return summary
+
+#Layers of a domain (all its ordered layers unless given), each sized with a timed one rule page, biggest first. With release the domain is logged
+#out once sized, collect_domain logs in again
+def plan_domain(client, domain_name, layers=None, release=False):
+  #An API error in headless mode only ends this domain, the others carry on
+  try:
+    layers = [dict(layer) for layer in (client.layers(domain_name) if layers is None else layers)]
+    for layer in layers:
+      try:
+        layer.update(client.probe_layer(layer["uid"], domain_name))
+      except ApiError:
+        layer.update({"total" : 0, "probe-seconds" : None, "probe-bytes" : None})
+  except ApiError as error:
+    print(error)
+    print(f"Skipping domain {domain_name} - unable to list its access layers")
+    return None
+  finally:
+    if release and domain_name:
+      client.release(domain_name)
+  layers.sort(key=lambda layer: layer["total"], reverse=True)
+  return {"name" : domain_name, "layers" : layers, "total" : sum(layer["total"] for layer in layers)}
+
+#Pre-flight estimate of a collection from its domain plans - the API calls (pages), bytes and seconds of every layer and of the whole run. The
+#latency of a request is the median of the one rule pages the layers were sized with, and one page at the current page size is timed on the
+#biggest layer for the time each further rule adds. Pages grow and shrink as AdaptivePageSize would make them, the first page of a layer is
+#fetched on its own and the rest page_fetch_workers at a time, and domains run workers at a time, biggest first, with no more requests in
+#flight than the server is allowed. Inline and shared layers are only found while collecting so are not in the estimate. None if no layer
+#could be sized
+def estimate_plan(client, domain_plans, workers):
+  probed = [layer for plan in domain_plans for layer in plan["layers"] if layer.get("probe-seconds") is not None]
+  if not probed:
+    return None
+  request_seconds = sorted(layer["probe-seconds"] for layer in probed)[len(probed) // 2]
+  rule_bytes = sorted(layer["probe-bytes"] for layer in probed)[len(probed) // 2]
+  rule_seconds = 0.0
+  sample = time_full_page(client, domain_plans)
+  if sample is not None:
+    rule_seconds = max(0.0, sample["seconds"] - request_seconds) / max(1, sample["rules"] - 1)
+    rule_bytes = sample["bytes"] / float(sample["rules"])
+
+  #Requests in flight are held to the server's adaptive limit as it stands after the probes
+  in_flight = max(1, min(workers * page_fetch_workers, int(client.concurrency_limit.limit)))
+  size = client.page_size.current()
+  largest_size = max(min_page_size, min(max_page_size, int(page_max_bytes / rule_bytes) if rule_bytes else max_page_size))
+  busy_seconds = 0.0
+  for plan in domain_plans:
+    plan["seconds"] = 0.0
+    for layer in plan["layers"]:
+      page_seconds, size = estimate_layer_pages(layer["total"], size, largest_size, request_seconds, rule_seconds)
+      layer["pages"] = len(page_seconds)
+      layer["bytes"] = int(layer["total"] * rule_bytes)
+      layer["seconds"] = page_seconds[0] + sum(page_seconds[1:]) / min(page_fetch_workers, in_flight)
+      plan["seconds"] += layer["seconds"]
+      busy_seconds += sum(page_seconds)
+
+  #Each domain goes to the worker that is free first, in plan order
+  finish = [0.0] * max(1, min(workers, len(domain_plans)))
+  for plan in domain_plans:
+    finish[finish.index(min(finish))] += plan["seconds"]
+  layers = [layer for plan in domain_plans for layer in plan["layers"]]
+  return {"domains" : len(domain_plans), "layers" : len(layers), "rules" : sum(layer["total"] for layer in layers), "pages" : sum(layer["pages"] for layer in layers),
+    "bytes" : sum(layer["bytes"] for layer in layers), "seconds" : max(max(finish), busy_seconds / in_flight), "request_seconds" : request_seconds,
+    "rule_seconds" : rule_seconds, "in_flight" : in_flight}
+
+#Seconds of each page of a layer of total rules and the page size after it, following get_rulebase_pages and AdaptivePageSize.record - the first
+#page is read on its own (and never grows the size), then up to page_fetch_workers * 2 pages are requested ahead, each at the size as it stood
+#when it was requested, and only a page as big as the current size grows it
+def estimate_layer_pages(total, size, largest_size, request_seconds, rule_seconds):
+  window = page_fetch_workers * 2
+  #Page size after each finished page, the first entry before any
+  sizes = [size]
+  page_seconds = []
+  offset = 0
+  #An empty layer still takes a page to find that out
+  while offset < total or not page_seconds:
+    limit = sizes[max(1, len(page_seconds) - window + 1) if page_seconds else 0]
+    rules = min(limit, total - offset)
+    page_seconds.append(request_seconds + rule_seconds * rules)
+    fitting = int((rules or limit) * page_target_seconds / max(page_seconds[-1], 0.001))
+    if fitting < limit:
+      size = max(min_page_size, min(size, fitting))
+    elif offset and rules >= size:
+      size = max(min_page_size, min(2 * size, fitting, largest_size))
+    sizes.append(size)
+    offset += limit
+  return page_seconds, size
+
+#One rulebase page at the current page size from the biggest layer of the plans, timed - None if every layer fits a one rule page or it failed
+def time_full_page(client, domain_plans):
+  layers = [(layer, plan["name"]) for plan in domain_plans for layer in plan["layers"] if layer["total"] > 1]
+  if not layers:
+    return None
+  layer, domain_name = max(layers, key=lambda entry: entry[0]["total"])
+  limit = client.page_size.current()
+  rules = min(limit, layer["total"])
+  sid = client.session(domain_name)
+  started = time.monotonic()
+  status, data = get_rulebase_page(client, layer["uid"], sid, 0, limit, rules=rules)
+  if status != 200:
+    return None
+  return {"rules" : rules, "seconds" : time.monotonic() - started, "bytes" : len(data)}
+
+def print_plan(domain_plans, estimate):
+  print("\n===== Collection Plan =====")
+  if estimate is None:
+    print("No layer could be sized\n")
+    return
+  print(f"{'DOMAIN':<24} {'LAYER':<32} {'RULES':>8} {'API CALLS':>9} {'MB':>8} {'SECONDS':>8}")
+  for plan in domain_plans:
+    for layer in plan["layers"]:
+      print(f"{plan['name'] or '-':<24} {layer['name']:<32} {layer['total']:>8} {layer['pages']:>9} {layer['bytes'] / 1048576.0:>8.1f} {layer['seconds']:>8.1f}")
+    if len(plan["layers"]) > 1:
+      print(f"{plan['name'] or '-':<24} {'(all layers)':<32} {plan['total']:>8} {sum(layer['pages'] for layer in plan['layers']):>9} {sum(layer['bytes'] for layer in plan['layers']) / 1048576.0:>8.1f} {plan['seconds']:>8.1f}")
+  print(f"{estimate['rules']} rules in {estimate['layers']} layer(s) of {estimate['domains']} domain(s): about {estimate['pages']} API calls and {estimate['bytes'] / 1048576.0:.1f} MB, "
+    f"ETA {format_seconds(estimate['seconds'])} ({estimate['request_seconds'] * 1000:.0f} ms per request + {estimate['rule_seconds'] * 1000:.2f} ms per rule, up to {estimate['in_flight']} requests in flight)")
+  print("Inline and shared layers are fetched as they are found and are not included\n")
+
+def format_seconds(seconds):
+  return str(datetime.timedelta(seconds=int(round(seconds))))
+
+#Layers of the domain that could not be read in full (a failed page or inline layer), or None if the domain was stopped by an API error
+def collect_domain(client, plan):
+  incomplete = []
+  try:
+    for layer in plan["layers"]:
+      policy_name = layer['name'].replace(' ','_')
+      print(f"Processing access-layer: {policy_name}" + (f" in domain {plan['name']}" if plan["name"] else ''))
+      if not client.report_layer(layer["uid"], policy_name, plan["name"], layer["last-modify-time"]):
+        incomplete.append(f"{plan['name']}/{layer['name']}" if plan["name"] else layer['name'])
+    #Nothing else needs this domain, so its session is not left open until the other domains finish
+    if plan["name"]:
+      client.release(plan["name"])
+  except ApiError:
+    print(f"Stopped processing domain {plan['name']} after an API error")
+    return None
+  return incomplete
+
+#Fleet mode (--inventory) - a JSON file listing the management servers, each collected headless by its own client at the same time:
+#  {"defaults" : {"user" : "reporting", "password-env" : "CHKP_API_PASSWORD"},
+#   "servers" : [{"name" : "mds-east", "server" : "192.0.2.10", "max-in-flight" : 8},
+#                {"server" : "192.0.2.20", "user" : "admin", "password-file" : "/root/.sms2_password", "domain-workers" : 2}]}
+#The password is named by password-env (an environment variable) or password-file (a file holding it) so the inventory holds no secrets. Each
+#server's reports go to output-directory, by default a directory named after the server
+inventory_keys = ("name", "server", "user", "password-env", "password-file", "max-in-flight", "domain-workers", "output-directory")
+
+def load_inventory(path):
+  try:
+    with open(path) as file:
+      inventory = json.load(file)
+  except (OSError, ValueError) as error:
+    print(f"Unable to read inventory {path}: {error}")
+    sys.exit(1)
+  defaults = inventory.get("defaults", {})
+  fleet = []
+  for entry in inventory.get("servers", []):
+    #A server can be given as just its address
+    if isinstance(entry, str):
+      entry = {"server" : entry}
+    entry = dict(defaults, **entry)
+    unknown = sorted(set(entry) - set(inventory_keys))
+    if unknown or not entry.get("server"):
+      print(f"Invalid inventory entry {entry.get('name', entry.get('server'))}: " + (f"unknown keys {', '.join(unknown)}" if unknown else "no server given"))
+      sys.exit(1)
+    name = entry.get("name", entry["server"])
+    if any(server["name"] == name for server in fleet):
+      print(f"Server {name} is in the inventory more than once")
+      sys.exit(1)
+    if "max-in-flight" in entry:
+      server_max_in_flight[entry["server"]] = int(entry["max-in-flight"])
+    output_directory = entry.get("output-directory", re.sub(r'[^A-Za-z0-9_.-]', '_', name))
+    os.makedirs(output_directory, exist_ok=True)
+    fleet.append({"name" : name, "server" : entry["server"], "user" : entry.get("user", "admin"), "password" : inventory_password(entry, name),
+      "domain-workers" : int(entry.get("domain-workers", domain_workers)), "output-directory" : output_directory})
+  if not fleet:
+    print(f"No servers in inventory {path}")
+    sys.exit(1)
+  return fleet
+
+def inventory_password(entry, name):
+  if "password-env" in entry and os.environ.get(entry["password-env"]):
+    return os.environ[entry["password-env"]]
+  if "password-file" in entry:
+    try:
+      with open(entry["password-file"]) as file:
+        return file.read().strip()
+    except OSError as error:
+      print(f"Unable to read the password file of {name}: {error}")
+      sys.exit(1)
+  print(f"No password for {name} - set the environment variable named by password-env or give a password-file")
+  sys.exit(1)
+
+def run_fleet(fleet, workers, run):
+  print(f"Collecting {len(fleet)} management server(s) using {workers} worker(s)")
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(collect_server, fleet, [run] * len(fleet)))
+
+#Everything about one server ends up in its result - a server that cannot be reached or logged in to does not stop the others
+def collect_server(entry, run):
+  started = time.monotonic()
+  result = {"name" : entry["name"], "server" : entry["server"], "type" : None, "status" : "failed", "domains" : 0, "failed_domains" : [],
+    "incomplete_layers" : [], "layers" : 0, "rules" : 0, "planned_seconds" : None, "seconds" : 0.0, "error" : None}
+  client = HitCountClient(entry["server"], entry["user"], entry["password"], entry["output-directory"], run, entry["domain-workers"])
+  try:
+    client.session()
+    result["type"] = "MDS" if client.is_mds() else "SMS"
+    result.update(process_all_domains(client))
+    result["status"] = "partial" if result["failed_domains"] or result["incomplete_layers"] else "ok"
+  except (ApiError, http.client.HTTPException, OSError) as error:
+    result["error"] = str(error) or type(error).__name__
+    print(f"Stopped collecting {entry['name']}: {result['error']}")
+  finally:
+    client.close()
+  result["seconds"] = round(time.monotonic() - started, 1)
+  return result
+
+def print_fleet_summary(results):
+  print("\n===== Fleet Summary =====")
+  print(f"{'NAME':<24} {'TYPE':<4} {'STATUS':<8} {'DOMAINS':>8} {'LAYERS':>7} {'RULES':>9} {'SECONDS':>8}  DETAILS")
+  for result in results:
+    details = result["error"] or '; '.join(([f"failed domains: {', '.join(result['failed_domains'])}"] if result["failed_domains"] else []) +
+      ([f"incomplete layers: {', '.join(result['incomplete_layers'])}"] if result["incomplete_layers"] else []))
+    print(f"{result['name']:<24} {result['type'] or '-':<4} {result['status']:<8} {result['domains'] - len(result['failed_domains']):>4}/{result['domains']:<3} {result['layers']:>7} {result['rules']:>9} {result['seconds']:>8.1f}  {details}")
+  print(f"{sum(result['status'] == 'ok' for result in results)} of {len(results)} server(s) collected completely\n")
+
+#Offline mode (--offline) - reports from show-access-rulebase responses saved as JSON files, one page per file, and the show-access-layers
+#response of each domain, e.g.
+#  mgmt_cli -r true show access-rulebase uid <layer uid> offset 0 limit 500 show-hits true --format json > network_0.json
+#  mgmt_cli -r true show access-layers details-level full limit 500 --format json > access_layers.json
+#Dumps directly in a directory have no domain, dumps in its subdirectories belong to the domain the subdirectory is named after. Every dump is
+#indexed first (layer, first rule, inline layers it references), then the layers are chosen as online - shared and inline layers are left out,
+#as is every layer used as an inline layer - and reported, inline layers being read from their own dumps. Without a show-access-layers dump a
+#shared layer no rule references cannot be told from a policy layer and is reported. Files are memory-mapped and walked one rule at a time, and
+#both steps are spread over offline_workers processes
+def run_offline(paths, workers, run):
+  started = time.monotonic()
+  dump_files = offline_dump_files(paths)
+  if not dump_files:
+    print(f"No JSON dumps found in {', '.join(paths)}")
+    return False
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    indexed = list(executor.map(index_rulebase_dump, *zip(*dump_files), chunksize=max(1, len(dump_files) // (workers * 4))))
+
+  dumps = {}
+  inline_layers = set()
+  #Shared and inline flags of the layers of each domain with a show-access-layers dump
+  access_layers = {}
+  for dump in indexed:
+    if "error" in dump:
+      print(f"Skipping {dump['path']}: {dump['error']}")
+      continue
+    if "access-layers" in dump:
+      access_layers.setdefault(dump["domain"], {}).update((accesslayer["uid"], accesslayer) for accesslayer in dump["access-layers"])
+      continue
+    dumps.setdefault((dump["domain"], dump["uid"]), []).append(dump)
+    inline_layers.update((dump["domain"], uid) for uid in dump["inline-layers"])
+  layers = []
+  for key, pages in dumps.items():
+    pages.sort(key=lambda dump: dump["from"])
+    rules = sum(dump["to"] - dump["from"] + 1 for dump in pages if dump["from"])
+    if rules != pages[0]["total"]:
+      print(f"Dumps of layer {pages[0]['name']} hold {rules} of its {pages[0]['total']} rules")
+    accesslayer = access_layers.get(key[0], {}).get(key[1], {})
+    if key not in inline_layers and not accesslayer.get("shared") and not accesslayer.get("inline"):
+      layers.append({"domain" : key[0], "uid" : key[1], "name" : pages[0]["name"], "total" : pages[0]["total"]})
+  layers.sort(key=lambda layer: layer["total"], reverse=True)
+  for domain in sorted(set(layer["domain"] for layer in layers) - set(access_layers)):
+    print(f"No show-access-layers dump for {'domain ' + domain if domain else 'the dumps without a domain'}, shared layers no rule references are reported as policies")
+
+  print(f"Reporting on {len(layers)} layer(s) from {len(dump_files)} dump(s) of {len(dumps)} layer(s) using {workers} process(es)")
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=start_offline_worker, initargs=(dumps, run.output_formats)) as executor:
+    completed = list(executor.map(report_offline_layer, layers))
+
+  failed = [layer["name"] for layer, success in zip(layers, completed) if not success]
+  print(f"Finished {len(layers) - len(failed)} of {len(layers)} layer(s) in {time.monotonic() - started:.1f} s" + (f" - incomplete: {', '.join(failed)}" if failed else ''))
+  return not failed
+
+#(path, domain) of every .json file given or found in the given directories
+def offline_dump_files(paths):
+  dump_files = []
+  for path in paths:
+    if not os.path.isdir(path):
+      dump_files.append((path, ''))
+      continue
+    for entry in sorted(os.listdir(path)):
+      entry_path = os.path.join(path, entry)
+      if os.path.isdir(entry_path):
+        dump_files.extend((os.path.join(entry_path, name), entry) for name in sorted(os.listdir(entry_path)) if name.endswith('.json'))
+      elif entry.endswith('.json'):
+        dump_files.append((entry_path, ''))
+  return dump_files
+
+#Layer, rule range and referenced inline layers of one dump, read in one pass over the mapped file without holding more than one rule
+def index_rulebase_dump(path, domain):
+  dump = {"path" : path, "domain" : domain}
+  try:
+    data = map_rulebase_dump(path)
+    inline_layers = set()
+    rules_without_hits = 0
+    for key, value in walk_rulebase_page(data):
+      if key != 'rulebase':
+        dump[key] = value
+        continue
+      #Sections hold their rules in their own rulebase
+      items = [value]
+      while items:
+        item = items.pop()
+        if item.get('type') == 'access-section':
+          items.extend(item.get('rulebase', []))
+        else:
+          rules_without_hits += 'hits' not in item
+          if 'inline-layer' in item:
+            inline_layers.add(item['inline-layer'])
+  except (OSError, ValueError) as error:
+    return {"path" : path, "error" : str(error)}
+  #A show-access-layers response - only the flags that decide which layers are reported are kept
+  if isinstance(dump.get("access-layers"), list):
+    return {"path" : path, "domain" : domain, "access-layers" : [{"uid" : accesslayer.get("uid"), "shared" : accesslayer.get('shared', False),
+      "inline" : 'parent-layer' in accesslayer} for accesslayer in dump["access-layers"] if isinstance(accesslayer, dict)]}
+  if not isinstance(dump.get("uid"), str) or not isinstance(dump.get("total"), int):
+    return {"path" : path, "error" : "not a show-access-rulebase or show-access-layers response"}
+  if rules_without_hits:
+    return {"path" : path, "error" : "no hit counts, dump the rulebase with show-hits true"}
+  dump["name"] = dump.get("name", dump["uid"])
+  dump["from"] = dump.get("from", 0)
+  dump["to"] = dump.get("to", 0)
+  dump["inline-layers"] = sorted(inline_layers)
+  #The objects-dictionary and any other fields are not needed again
+  return {key : dump[key] for key in ("path", "domain", "uid", "name", "from", "to", "total", "inline-layers")}
+
+#Pages of a mapped file are only read when a rule is asked for, so a dump of any size takes no more memory than the rule being read. The
+#mapping is released once nothing reads the file any more
+def map_rulebase_dump(path):
+  with open(path, 'rb') as file:
+    if os.fstat(file.fileno()).st_size == 0:
+      raise ValueError('empty file')
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def start_offline_worker(dumps, formats):
+  global offline_reader,rulebase_json_decoder
+  offline_reader = OfflineReader(dumps, CollectionRun(formats))
+  rulebase_json_decoder = 'stream'
+
+#Reads layers from the rulebase dumps of an offline run where a HitCountClient reads them from a server, so loop_policy_rulebase and the inline
+#layer cache work the same on both. The session id of a domain is offline_session_prefix and the domain name
+class OfflineReader:
+  def __init__(self, dumps, run):
+    self.server = ''
+    self.output_directory = ''
+    self.run = run
+    #(domain, layer uid) -> the dumps of the layer, a list of pages in rule order
+    self.dumps = dumps
+    self.inline_layers = InlineLayerCache(self, inline_layer_workers)
+
+  def rulebase_pages(self, layer_uid, sid, start_offset, errors):
+    domain = sid[len(offline_session_prefix):]
+    pages = self.dumps.get((domain, layer_uid))
+    if not pages:
+      return None, 'No dump of layer {}{}'.format(layer_uid, ' in domain ' + domain if domain else '').encode('utf-8')
+    return read_rulebase_dumps(pages, errors), None
+
+#One top level layer with its inline layers, in a worker process
+def report_offline_layer(layer):
+  sid = offline_session_prefix + layer["domain"]
+  policy_name = layer['name'].replace(' ','_')
+  print(f"Processing access-layer: {policy_name}" + (f" in domain {layer['domain']}" if layer["domain"] else ''))
+  try:
+    return loop_policy_rulebase(offline_reader, layer["uid"], policy_name, sid, layer["domain"].replace(' ','_'))
+  except (OSError, ValueError, KeyError) as error:
+    print(f"Stopped processing access-layer {policy_name} - unable to read its dumps: {error!r}")
+    return False
+
+#Each dump as a page tagged with its 'offset' and 'limit', like the pages fetched from the server
+def read_rulebase_dumps(pages, errors):
+  for dump in pages:
+    try:
+      page = load_rulebase_page(map_rulebase_dump(dump["path"]))
+    except (OSError, ValueError) as error:
+      print('Error occurred while trying to read rulebase dump {}: {}'.format(dump["path"], error))
+      errors.record()
+      continue
+    page['offset'] = max(0, dump["from"] - 1)
+    page['limit'] = dump["to"] - dump["from"] + 1 if dump["from"] else 0
+    yield page
+
 # Display a list of all access policies for the user to select from, including an option for 'All Policies' and an 'Exit' option
-def create_interactive_access_policy_menu(sid):
+def create_interactive_access_policy_menu(client, domain_name=''):
   #Create list of non shared layers name and uid fields (shared layers will be accessed by their UID which is in key 'inline-layer' within the 'show-access-rulebase' output)
   global policy_info
-  policy_info = get_non_shared_access_layer_names(sid)
+  policy_info = get_non_shared_access_layer_names(client, domain_name)
   clear_console()
   print_policy_names()
 
@@ -162,23 +1115,25 @@ def create_interactive_access_policy_menu(sid):
     try:
         policy_info[selected_policy_number]
         if (policy_info[selected_policy_number]["name"] == 'Exit'):
-          logout(sid)
           break
         elif (policy_info[selected_policy_number]["name"] == all_policies_object["name"]):
-          for policy in policy_info:
-              if policy["name"] == all_policies_object["name"] or policy["name"] == exit_object["name"]:
-                continue
-              else:
+          policies = [policy for policy in policy_info if policy["name"] not in (all_policies_object["name"], exit_object["name"])]
+          #With --plan planned first, then collected biggest layer first, otherwise collected in menu order without the planning requests
+          plan = plan_domain(client, domain_name, policies) if plan_policies else {"layers" : policies}
+          if plan is not None:
+            if plan_policies:
+              print_plan([plan], estimate_plan(client, [plan], 1))
+            for policy in ([] if plan_only else plan["layers"]):
                 policy_name = policy['name'].replace(' ','_')
                 print(f"Processing access-layer: {policy_name}")
-                loop_policy_rulebase(policy["uid"], policy_name,sid)
+                client.report_layer(policy["uid"], policy_name, domain_name, policy["last-modify-time"])
           print_policy_names()
           continue
         else:
           #clear_console()
           policy_name = policy_info[selected_policy_number]['name'].replace(' ','_')
           print(f"Processing access-layer: {policy_name}")
-          loop_policy_rulebase(policy_info[selected_policy_number]["uid"], policy_name,sid)
+          client.report_layer(policy_info[selected_policy_number]["uid"], policy_name, domain_name, policy_info[selected_policy_number]["last-modify-time"])
           print_policy_names()
           continue
 
@@ -193,32 +1148,16 @@ def create_interactive_access_policy_menu(sid):
       print_policy_names()
       continue
 
-def get_non_shared_access_layer_names(sid):
-  access_layer_names = [all_policies_object]
-  payload = json.dumps({
-    "details-level": "full"
-  })
+def get_non_shared_access_layer_names(client, domain_name=''):
   # Get names of access layers - store for iteration
-  response = api_call(mgmt_server, 'show-access-layers', payload, sid)
-  data = response.read()
-  if response.status == 200:
-    response_data = json.loads(data.decode('utf-8'))
-    for accesslayer in response_data['access-layers']:
-      if (accesslayer['shared']):
-        print('Skipping Shared Layer - {}'.format(accesslayer["name"]))
-        continue
-      if 'parent-layer' in accesslayer:
-        print('Skipping Inline Layer - {}'.format(accesslayer["name"]))
-        continue
-      access_layer_names.append({"name": accesslayer["name"], "uid" : accesslayer["uid"]})
-
-    #Add this as final entry for users to cleanly close out of the loop
-    access_layer_names.insert(len(access_layer_names),exit_object)
-    return access_layer_names
-  else:
-    print('Error occurred while trying to show-access-layers: {}'.format(data.decode('utf-8')))
-    logout(sid)
-    sys.exit()  
+  try:
+    access_layer_names = [all_policies_object] + list(client.layers(domain_name))
+  except ApiError as error:
+    print(error)
+    sys.exit()
+  #Add this as final entry for users to cleanly close out of the loop
+  access_layer_names.insert(len(access_layer_names),exit_object)
+  return access_layer_names
 
 def user_selected_policy_number():
   while True:
@@ -263,189 +1202,1803 @@ def convert_datestring_to_date(datestr):
   str = re.search(r'\d{4}-\d{2}-\d{2}', datestr)
   return datetime.datetime.strptime(str.group(), '%Y-%m-%d').date()
 
-def loop_policy_rulebase(policyuid,policy_name,sid):
-  finished = False  # will become true after getting all the data
+#Reports on one layer read through client (a HitCountClient, or an OfflineReader), in the formats and with the files of the client's run. Returns
+#whether every page of the layer and its inline layers was read (a skipped layer counts as read)
+def loop_policy_rulebase(client,policyuid,policy_name,sid,domain_name,layer_modified=None):
   #all_objects = {}  # accumulate all the objects from all the API calls
-  global all_rules_object
-  all_rules_object = []
-  all_rules_object.append(csv_header)
-  iterations = 0  # number of times we've made an API call
-  limit = 50 # page size to get for each api call
-  offset = 0 # skip n objects in the database
-  payload = {}
-
-  payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : policyuid, "details-level" : "standard", "show-hits" : True})
-  response = api_call(mgmt_server, "show-access-rulebase", payload, sid)
-  response_data = response.read()
+  run = client.run
+  server = client.server
+  snapshot_store = run.snapshot_store
+  run_journal = run.journal
+  if run.delta and run.skip_unmodified_layers and snapshot_store.layer_unchanged(server, domain_name, policyuid, layer_modified):
+    print(f"Skipping unmodified access-layer: {policy_name}")
+    return True
 
-  if response.status == 200:
-    response_data = json.loads(response_data.decode('utf-8'))
-    loop_rules(response_data,'','',sid)
+  #With a journal, a finished layer is skipped and a partly written one picks up after its last recorded page, in the files it was being written to
+  journal_state = run_journal.layer_state(domain_name, policyuid) if run_journal is not None else None
+  if journal_state is not None and journal_state["done"]:
+    print(f"Skipping access-layer finished before resuming: {policy_name}")
+    return True
+  start_offset = 0
+  resume_sizes = None
+  if journal_state is not None and journal_state["next-offset"] and run_journal.can_append(journal_state, run.output_formats):
+    start_offset = journal_state["next-offset"]
+    resume_sizes = journal_state["sizes"]
+    print(f"Resuming access-layer {policy_name} at rule offset {start_offset} ({journal_state['rows']} rows already written)")
 
-    while not finished:
-      total_objects = response_data['total']  # total number of objects
-      received_objects = response_data['to']  # number of objects we got so far
+  errors = RulebaseErrors()
+  pages, error_data = client.rulebase_pages(policyuid, sid, start_offset, errors)
 
-      if received_objects == total_objects:
-        break
+  if pages is not None:
+    if resume_sizes is not None:
+      report_name = journal_state["file"]
+    elif snapshot_store is not None and run.delta:
+      report_name = csv_file_name_for(policy_name, domain_name, 'hit_count_delta', client.output_directory)
+    else:
+      report_name = csv_file_name_for(policy_name, domain_name, output_directory=client.output_directory)
+    if run_journal is not None and resume_sizes is None:
+      run_journal.start_layer(domain_name, policyuid, report_name)
 
-      iterations += 1
-      
-      payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : policyuid, "details-level" : "standard", "show-hits" : True})
-      response = api_call(mgmt_server, "show-access-rulebase", payload, sid)
-      response_data = response.read()
-      response_data = json.loads(response_data.decode('utf-8'))
-      loop_rules(response_data,'','',sid)
-    
-    print_rules(policy_name)
+    #Rows stream straight from each page into the CSV writer thread rather than being held until the whole layer is done
+    all_rules_object = ReportRowWriter(report_name, run.output_formats, resume_sizes)
+    if snapshot_store is not None:
+      all_rules_object = SnapshotRowWriter(snapshot_store, server, domain_name, policyuid, policy_name, layer_modified, run.delta, all_rules_object)
+    if run.consolidated_index is not None:
+      all_rules_object = IndexRowWriter(run.consolidated_index, server, domain_name, policyuid, policy_name, all_rules_object)
+    all_rules_object.append(csv_header)
+    layer_summary = LayerSummary(policy_name)
+    rows_written = journal_state["rows"] if resume_sizes is not None else 0
+    #Pages are only checkpointed while every page up to them came back whole - after a failed page a resume has to start from that page
+    next_offset = start_offset
+    contiguous = True
+    try:
+      for response_data, rule_table in resolved_pages(client, pages, sid, errors):
+        rule_table.enrich()
+        layer_summary.add(rule_table)
+        for row in rule_table.rows(run.todays_date):
+          all_rules_object.append(row)
+        rows_written += len(rule_table)
+        contiguous = contiguous and response_data['offset'] == next_offset and not rule_table.failed_inline_layers
+        next_offset = response_data['offset'] + response_data['limit']
+        if run_journal is not None and contiguous:
+          all_rules_object.checkpoint(run_journal.page_checkpoint(domain_name, policyuid, next_offset, rows_written))
+        else:
+          all_rules_object.flush()
+      layer_finished = not errors.count
+      #Rules saved to the snapshot before the interruption belong to the earlier run, so deleted rules are not worked out for a resumed layer
+      all_rules_object.layer_complete = layer_finished and resume_sizes is None
+    finally:
+      all_rules_object.close()
+    if run_journal is not None and layer_finished:
+      run_journal.finish_layer(domain_name, policyuid)
+    layer_summary.print_summary()
+    return layer_finished
 
   else:
-    print('Error occurred while trying to show-access-rulebase: {}'.format(response_data.decode('utf-8')))
+    print('Error occurred while trying to show-access-rulebase: {}'.format(error_data.decode('utf-8')))
+    return False
 
-def loop_rules(data, parent_rule_number, policy_name, sid):
+def loop_rules(data, parent_rule_number, policy_name, sid, rule_table, inline_layers):
   #Due to how access-sections work, we need to store the policy name from the access-rulebase object and pass it back if an access-section is present when
   #we loop through the sub-array because the nested object has no copy of the rulebase name to reference
   if not policy_name:
     policy_name = data['name']
-  global all_rules_object
-  for access_rule in data['rulebase']:
-    if (access_rule['type'] == 'access-section'):
-      #If an access-section is present it output the rules of the section as an array within the object, so we have to interate that sub-array to print those rules
-      loop_rules(access_rule,'',policy_name,sid)
+  #Rulebases still being read, innermost last - an access-section holds its rules in its own rulebase array, which is read before carrying on
+  #with the rules after the section
+  rulebases = [iter(data['rulebase'])]
+  while rulebases:
+    access_rule = next(rulebases[-1], None)
+    if access_rule is None:
+      rulebases.pop()
+    elif (access_rule['type'] == 'access-section'):
+      rulebases.append(iter(access_rule['rulebase']))
     else:
       if 'name' in access_rule:
         rule_name = access_rule['name'].replace('\n',' ')
       else:
         rule_name ='Empty Rule Name'
 
+      #Only the day of each date is kept here, dates are parsed and DAYS_SINCE_LAST_HIT worked out for a whole page at a time in RuleTable.enrich
       if 'last-date' in access_rule['hits']:
-        last_hit_date = convert_datestring_to_date(access_rule['hits']['last-date']['iso-8601'])
-        last_delta=str((todays_date - last_hit_date).days)
-        #first_hit_date = convert_datestring_to_date(access_rule['hits']['first-date']['iso-8601'])
-        #first_delta=str((todays_date - first_hit_date).days)
+        last_hit_day = access_rule['hits']['last-date']['iso-8601'][:10]
       else:
-        last_hit_date = last_hit_empty
-        last_delta = last_delta_empty
-        #first_hit_date = first_hit_empty
-        #first_delta = first_delta_empty
-      
-      if 'inline-layer' in access_rule:
-        is_layer='Yes'
-        #layer_uid=access_rule['inline-layer']
-      else:
-        is_layer='No'
-        #layer_uid='Not inline layer'
+        last_hit_day = ''
 
       if parent_rule_number:
         rule_number = str(parent_rule_number) + '.' + str(access_rule['rule-number'])
       else:
         rule_number = str(access_rule['rule-number'])
 
-      last_modified_date = convert_datestring_to_date(access_rule['meta-info']['last-modify-time']['iso-8601'])
-
-      all_rules_object.append([policy_name,rule_number,rule_name,str(access_rule['hits']['value']),str(last_hit_date),last_delta,access_rule['enabled'],last_modified_date,access_rule['meta-info']['last-modifier'],access_rule['uid']])
-      if (is_layer == 'Yes'):
-        get_inline_layer_info(access_rule['inline-layer'], sid, rule_number)
+      rule_table.add(policy_name,rule_number,rule_name,access_rule['hits']['value'],last_hit_day,access_rule['enabled'],access_rule['meta-info']['last-modify-time']['iso-8601'][:10],access_rule['meta-info']['last-modifier'],access_rule['uid'])
+      if 'inline-layer' in access_rule:
+        #Fetched in the background from now on, the rules are spliced in after this one by InlineLayerCache.resolve
+        rule_table.add_inline_layer(access_rule['inline-layer'], rule_number)
+        inline_layers.queue(access_rule['inline-layer'], sid)
 
     
-def get_inline_layer_info(uid,sid,rulenumber):
-  finished = False  # will become true after getting all the data
-  iterations = 0  # number of times we've made an API call
-  limit = 50 # page size to get for each api call
-  offset = 0 # skip n objects in the database
-  payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : uid, "details-level" : "standard", "show-hits" : True})
-  response = api_call(mgmt_server, 'show-access-rulebase', payload, sid)
-  response_data = response.read()
-  if response.status == 200:
-    response_data = json.loads(response_data.decode('utf-8'))
-    loop_rules(response_data,rulenumber,'',sid)
+#Rules held column by column - hit counts and dates in typed arrays, layer names and modifiers interned so repeated values share one string.
+#A table is filled by loop_rules for one page (or one cached inline layer) and turned into CSV rows by rows()
+class RuleTable:
+  def __init__(self):
+    self.layer_names = []
+    self.rule_numbers = []
+    self.rule_names = []
+    self.hit_counts = array.array('q')
+    self.last_hit_days = []
+    self.enabled = []
+    self.modified_days = []
+    self.modified_by = []
+    self.rule_uids = []
+    #Date ordinals filled in by enrich(), 0 where a rule was never hit
+    self.last_hit_ordinals = None
+    self.modified_ordinals = None
+    #(position, layer uid, parent rule number) of each inline layer still to be spliced in, and inline layers (or pages of them) that could not be fetched
+    self.inline_layers = []
+    self.failed_inline_layers = 0
 
-    while not finished:
-      total_objects = response_data['total']  # total number of objects
-      received_objects = response_data['to']  # number of objects we got so far
+  columns = ('layer_names', 'rule_numbers', 'rule_names', 'hit_counts', 'last_hit_days', 'enabled', 'modified_days', 'modified_by', 'rule_uids')
 
-      if received_objects == total_objects:
-        break
+  def __len__(self):
+    return len(self.rule_uids)
+
+  def add(self, layer_name, rule_number, rule_name, hit_count, last_hit_day, enabled, modified_day, modified_by, rule_uid):
+    self.layer_names.append(sys.intern(layer_name))
+    self.rule_numbers.append(rule_number)
+    self.rule_names.append(rule_name)
+    self.hit_counts.append(hit_count)
+    self.last_hit_days.append(last_hit_day)
+    self.enabled.append(enabled)
+    self.modified_days.append(modified_day)
+    self.modified_by.append(sys.intern(modified_by))
+    self.rule_uids.append(rule_uid)
+
+  def add_inline_layer(self, uid, parent_rule_number):
+    self.inline_layers.append((len(self), uid, parent_rule_number))
+
+  #A new table with the given inline layer tables ((position, parent rule number, table or None if it failed) in position order) spliced in
+  def with_inline_layers(self, inline_tables):
+    table = RuleTable()
+    table.failed_inline_layers = self.failed_inline_layers
+    start = 0
+    for position, parent_rule_number, layer_table in inline_tables:
+      table.extend_rows(self, start, position)
+      if layer_table is None:
+        table.failed_inline_layers += 1
+      else:
+        table.extend_inline(layer_table, parent_rule_number)
+        table.failed_inline_layers += layer_table.failed_inline_layers
+      start = position
+    table.extend_rows(self, start, len(self))
+    return table
+
+  def extend_rows(self, other, start, end):
+    for column in self.columns:
+      getattr(self, column).extend(getattr(other, column)[start:end])
+
+  #Rules of an inline layer go in right after the rule that references it, numbered under that rule
+  def extend_inline(self, layer_table, parent_rule_number):
+    prefix = str(parent_rule_number) + '.'
+    self.layer_names.extend(layer_table.layer_names)
+    self.rule_numbers.extend([prefix + rule_number for rule_number in layer_table.rule_numbers])
+    self.rule_names.extend(layer_table.rule_names)
+    self.hit_counts.extend(layer_table.hit_counts)
+    self.last_hit_days.extend(layer_table.last_hit_days)
+    self.enabled.extend(layer_table.enabled)
+    self.modified_days.extend(layer_table.modified_days)
+    self.modified_by.extend(layer_table.modified_by)
+    self.rule_uids.extend(layer_table.rule_uids)
+
+  #Parses each distinct day once and converts both date columns to ordinals in one go
+  def enrich(self):
+    self.last_hit_ordinals = array.array('l', day_ordinals(self.last_hit_days))
+    self.modified_ordinals = array.array('l', day_ordinals(self.modified_days))
+
+  #today is the day DAYS_SINCE_LAST_HIT counts from
+  def rows(self, today):
+    today = today.toordinal()
+    last_hit_dates = [day_text(ordinal) if ordinal else last_hit_empty for ordinal in self.last_hit_ordinals]
+    days_since_last_hit = [str(today - ordinal) if ordinal else last_delta_empty for ordinal in self.last_hit_ordinals]
+    modified_dates = [day_text(ordinal) for ordinal in self.modified_ordinals]
+    for columns in zip(self.layer_names, self.rule_numbers, self.rule_names, self.hit_counts, last_hit_dates, days_since_last_hit, self.enabled, modified_dates, self.modified_by, self.rule_uids):
+      row = list(columns)
+      row[3] = str(row[3])
+      yield row
+
+def day_ordinals(days):
+  for day in set(days).difference(day_ordinal_cache):
+    day_ordinal_cache[day] = convert_datestring_to_date(day).toordinal()
+  return [day_ordinal_cache[day] for day in days]
+
+def day_text(ordinal):
+  text = day_text_cache.get(ordinal)
+  if text is None:
+    text = day_text_cache[ordinal] = str(date.fromordinal(ordinal))
+  return text
+
+#Hit count summary of a layer, built from the hit count column of each page as it is written
+class LayerSummary:
+  def __init__(self, layer_name):
+    self.layer_name = layer_name
+    self.hit_counts = array.array('q')
+    self.never_hit = 0
+
+  def add(self, rule_table):
+    self.hit_counts.extend(rule_table.hit_counts)
+    self.never_hit += rule_table.last_hit_ordinals.count(0)
+
+  def summary(self):
+    hit_counts = sorted(self.hit_counts)
+    summary = {"rules" : len(hit_counts), "zero_hits" : self.hit_counts.count(0), "never_hit" : self.never_hit}
+    for percentile in (50, 90, 99):
+      #Nearest rank
+      summary[f"p{percentile}"] = hit_counts[max(0, -(-percentile * len(hit_counts) // 100) - 1)] if hit_counts else 0
+    summary["max"] = hit_counts[-1] if hit_counts else 0
+    return summary
+
+  def print_summary(self):
+    summary = self.summary()
+    print(f"{self.layer_name}: {summary['rules']} rules, {summary['zero_hits']} with zero hits, hit count p50 {summary['p50']} / p90 {summary['p90']} / p99 {summary['p99']} / max {summary['max']}")
+
+#Inline and shared layers of one client, fetched once per session with rule numbers relative to the layer and re-numbered under each parent rule
+#that references them. A shared layer used by dozens of policies is downloaded a single time. A layer is queued as soon as a page referencing it
+#is read and fetched by the client's inline layer workers while the rest of the parent layer is read. Fetches never wait on each other - an inline
+#layer found inside another is just queued in turn - so nesting depth costs neither threads nor stack
+class InlineLayerCache:
+  def __init__(self, client, workers):
+    self.client = client
+    self.workers = workers
+    self.executor = None
+    self.lock = threading.Lock()
+    #(sid, layer uid) -> the fetch of the layer as it was queued, and the layer with its own inline layers spliced in
+    self.fetches = {}
+    self.resolved = {}
+
+  def queue(self, uid, sid):
+    with self.lock:
+      if (sid, uid) in self.fetches:
+        self.client.run.count("inline-hits")
+        return
+      if self.executor is None:
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+      self.fetches[(sid, uid)] = self.executor.submit(fetch_inline_layer, self.client, uid, sid)
+    self.client.run.count("inline-fetched")
+
+  def fetched(self, rule_table, sid):
+    with self.lock:
+      return all(self.fetches[(sid, uid)].done() for position, uid, parent_rule_number in rule_table.inline_layers)
+
+  #Splice the inline layers of a page in after the rules that reference them. Each inline layer that could not be fetched in full is an error of
+  #the layer being read, so it is not treated as complete
+  def resolve(self, rule_table, sid, errors):
+    if not rule_table.inline_layers:
+      return rule_table
+    table = rule_table.with_inline_layers([(position, parent_rule_number, self.resolved_layer(uid, sid)) for position, uid, parent_rule_number in rule_table.inline_layers])
+    for failed in range(table.failed_inline_layers):
+      errors.record()
+    return table
+
+  #An inline layer with the inline layers nested in it spliced in, worked out once per session. The nested layers are resolved innermost first from an
+  #explicit stack. A layer that (wrongly) contains itself further down is left out at the repeat rather than looping
+  def resolved_layer(self, uid, sid):
+    stack = [uid]
+    in_progress = set()
+    while stack:
+      layer_uid = stack[-1]
+      with self.lock:
+        if (sid, layer_uid) in self.resolved:
+          stack.pop()
+          continue
+        future = self.fetches[(sid, layer_uid)]
+      layer_table = future.result()
+      if layer_table is not None:
+        with self.lock:
+          nested = [nested_uid for position, nested_uid, parent_rule_number in layer_table.inline_layers if (sid, nested_uid) not in self.resolved and nested_uid not in in_progress]
+        if nested and layer_uid not in in_progress:
+          in_progress.add(layer_uid)
+          stack.extend(reversed(nested))
+          continue
+        with self.lock:
+          layer_table = layer_table.with_inline_layers([(position, parent_rule_number, self.resolved.get((sid, nested_uid))) for position, nested_uid, parent_rule_number in layer_table.inline_layers])
+      in_progress.discard(layer_uid)
+      with self.lock:
+        self.resolved.setdefault((sid, layer_uid), layer_table)
+      stack.pop()
+    with self.lock:
+      return self.resolved[(sid, uid)]
+
+  #Inline layers still queued when the client is closed (finished or interrupted) are not fetched, they would only keep the sessions busy
+  def cancel(self):
+    with self.lock:
+      futures = list(self.fetches.values())
+      executor = self.executor
+    for future in futures:
+      future.cancel()
+    if executor is not None:
+      executor.shutdown(wait=False)
+
+  #The inline layers of a session that was logged out - nothing can use them again, and the next session for the domain fetches its own
+  def forget(self, sid):
+    with self.lock:
+      futures = [self.fetches.pop(key) for key in [key for key in self.fetches if key[0] == sid]]
+      for key in [key for key in self.resolved if key[0] == sid]:
+        del self.resolved[key]
+    for future in futures:
+      future.cancel()
+
+#The rules of one inline layer, with the inline layers it references still to be spliced in (None if the layer could not be fetched). A page of
+#it that could not be fetched counts against every layer using it
+def fetch_inline_layer(client, uid, sid):
+  layer_table = RuleTable()
+  errors = RulebaseErrors()
+  pages, error_data = client.rulebase_pages(uid, sid, 0, errors)
+  if pages is None:
+    print('Error occurred while trying to inline layer: {}'.format(error_data.decode('utf-8')))
+    return None
+  for response_data in pages:
+    loop_rules(response_data,'','',sid,layer_table,client.inline_layers)
+  layer_table.failed_inline_layers += errors.count
+  return layer_table
+
+#Pages of a layer in order, each with its inline layers spliced in. Up to inline_lookahead_pages later pages are read (queueing their inline layers)
+#while a page waits for its inline layers, so the rows still come out in rule order
+def resolved_pages(client, pages, sid, errors):
+  inline_layers = client.inline_layers
+  pending = collections.deque()
+  for response_data in pages:
+    rule_table = RuleTable()
+    loop_rules(response_data,'','',sid,rule_table,inline_layers)
+    pending.append((response_data, rule_table))
+    while pending and (len(pending) > inline_lookahead_pages or inline_layers.fetched(pending[0][1], sid)):
+      response_data, rule_table = pending.popleft()
+      yield response_data, inline_layers.resolve(rule_table, sid, errors)
+  while pending:
+    response_data, rule_table = pending.popleft()
+    yield response_data, inline_layers.resolve(rule_table, sid, errors)
+
+#Pages and inline layers of one read of a layer that could not be fetched - the layer is only treated as complete (for deleted rule detection and
+#the journal) if there were none. Every read counts its own, so reads of the same domain at the same time do not see each other's errors
+class RulebaseErrors:
+  def __init__(self):
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def record(self):
+    with self.lock:
+      self.count += 1
+
+#Fetch every page of a rulebase. The first response gives us the total, so the remaining offsets are requested at the same time through a bounded
+#worker pool instead of waiting on each page in turn. Pages are yielded in offset order as they arrive so loop_rules numbers the rules exactly as before
+#Pages are yielded in offset order, each tagged with the 'offset' and 'limit' it was requested with. A page that fails is reported, counted in
+#errors and left out
+def get_rulebase_pages(client, uid, sid, start_offset, errors):
+  limit = next_page_limit(client, uid, start_offset) # page size to get for this api call, each later page is sized when it is requested
+  status, data = get_rulebase_page(client, uid, sid, start_offset, limit)
+  if status != 200:
+    return None, data
+
+  first_page = load_rulebase_page(data, client.server)
+  #The total comes after the rulebase in the response, so the first page is read in full before the remaining offsets are requested
+  first_page['rulebase'] = list(first_page['rulebase'])
+  first_page['offset'] = start_offset
+  first_page['limit'] = limit
+  return stream_rulebase_pages(client, uid, sid, first_page, errors), None
+
+#What --lean saves - compression is the only difference it makes to the bytes of a page that can be measured without fetching the page twice
+def print_lean_stats():
+  requests = response_bytes = wire_bytes = 0
+  for entry in api_metrics.summary()["commands"]:
+    if entry["command"] == "show-access-rulebase":
+      requests += entry["requests"]
+      response_bytes += entry["response_bytes"]
+      wire_bytes += entry["wire_bytes"]
+  if requests and response_bytes:
+    print(f"Compressed rulebase pages: {(response_bytes - wire_bytes) // requests} bytes saved per page on the wire ({wire_bytes} bytes received for {response_bytes} bytes of JSON, {(response_bytes - wire_bytes) * 100.0 / response_bytes:.0f}% smaller)")
+
+def stream_rulebase_pages(client, uid, sid, first_page, errors):
+  yield first_page
+
+  total_objects = first_page['total']  # total number of objects
+  offset = first_page['offset'] + first_page['limit']
+  if offset >= total_objects:
+    return
+  #Only a few pages are requested ahead of the one being processed, which bounds memory to a handful of pages however big the layer is
+  window = page_fetch_workers * 2
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(page_fetch_workers, -(-(total_objects - offset) // client.page_size.current()))) as executor:
+    pending = collections.deque()
+    while offset < total_objects:
+      #Each page takes the page size as it stands when the page is requested
+      limit = next_page_limit(client, uid, offset)
+      pending.append((offset, limit, executor.submit(get_rulebase_page, client, uid, sid, offset, limit, rules=min(limit, total_objects - offset))))
+      offset += limit
+      if len(pending) >= window:
+        yield from decode_rulebase_page(client, errors, *pending.popleft())
+    while pending:
+      yield from decode_rulebase_page(client, errors, *pending.popleft())
+
+def next_page_limit(client, uid, offset):
+  if api_cassette is not None and api_cassette.replaying:
+    return api_cassette.recorded_page_limit(client.server, uid, offset) or client.page_size.current()
+  return client.page_size.current()
+
+def decode_rulebase_page(client, errors, offset, limit, future):
+  status, data = future.result()
+  if status == 200:
+    page = load_rulebase_page(data, client.server)
+    page['offset'] = offset
+    page['limit'] = limit
+    yield page
+  else:
+    print('Error occurred while trying to show-access-rulebase at offset {}: {}'.format(offset, data.decode('utf-8')))
+    errors.record()
+
+#Decode a show-access-rulebase page. In 'stream' mode the page comes back with 'rulebase' as an iterator: the body is decoded to text a chunk at
+#a time and each rulebase entry is decoded only when loop_rules asks for it, while the unused objects-dictionary is stepped over one object at a
+#time. The full text and the full dict tree of a page are never held together. The other top level fields ('from', 'to', 'total') are filled in
+#once the rulebase has been read
+def load_rulebase_page(data, server=None):
+  if rulebase_json_decoder != 'stream':
+    return load_api_json('show-access-rulebase', data, server)
+
+  members = walk_rulebase_page(data, server)
+  page = {}
+  for key, value in members:
+    if key == 'rulebase':
+      page['rulebase'] = remaining_rulebase_items(value, members, page)
+      #loop_rules needs the layer name before the first rule - read the whole page first if the server sent the name after the rulebase
+      if 'name' not in page:
+        page['rulebase'] = list(page['rulebase'])
+      return page
+    page[key] = value
+  page['rulebase'] = []
+  return page
+
+def remaining_rulebase_items(first_item, members, page):
+  yield first_item
+  for key, value in members:
+    if key == 'rulebase':
+      yield value
+    else:
+      page[key] = value
 
-      iterations += 1
-      
-      payload = json.dumps({"limit": limit, "offset": iterations * limit + offset, "uid" : uid, "details-level" : "standard", "show-hits" : True})
-      response = api_call(mgmt_server, "show-access-rulebase", payload, sid)
-      response_data = response.read()
-      response_data = json.loads(response_data.decode('utf-8'))
-      loop_rules(response_data,rulenumber,'',sid)
-      
+def walk_rulebase_page(data, server=None):
+  stream = JsonTextStream(data)
+  for key in stream.members():
+    if key == 'rulebase' and stream.peek() == '[':
+      for item in stream.items():
+        yield key, item
+    elif key == 'objects-dictionary' and stream.peek() == '[':
+      for unused_object in stream.items():
+        pass
+    else:
+      yield key, stream.value()
+  if api_metrics is not None:
+    api_metrics.record_decode('show-access-rulebase', stream.decode_seconds, server)
+
+#Incremental reader over a JSON response body. Values are decoded with the json module's C scanner (raw_decode) directly from the text read so
+#far - when a value is cut off at the end of the text, more is decoded (doubling each time, so a large value costs only a few attempts)
+class JsonTextStream:
+  def __init__(self, data):
+    self.data = memoryview(data)
+    self.offset = 0
+    self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+    self.buffer = ''
+    self.pos = 0
+    self.decode_seconds = 0.0
+
+  def read_more(self):
+    if self.offset >= len(self.data):
+      return False
+    size = max(json_stream_chunk_size, 2 * (len(self.buffer) - self.pos))
+    chunk = self.text_decoder.decode(self.data[self.offset:self.offset + size], self.offset + size >= len(self.data))
+    self.offset += size
+    self.buffer = self.buffer[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self):
+    while True:
+      self.pos = json_whitespace.match(self.buffer, self.pos).end()
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self.read_more():
+        raise ValueError('Unexpected end of JSON response')
+
+  def expect(self, char):
+    if self.peek() != char:
+      raise ValueError('Expected {} at position {} of JSON response'.format(char, self.offset - len(self.buffer) + self.pos))
+    self.pos += 1
+
+  def value(self):
+    self.peek()
+    while True:
+      started = time.monotonic()
+      try:
+        value, end = json_stream_decoder.raw_decode(self.buffer, self.pos)
+      except json.JSONDecodeError:
+        if not self.read_more():
+          raise
+        continue
+      finally:
+        self.decode_seconds += time.monotonic() - started
+      #A number ending exactly at the end of the text read so far may carry on in the next chunk
+      if end == len(self.buffer) and self.read_more():
+        continue
+      self.pos = end
+      return value
+
+  def items(self):
+    #Values of an array, one at a time
+    self.expect('[')
+    if self.peek() == ']':
+      self.pos += 1
+      return
+    while True:
+      yield self.value()
+      if self.peek() == ']':
+        self.pos += 1
+        return
+      self.expect(',')
+
+  def members(self):
+    #Keys of an object, one at a time - the caller reads each key's value (value() or items()) before asking for the next key
+    self.expect('{')
+    if self.peek() == '}':
+      self.pos += 1
+      return
+    while True:
+      key = self.value()
+      self.expect(':')
+      yield key
+      if self.peek() == '}':
+        self.pos += 1
+        return
+      self.expect(',')
+
+#Pages are measured for the adaptive page size unless measure is False (the one rule pages used to size a layer say nothing about page latency).
+#rules is the number of rules the page holds when the layer total is already known
+def get_rulebase_page(client, uid, sid, offset, limit, measure=True, rules=None):
+  if client.run.lean:
+    #The objects-dictionary holds every object the page's rules use, which the report has no column for
+    payload = json.dumps({"limit": limit, "offset": offset, "uid" : uid, "details-level" : "standard", "use-object-dictionary" : False, "show-hits" : True})
   else:
-    print('Error occurred while trying to inline layer: {}'.format(response_data.decode('utf-8')))
+    payload = json.dumps({"limit": limit, "offset": offset, "uid" : uid, "details-level" : "standard", "show-hits" : True})
+  #A page that still fails after the retries is reported by the caller like any other failed page instead of ending the layer
+  page_size = client.page_size
+  #Only pages whose number of rules is known are measured for the concurrency limit as well
+  measured_rules = rules if measure else None
+  try:
+    if hedge_percentile:
+      response = hedged_api_call(client, "show-access-rulebase", payload, sid, measured_rules)
+    else:
+      response = api_call(client, "show-access-rulebase", payload, sid, measured_rules)
+  except (http.client.HTTPException, OSError) as error:
+    if measure:
+      page_size.record_failure(limit)
+    return 0, 'Request failed: {}'.format(error or type(error).__name__).encode('utf-8')
+  if measure and response.status == 200:
+    page_size.record(limit, rules, response.time_to_first_byte, len(response.data))
+  elif measure and response.status in overload_statuses:
+    page_size.record_failure(limit)
+  return response.status, response.read()
 
-def print_rules(policy_name):
+#Tail latency hedging - the request is sent once, and again if it has not answered by the hedge percentile of recent page latencies. The first
+#good answer wins, the slower request finishes in the background and its connection goes back to the pool
+def hedged_api_call(client, command, json_payload, sid, rules=1):
+  executor = client.hedge_pool()
+  started = time.monotonic()
+  primary = executor.submit(api_call, client, command, json_payload, sid, rules)
+  pending = {primary}
+  threshold = hedge_threshold(client)
+  if threshold is not None:
+    done, pending = concurrent.futures.wait(pending, timeout=threshold)
+    if not done:
+      pending.add(executor.submit(api_call, client, command, json_payload, sid, rules))
+      client.run.count("hedges-sent")
+    pending.update(done)
+  while pending:
+    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+      if future.exception() is None and future.result().status == 200:
+        with client.lock:
+          client.hedge_latencies.append(time.monotonic() - started)
+        if future is not primary:
+          client.run.count("hedges-won")
+        return future.result()
+  return primary.result()
 
-  directory_path = os.getcwd()
+#The hedge percentile of the client's recent page latencies
+def hedge_threshold(client):
+  with client.lock:
+    if len(client.hedge_latencies) < hedge_min_samples:
+      return None
+    latencies = sorted(client.hedge_latencies)
+  return latencies[int(hedge_percentile / 100.0 * (len(latencies) - 1))]
 
-  if (is_mds):
-    csv_file_name= active_domain_name+"_"+policy_name+"_hit_count_report"+'_{:%Y%b%d_%H%M}'.format(datetime.datetime.now())+".csv"
+def csv_file_name_for(policy_name,domain_name,report_type='hit_count_report',output_directory=''):
+  if (domain_name):
+    return os.path.join(output_directory, domain_name+"_"+policy_name+"_"+report_type+'_{:%Y%b%d_%H%M}'.format(datetime.datetime.now())+".csv")
   else:
-    csv_file_name= policy_name+"_hit_count_report"+'_{:%Y%b%d_%H%M}'.format(datetime.datetime.now())+".csv"
+    return os.path.join(output_directory, policy_name+"_"+report_type+'_{:%Y%b%d_%H%M}'.format(datetime.datetime.now())+".csv")
+
+#Collects rows from loop_rules in small batches and hands them to a background thread running print_rules, so writing to disk overlaps the API
+#fetches and rows reach the file while the layer is still being downloaded. The bounded queue holds back loop_rules if the disk falls behind
+class ReportRowWriter:
+  #output_formats - the formats written (see print_rules). resume_sizes - when carrying on a layer from the journal, the size of each output file
+  #at the last checkpoint. The files are cut back to it and appended to instead of being replaced
+  def __init__(self, csv_file_name, output_formats, resume_sizes=None):
+    self.csv_file_name = csv_file_name
+    self.output_formats = output_formats
+    self.resume_sizes = resume_sizes
+    self.layer_complete = False
+    self.batch = []
+    self.row_queue = queue.Queue(maxsize=writer_queue_batches)
+    self.error = None
+    self.thread = threading.Thread(target=print_rules, args=(self,), daemon=True)
+    self.thread.start()
+
+  def append(self, row):
+    self.batch.append(row)
+    if len(self.batch) >= writer_batch_rows:
+      self.flush()
+
+  def flush(self):
+    if self.error is not None:
+      raise self.error
+    if self.batch:
+      self.row_queue.put(self.batch)
+      self.batch = []
+
+  #record_checkpoint is called by the writer thread with the output file sizes once every row appended so far is written out
+  def checkpoint(self, record_checkpoint):
+    self.flush()
+    self.row_queue.put(record_checkpoint)
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      self.row_queue.put(None)
+      self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+#Local SQLite snapshot of every rule's hit count, last hit and modification details, keyed by management server, domain, top level layer UID and
+#RULE_UID, so the servers of a fleet run can share one store. One connection is shared by all domain threads behind a lock, each layer is
+#committed once it is finished
+class SnapshotStore:
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    with self.lock, self.connection:
+      self.connection.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT NOT NULL, server TEXT)")
+      #Stores written before the server was part of the keys - each snapshot is moved under the server of the run that saved it
+      rule_columns = [column[1] for column in self.connection.execute("PRAGMA table_info(rules)")]
+      keyed_without_server = rule_columns and 'server' not in rule_columns
+      if keyed_without_server:
+        self.connection.execute("ALTER TABLE rules RENAME TO rules_without_server")
+        self.connection.execute("ALTER TABLE layers RENAME TO layers_without_server")
+      self.connection.executescript("""
+        CREATE TABLE IF NOT EXISTS layers (server TEXT NOT NULL, domain TEXT NOT NULL, layer_uid TEXT NOT NULL, layer_name TEXT, last_modify_time INTEGER,
+          run_id INTEGER NOT NULL, PRIMARY KEY (server, domain, layer_uid));
+        CREATE TABLE IF NOT EXISTS rules (server TEXT NOT NULL, domain TEXT NOT NULL, layer_uid TEXT NOT NULL, rule_uid TEXT NOT NULL,
+          layer_name TEXT, rule_number TEXT, rule_name TEXT, hit_count INTEGER, date_last_hit TEXT, days_since_last_hit TEXT,
+          rule_enabled TEXT, modified_date TEXT, modified_by TEXT, run_id INTEGER NOT NULL,
+          PRIMARY KEY (server, domain, layer_uid, rule_uid));
+      """)
+      if keyed_without_server:
+        self.connection.executescript("""
+          INSERT OR REPLACE INTO layers SELECT COALESCE(runs.server, ''), layers_without_server.* FROM layers_without_server LEFT JOIN runs USING (run_id);
+          INSERT OR REPLACE INTO rules SELECT COALESCE(runs.server, ''), rules_without_server.* FROM rules_without_server LEFT JOIN runs USING (run_id);
+          DROP TABLE layers_without_server;
+          DROP TABLE rules_without_server;
+        """)
+      #The servers of a run are in the keys of what it saved
+      self.run_id = self.connection.execute("INSERT INTO runs (started) VALUES (?)", (datetime.datetime.now().isoformat(),)).lastrowid
+
+  def layer_unchanged(self, server, domain, layer_uid, last_modify_time):
+    if last_modify_time is None:
+      return False
+    with self.lock:
+      row = self.connection.execute("SELECT last_modify_time FROM layers WHERE server = ? AND domain = ? AND layer_uid = ?", (server, domain, layer_uid)).fetchone()
+    return row is not None and row[0] == last_modify_time
+
+  #Every rule of a layer as the last run left it, by RULE_UID
+  def previous_rules(self, server, domain, layer_uid):
+    with self.lock:
+      rows = self.connection.execute("SELECT rule_uid, rule_name, hit_count, rule_enabled, modified_date, modified_by FROM rules WHERE server = ? AND domain = ? AND layer_uid = ? AND run_id != ?",
+        (server, domain, layer_uid, self.run_id)).fetchall()
+    return {row[0] : row[1:] for row in rows}
+
+  def save_rules(self, server, domain, layer_uid, rows):
+    with self.lock:
+      self.connection.executemany("INSERT OR REPLACE INTO rules VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(server, domain, layer_uid, row[9], row[0], row[1], row[2], int(row[3]), row[4], row[5], str(row[6]), str(row[7]), row[8], self.run_id) for row in rows])
+
+  def remove_unseen_rules(self, server, domain, layer_uid):
+    with self.lock:
+      removed = self.connection.execute("SELECT layer_name, rule_number, rule_name, hit_count, date_last_hit, days_since_last_hit, rule_enabled, modified_date, modified_by, rule_uid FROM rules WHERE server = ? AND domain = ? AND layer_uid = ? AND run_id != ?", (server, domain, layer_uid, self.run_id)).fetchall()
+      self.connection.execute("DELETE FROM rules WHERE server = ? AND domain = ? AND layer_uid = ? AND run_id != ?", (server, domain, layer_uid, self.run_id))
+    return [list(row) for row in removed]
+
+  def save_layer(self, server, domain, layer_uid, layer_name, last_modify_time):
+    with self.lock:
+      self.connection.execute("INSERT OR REPLACE INTO layers VALUES (?, ?, ?, ?, ?, ?)", (server, domain, layer_uid, layer_name, last_modify_time, self.run_id))
+
+  def commit(self):
+    with self.lock:
+      self.connection.commit()
+
+  def close(self):
+    with self.lock:
+      self.connection.commit()
+      self.connection.close()
+    print(f"Saved hit count snapshot to {os.path.abspath(self.path)}")
+
+#Sits in front of a ReportRowWriter, saving every row to the snapshot store. In --delta mode only new, modified and deleted rules and rules whose hit
+#count moved are passed on (delta), with the change and the hit count increase since the last snapshot. Rules are compared with the layer as the last run
+#left it, read before any row of this run is saved - a rule of a shared or inline layer used several times in the layer has a row for each use, and
+#every one of them is compared with the same earlier snapshot
+class SnapshotRowWriter:
+  def __init__(self, store, server, domain, layer_uid, layer_name, layer_modified, delta, output):
+    self.store = store
+    self.delta = delta
+    self.server = server
+    self.domain = domain
+    self.layer_uid = layer_uid
+    self.layer_name = layer_name
+    self.layer_modified = layer_modified
+    self.output = output
+    self.layer_complete = False
+    self.batch = []
+    self.previous = store.previous_rules(server, domain, layer_uid) if delta else None
+
+  def append(self, row):
+    if row is csv_header:
+      self.output.append(delta_csv_header if self.delta else row)
+      return
+    self.batch.append(row)
+    if len(self.batch) >= writer_batch_rows:
+      self.flush()
+
+  def flush(self):
+    rows = self.batch
+    self.batch = []
+    if rows:
+      if self.delta:
+        for row in rows:
+          change = classify_rule_change(row, self.previous.get(row[9]))
+          if change is not None:
+            self.output.append(row + list(change))
+      else:
+        for row in rows:
+          self.output.append(row)
+      self.store.save_rules(self.server, self.domain, self.layer_uid, rows)
+    self.output.flush()
+
+  def checkpoint(self, record_checkpoint):
+    self.flush()
+    self.output.checkpoint(record_checkpoint)
+
+  def close(self):
+    try:
+      self.flush()
+      #Rules are only reported deleted when every page of the layer and its inline layers was fetched, a failed page must not look like a deletion
+      if self.layer_complete:
+        for row in self.store.remove_unseen_rules(self.server, self.domain, self.layer_uid):
+          if self.delta:
+            self.output.append(row + ["DELETED", ''])
+        self.store.save_layer(self.server, self.domain, self.layer_uid, self.layer_name, self.layer_modified)
+      self.store.commit()
+    finally:
+      self.output.close()
+
+def classify_rule_change(row, previous):
+  hit_count = int(row[3])
+  if previous is None:
+    return "NEW", hit_count
+  previous_name, previous_hits, previous_enabled, previous_modified_date, previous_modified_by = previous
+  increase = hit_count - previous_hits
+  if (row[2], str(row[6]), str(row[7]), row[8]) != (previous_name, previous_enabled, previous_modified_date, previous_modified_by):
+    return "MODIFIED", increase
+  if increase:
+    return "HITS", increase
+  return None
+
+#SQLite index of every rule collected across servers and domains, for --consolidated-index. Global and shared layers show up under every domain
+#that uses them, with the same RULE_UID everywhere, so each rule is held once in rules (layer, name, enabled, last modified) and every place it
+#was seen - server, domain, top level layer and rule number, with the hit count there - is a row of rule_references. At the end of the run the
+#hit count of each rule is added up across domains (once per domain, however many times a domain uses it) along with its latest hit and the
+#number of domains using it. A layer collected again replaces its references, rules no longer referenced anywhere are dropped. Rules are
+#indexed by layer name and modifier, references by rule and by layer. One connection is shared by all domain threads behind a lock
+class ConsolidatedIndex:
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    with self.lock, self.connection:
+      self.connection.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS rules (rule_uid TEXT PRIMARY KEY, layer_name TEXT, rule_name TEXT, rule_enabled TEXT, modified_date TEXT,
+          modified_by TEXT, hit_count INTEGER, date_last_hit TEXT, domains INTEGER, references_count INTEGER);
+        CREATE TABLE IF NOT EXISTS rule_references (rule_uid TEXT NOT NULL, server TEXT NOT NULL, domain TEXT NOT NULL, layer_uid TEXT NOT NULL,
+          policy_name TEXT, rule_number TEXT NOT NULL, hit_count INTEGER, date_last_hit TEXT, run_id INTEGER NOT NULL,
+          PRIMARY KEY (rule_uid, server, domain, layer_uid, rule_number)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS rules_by_layer ON rules (layer_name);
+        CREATE INDEX IF NOT EXISTS rules_by_modifier ON rules (modified_by);
+        CREATE INDEX IF NOT EXISTS references_by_layer ON rule_references (server, domain, layer_uid);
+      """)
+      self.run_id = self.connection.execute("INSERT INTO runs (started) VALUES (?)", (datetime.datetime.now().isoformat(),)).lastrowid
+
+  def save_rules(self, server, domain, layer_uid, policy_name, rows):
+    with self.lock:
+      self.connection.executemany("INSERT OR REPLACE INTO rules (rule_uid, layer_name, rule_name, rule_enabled, modified_date, modified_by) VALUES (?, ?, ?, ?, ?, ?)",
+        [(row[9], row[0], row[2], str(row[6]), row[7], row[8]) for row in rows])
+      self.connection.executemany("INSERT OR REPLACE INTO rule_references VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(row[9], server, domain, layer_uid, policy_name, row[1], int(row[3]), row[4] if row[4] != last_hit_empty else None, self.run_id) for row in rows])
+
+  #References of a layer left over from an earlier run are rules since deleted or moved
+  def remove_unseen_references(self, server, domain, layer_uid):
+    with self.lock:
+      self.connection.execute("DELETE FROM rule_references WHERE server = ? AND domain = ? AND layer_uid = ? AND run_id != ?", (server, domain, layer_uid, self.run_id))
+
+  def commit(self):
+    with self.lock:
+      self.connection.commit()
+
+  #Rules with their hit counts across domains and every reference to them, by RULE_UID, layer name or last modifier
+  def lookup(self, rule_uid=None, layer_name=None, modified_by=None):
+    column, value = next((column, value) for column, value in (("rule_uid", rule_uid), ("layer_name", layer_name), ("modified_by", modified_by)) if value is not None)
+    columns = ("rule_uid", "layer_name", "rule_name", "rule_enabled", "modified_date", "modified_by", "hit_count", "date_last_hit", "domains", "references_count")
+    with self.lock:
+      rules = [dict(zip(columns, row)) for row in self.connection.execute(f"SELECT {', '.join(columns)} FROM rules WHERE {column} = ?", (value,))]
+      for rule in rules:
+        rule["references"] = [{"server" : row[0], "domain" : row[1], "layer_uid" : row[2], "policy_name" : row[3], "rule_number" : row[4], "hit_count" : row[5], "date_last_hit" : row[6]}
+          for row in self.connection.execute("SELECT server, domain, layer_uid, policy_name, rule_number, hit_count, date_last_hit FROM rule_references WHERE rule_uid = ?", (rule["rule_uid"],))]
+    return rules
 
-  if os.path.exists(csv_file_name):
-    os.remove(csv_file_name)
+  def close(self):
+    with self.lock:
+      self.connection.executescript("""
+        DELETE FROM rules WHERE rule_uid NOT IN (SELECT rule_uid FROM rule_references);
+        DROP TABLE IF EXISTS temp.rule_totals;
+        CREATE TEMP TABLE rule_totals (rule_uid TEXT PRIMARY KEY, hit_count INTEGER, date_last_hit TEXT, domains INTEGER, references_count INTEGER);
+        INSERT INTO rule_totals SELECT rule_uid, SUM(domain_hit_count), MAX(domain_last_hit), COUNT(*), SUM(domain_references) FROM
+          (SELECT rule_uid, MAX(hit_count) AS domain_hit_count, MAX(date_last_hit) AS domain_last_hit, COUNT(*) AS domain_references FROM rule_references GROUP BY rule_uid, server, domain)
+          GROUP BY rule_uid;
+        UPDATE rules SET hit_count = (SELECT hit_count FROM rule_totals WHERE rule_totals.rule_uid = rules.rule_uid),
+          date_last_hit = (SELECT date_last_hit FROM rule_totals WHERE rule_totals.rule_uid = rules.rule_uid),
+          domains = (SELECT domains FROM rule_totals WHERE rule_totals.rule_uid = rules.rule_uid),
+          references_count = (SELECT references_count FROM rule_totals WHERE rule_totals.rule_uid = rules.rule_uid);
+        DROP TABLE temp.rule_totals;
+      """)
+      self.connection.commit()
+      rules, references, shared = self.connection.execute("SELECT COUNT(*), SUM(references_count), SUM(domains > 1) FROM rules").fetchone()
+      self.connection.close()
+    print(f"Indexed {rules} rules ({references or 0} references, {shared or 0} rules used in more than one domain) in {os.path.abspath(self.path)}")
 
-  with open(csv_file_name, 'w') as file:
-    writer = csv.writer(file, dialect='excel')
-    writer.writerows(all_rules_object)
+#Sits in front of the report writer of a layer, saving every row to the consolidated index before passing it on
+class IndexRowWriter:
+  def __init__(self, index, server, domain, layer_uid, policy_name, output):
+    self.index = index
+    self.server = server
+    self.domain = domain
+    self.layer_uid = layer_uid
+    self.policy_name = policy_name
+    self.output = output
+    self.layer_complete = False
+    self.batch = []
+
+  def append(self, row):
+    if row is not csv_header:
+      self.batch.append(row)
+      if len(self.batch) >= writer_batch_rows:
+        self.save()
+    self.output.append(row)
+
+  def save(self):
+    rows = self.batch
+    self.batch = []
+    if rows:
+      self.index.save_rules(self.server, self.domain, self.layer_uid, self.policy_name, rows)
+
+  def flush(self):
+    self.save()
+    self.output.flush()
+
+  def checkpoint(self, record_checkpoint):
+    self.save()
+    self.index.commit()
+    self.output.checkpoint(record_checkpoint)
+
+  def close(self):
+    try:
+      self.save()
+      #As for the snapshot store, a layer with a failed page keeps the references it had
+      if self.layer_complete:
+        self.index.remove_unseen_references(self.server, self.domain, self.layer_uid)
+      self.index.commit()
+    finally:
+      self.output.layer_complete = self.layer_complete
+      self.output.close()
+
+#Writes the rows of a layer to a file per selected output format as they come off the queue. The first row is the header
+def print_rules(row_writer):
+
+  output_formats = row_writer.output_formats
+  file_names = [report_file_name(row_writer.csv_file_name, output_format) for output_format in output_formats]
+  sinks = []
+
+  try:
+    for output_format, file_name in zip(output_formats, file_names):
+      if row_writer.resume_sizes is not None:
+        #Drop anything written after the last checkpoint, those rows are fetched again
+        os.truncate(file_name, row_writer.resume_sizes[file_name])
+      elif os.path.exists(file_name):
+        os.remove(file_name)
+    header = None
+    while True:
+      rows = row_writer.row_queue.get()
+      if rows is None:
+        break
+      if callable(rows):
+        #Journal checkpoint - every row queued before it has been written and flushed
+        rows({file_name : os.path.getsize(file_name) for file_name in file_names})
+        continue
+      if header is None:
+        header = rows[0]
+        rows = rows[1:]
+        sinks = [open_report_sink(output_format, file_name, header, row_writer.resume_sizes is not None) for output_format, file_name in zip(output_formats, file_names)]
+      for sink in sinks:
+        sink.write_rows(rows)
+    for sink in sinks:
+      sink.close()
+  except Exception as error:
+    #Any failure (a full disk, a sink that cannot take a value) is raised again by the producer in flush / close
+    row_writer.error = error
+    #Keep draining so loop_rules is never left blocked on a full queue
+    while row_writer.row_queue.get() is not None:
+      pass
+    return
   
-  print(f"Created CSV output file: {directory_path}/{csv_file_name}")
+  for output_format, file_name in zip(output_formats, file_names):
+    print(f"Created {output_format.upper()} output file: {os.path.abspath(file_name)}")
+
+def report_file_name(csv_file_name, output_format):
+  return csv_file_name[:-len('.csv')] + output_format_extensions[output_format]
+
+def open_report_sink(output_format, file_name, header, resume=False):
+  if resume and output_format == 'csv':
+    return CsvSink(open(file_name, 'a'), None)
+  elif resume and output_format == 'jsonl':
+    return JsonLinesSink(open(file_name, 'a'), header)
+  elif output_format == 'csv':
+    return CsvSink(open(file_name, 'w'), header)
+  elif output_format == 'csv.gz':
+    return CsvSink(gzip.open(file_name, 'wt'), header)
+  elif output_format == 'csv.zst':
+    raw_file = open(file_name, 'wb')
+    return CsvSink(io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw_file), encoding='utf-8'), header)
+  elif output_format == 'jsonl':
+    return JsonLinesSink(open(file_name, 'w'), header)
+  else:
+    return ArrowSink(output_format, file_name, header)
+
+class CsvSink:
+  def __init__(self, file, header):
+    self.file = file
+    self.writer = csv.writer(file, dialect='excel')
+    #No header when appending to a resumed file
+    if header is not None:
+      self.writer.writerow(header)
+
+  def write_rows(self, rows):
+    self.writer.writerows(rows)
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+#One JSON object per rule, keyed by the CSV header, with numbers, booleans and null instead of the CSV text
+class JsonLinesSink:
+  def __init__(self, file, header):
+    self.file = file
+    self.header = header
+    self.converters = column_converters(header)
+
+  def write_rows(self, rows):
+    lines = []
+    for row in rows:
+      record = {}
+      for column, converter, value in zip(self.header, self.converters, row):
+        value = converter(value)
+        record[column] = value.isoformat() if isinstance(value, date) else value
+      lines.append(json.dumps(record))
+    if lines:
+      self.file.write('\n'.join(lines) + '\n')
+      self.file.flush()
+
+  def close(self):
+    self.file.close()
 
-def login(username,password,domainname):
-  sessnam = username+'_{:%Y%b%d%H%M%S}'.format(datetime.datetime.now())
+#Parquet or Arrow IPC file with int64 hit counts, date32 dates and bool RULE_ENABLED. Each batch from the queue is written as its own row group
+class ArrowSink:
+  def __init__(self, output_format, file_name, header):
+    self.header = header
+    self.converters = column_converters(header)
+    self.schema = pyarrow.schema([(column, arrow_column_type(column)) for column in header])
+    if output_format == 'parquet':
+      self.writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+    else:
+      self.writer = pyarrow.ipc.new_file(file_name, self.schema)
+
+  def write_rows(self, rows):
+    if rows:
+      columns = [[converter(row[index]) for row in rows] for index, converter in enumerate(self.converters)]
+      self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+  def close(self):
+    self.writer.close()
+
+def arrow_column_type(column):
+  if column in integer_columns:
+    return pyarrow.int64()
+  if column in date_columns:
+    return pyarrow.date32()
+  if column in boolean_columns:
+    return pyarrow.bool_()
+  return pyarrow.string()
+
+def column_converters(header):
+  converters = []
+  for column in header:
+    if column in integer_columns:
+      converters.append(optional_int)
+    elif column in date_columns:
+      converters.append(optional_date)
+    elif column in boolean_columns:
+      converters.append(rule_enabled_value)
+    else:
+      converters.append(str)
+  return converters
+
+#The CSV placeholders ('No last hit to show date for', '' for the increase of a deleted rule) become null
+def optional_int(value):
+  try:
+    return int(value)
+  except ValueError:
+    return None
+
+def optional_date(value):
+  try:
+    return date.fromisoformat(str(value))
+  except ValueError:
+    return None
+
+#Rows restored from the snapshot store hold RULE_ENABLED as text
+def rule_enabled_value(value):
+  if isinstance(value, bool):
+    return value
+  return value == 'True'
+
+def login_response(client,domainname):
+  sessnam = client.username+'_{:%Y%b%d%H%M%S}'.format(datetime.datetime.now())
   payload = json.dumps({
-    'user': username,
-    'password': password,
+    'user': client.username,
+    'password': client.password,
     'session-name' : sessnam,
     "domain" : domainname
   })
 
-  response = api_call(mgmt_server, 'login', payload, '')
+  response = api_call(client, 'login', payload, '')
   data = response.read()
 
   if response.status == 200:
-    response_data = json.loads(data.decode('utf-8'))
+    response_data = load_api_json('login', data, client.server)
     session_id=response_data['sid']
-    print('Login Successful - Session ID: {}'.format(session_id))
-    return session_id
+    logger.info('Login Successful - Session ID: {}'.format(session_id))
+    return response_data
   else:
-    print('Error occurred while trying to login: {}'.format(data.decode('utf-8')))
-    sys.exit()
+    raise ApiError('login', data.decode('utf-8'))
 
-def logout(sid):
+def logout(client,sid):
   payload = json.dumps({})
-  response = api_call(mgmt_server, 'logout', payload, sid)
+  try:
+    response = api_call(client, 'logout', payload, sid)
+  finally:
+    client.inline_layers.forget(sid)
   data = response.read()
 
   if response.status == 200:
-    response_data = json.loads(data.decode('utf-8'))
+    response_data = load_api_json('logout', data, client.server)
     logout_message=response_data['message']
-    print('Logout of Session ID: ' + sid + ' ' + logout_message)
+    logger.info('Logout of Session ID: ' + sid + ' ' + logout_message)
+    client.sessions.forget(sid)
   else:
-    print('Error occurred while trying to logout: {}'.format(data.decode('utf-8')))
-    sys.exit()
+    raise ApiError('logout', data.decode('utf-8'))
 
-def api_call(ip_addr, command, json_payload, sid):
-  #Use SSLContect object to disable certificate verification allowing self signed certs
-  context = ssl.SSLContext()
-  context.check_hostname = False
-  context.verify_mode = ssl.CERT_NONE
-  conn = http.client.HTTPSConnection(ip_addr, context=context )
+#One live session per domain ('' is the MDS / SMS level login) of one management server. Everything working on a domain shares its session instead of
+#logging in again, idle sessions are kept alive with keepalive, and a session the server rejects (expired, restarted) is replaced by a new login.
+#Callers keep using the SID they were first given - api_call swaps in the session's current SID and resends a request rejected with
+#generic_err_wrong_session_id
+class SessionManager:
+  def __init__(self, client):
+    self.client = client
+    self.server = client.server
+    self.lock = threading.Lock()
+    self.domain_locks = collections.defaultdict(threading.Lock)
+    #domain -> session, and every SID handed out or issued since -> session
+    self.sessions = {}
+    self.sessions_by_sid = {}
+    self.stats = {"logins" : 0, "reused" : 0, "reauthenticated" : 0, "keepalives" : 0}
+    self.stopped = threading.Event()
+    self.keepalive_thread = threading.Thread(target=self.keep_sessions_alive, daemon=True)
+    self.keepalive_thread.start()
 
-  if command == 'login':
-    request_headers = {'Content-Type' : 'application/json'}
-  else:
-    request_headers = {'Content-Type' : 'application/json', 'X-chkp-sid' : sid}
+  def get(self, domain_name):
+    with self.domain_locks[domain_name]:
+      with self.lock:
+        session = self.sessions.get(domain_name)
+        if session is not None:
+          self.stats["reused"] += 1
+          return session["handle"]
+      response_data = login_response(self.client,domain_name)
+      session = {"domain" : domain_name, "handle" : response_data['sid'], "sid" : response_data['sid'],
+        "timeout" : response_data.get('session-timeout', 600), "last-used" : time.monotonic()}
+      with self.lock:
+        self.stats["logins"] += 1
+        self.sessions[domain_name] = session
+        self.sessions_by_sid[session["sid"]] = session
+      return session["handle"]
+
+  #The SID to send for a handle (or for an SID not managed here, the SID itself)
+  def current_sid(self, sid):
+    with self.lock:
+      session = self.sessions_by_sid.get(sid)
+      if session is None:
+        return sid
+      session["last-used"] = time.monotonic()
+      return session["sid"]
+
+  #Log in again after the server rejected rejected_sid. Threads that hit the same rejection share the one new login
+  def reauthenticate(self, sid, rejected_sid):
+    with self.lock:
+      session = self.sessions_by_sid.get(sid)
+    #Nothing logs in again once the sessions have been closed
+    if session is None or self.stopped.is_set():
+      return None
+    with self.domain_locks[session["domain"]]:
+      if session["sid"] == rejected_sid:
+        logger.info(f"Session for {session['domain'] or self.server} was rejected, logging in again")
+        #A failed login leaves the request rejected, its caller reports it like any other refused request
+        try:
+          response_data = login_response(self.client,session["domain"])
+        except ApiError as error:
+          logger.warning(error)
+          return None
+        with self.lock:
+          self.stats["reauthenticated"] += 1
+          session["sid"] = response_data['sid']
+          session["timeout"] = response_data.get('session-timeout', session["timeout"])
+          self.sessions_by_sid[session["sid"]] = session
+      return session["sid"]
+
+  #Called by logout - the session is gone, the next get() for the domain logs in again
+  def forget(self, sid):
+    with self.lock:
+      session = self.sessions_by_sid.get(sid)
+      if session is not None and self.sessions.get(session["domain"]) is session:
+        del self.sessions[session["domain"]]
 
+  def release(self, domain_name):
+    with self.lock:
+      session = self.sessions.get(domain_name)
+    if session is not None:
+      logout_quietly(self.client, session["handle"])
+
+  def keep_sessions_alive(self):
+    while not self.stopped.wait(keepalive_check_seconds):
+      with self.lock:
+        idle = [session for session in self.sessions.values() if time.monotonic() - session["last-used"] > session["timeout"] / 2]
+      for session in idle:
+        try:
+          response = api_call(self.client, 'keepalive', json.dumps({}), session["handle"])
+          if response.status == 200:
+            with self.lock:
+              self.stats["keepalives"] += 1
+        except (http.client.HTTPException, OSError) as error:
+          logger.warning(f"Keepalive for {session['domain'] or self.server} failed: {error}")
+
+  def close(self):
+    self.stopped.set()
+    self.keepalive_thread.join()
+    with self.lock:
+      sessions = list(self.sessions.values())
+    for session in sessions:
+      logout_quietly(self.client, session["handle"])
+    logger.info(f"Sessions: {self.stats['logins']} logins, {self.stats['reused']} reused instead of logging in again, {self.stats['reauthenticated']} re-authenticated, {self.stats['keepalives']} keepalives")
+
+#logout() raises on an error - at shutdown or when releasing a domain the other sessions must still be logged out
+def logout_quietly(client, sid):
+  try:
+    logout(client, sid)
+  except ApiError as error:
+    logger.warning(error)
+  except (http.client.HTTPException, OSError):
+    pass
+
+#Append-only journal of a run, one JSON record per line, flushed and synced to disk as it is written so it survives a crash or a lost connection.
+#Records are layer-start (with the report file name), page (the next rule offset, rows written so far and the output file sizes once those rows
+#are on disk) and layer-done, keyed by domain and layer UID. A partly written last line from a crash is ignored when the journal is read back
+class RunJournal:
+  def __init__(self, path, resume):
+    self.path = path
+    self.lock = threading.Lock()
+    self.layers = {}
+    if resume and os.path.exists(path):
+      self.load()
+      finished = sum(1 for state in self.layers.values() if state["done"])
+      print(f"Resuming from journal {os.path.abspath(path)}: {finished} layer(s) finished, {len(self.layers) - finished} partly written")
+    elif resume:
+      print(f"No journal found at {os.path.abspath(path)}, starting a new run")
+    self.file = open(path, 'a' if resume else 'w')
+
+  def load(self):
+    with open(self.path) as file:
+      for line in file:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          break
+        key = (record["domain"], record["layer"])
+        if record["event"] == 'layer-start':
+          self.layers[key] = {"file" : record["file"], "done" : False, "next-offset" : 0, "rows" : 0, "sizes" : None}
+        elif record["event"] == 'page' and key in self.layers:
+          self.layers[key].update({"next-offset" : record["next-offset"], "rows" : record["rows"], "sizes" : record["sizes"]})
+        elif record["event"] == 'layer-done' and key in self.layers:
+          self.layers[key]["done"] = True
+
+  def layer_state(self, domain, layer_uid):
+    with self.lock:
+      return self.layers.get((domain, layer_uid))
+
+  #A layer can only carry on where it stopped if every file it was being written to can be cut back and appended to and is still there
+  def can_append(self, state, output_formats):
+    if any(output_format not in appendable_output_formats for output_format in output_formats):
+      return False
+    file_names = [report_file_name(state["file"], output_format) for output_format in output_formats]
+    return all(file_name in state["sizes"] and os.path.exists(file_name) and os.path.getsize(file_name) >= state["sizes"][file_name] for file_name in file_names)
+
+  def start_layer(self, domain, layer_uid, file_name):
+    self.write({"event" : 'layer-start', "domain" : domain, "layer" : layer_uid, "file" : file_name})
+
+  def page_checkpoint(self, domain, layer_uid, next_offset, rows):
+    def record_checkpoint(sizes):
+      self.write({"event" : 'page', "domain" : domain, "layer" : layer_uid, "next-offset" : next_offset, "rows" : rows, "sizes" : sizes})
+    return record_checkpoint
+
+  def finish_layer(self, domain, layer_uid):
+    self.write({"event" : 'layer-done', "domain" : domain, "layer" : layer_uid})
+
+  def write(self, record):
+    with self.lock:
+      self.file.write(json.dumps(record) + '\n')
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+    print(f"Run journal written to {os.path.abspath(self.path)}")
+
+#Domain and access layer lists of each server and domain, kept in a JSON file between runs so the menus and --all-domains do not list them with
+#details-level full at every start. A list is used while it is younger than the TTL and its domain has not been published to since it was
+#cached (one show-last-published-session instead of the full list), otherwise it is fetched again. Shared by every client and domain thread
+class MetadataCache:
+  version = 1
+
+  def __init__(self, path, ttl):
+    self.path = path
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.refreshes = 0
+    self.entries = {}
+    try:
+      with open(path) as file:
+        cache = json.load(file)
+      if cache.get("version") == self.version:
+        self.entries = cache["entries"]
+    except FileNotFoundError:
+      pass
+    except (OSError, ValueError, KeyError, AttributeError) as error:
+      print(f"Ignoring unreadable metadata cache {path}: {error}")
+
+  def key(self, server, domain, kind):
+    return json.dumps([server, domain, kind])
+
+  def get(self, server, domain, kind, published):
+    with self.lock:
+      entry = self.entries.get(self.key(server, domain, kind))
+      if entry is None or time.time() - entry["cached"] >= self.ttl or entry["published"] != published:
+        return None
+      self.hits += 1
+      return entry["data"]
+
+  def put(self, server, domain, kind, published, data):
+    with self.lock:
+      self.refreshes += 1
+      self.entries[self.key(server, domain, kind)] = {"cached" : time.time(), "published" : published, "data" : data}
+      try:
+        write_file_atomically(self.path, json.dumps({"version" : self.version, "entries" : self.entries}))
+      except OSError as error:
+        print(f"Unable to write metadata cache {self.path}: {error}")
+
+  def print_stats(self):
+    print(f"Metadata cache {self.path}: {self.hits} list(s) used from the cache, {self.refreshes} fetched")
+
+#Keep-alive HTTPS connections are pooled per management server and reused by every api_call, so each page no longer pays for a new TCP + TLS handshake
+#Pools are thread safe so concurrent requests each check out their own connection
+class ApiResponse:
+  #The response body is read in full inside api_call so the connection can go straight back into the pool, callers still use .status and .read()
+  def __init__(self, status, data, headers, time_to_first_byte=0.0, retries=0, wire_bytes=None):
+    self.status = status
+    self.data = data
+    self.headers = headers
+    self.time_to_first_byte = time_to_first_byte
+    self.retries = retries
+    #Bytes as received, before a compressed body was decompressed
+    self.wire_bytes = len(data) if wire_bytes is None else wire_bytes
+
+  def read(self):
+    return self.data
+
+class ApiConnectionPool:
+  def __init__(self, ip_addr, max_idle_connections):
+    self.ip_addr = ip_addr
+    self.max_idle_connections = max_idle_connections
+    #Use SSLContect object to disable certificate verification allowing self signed certs - created once per server instead of once per call
+    self.context = ssl.SSLContext()
+    self.context.check_hostname = False
+    self.context.verify_mode = ssl.CERT_NONE
+    self.idle_connections = []
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.handshakes = 0
+    self.reused = 0
+    self.reconnects = 0
+
+  def new_connection(self):
+    with self.lock:
+      self.handshakes += 1
+    return http.client.HTTPSConnection(self.ip_addr, context=self.context, timeout=connect_timeout)
+
+  def acquire(self):
+    with self.lock:
+      if self.idle_connections:
+        self.reused += 1
+        return self.idle_connections.pop(), True
+    return self.new_connection(), False
+
+  def release(self, conn):
+    with self.lock:
+      if len(self.idle_connections) < self.max_idle_connections:
+        self.idle_connections.append(conn)
+        return
+    conn.close()
+
+  def request(self, command, json_payload, request_headers):
+    if api_cassette is None:
+      return self.send(command, json_payload, request_headers)
+    sid = request_headers.get('X-chkp-sid', '')
+    if api_cassette.replaying:
+      return api_cassette.replay(self.ip_addr, command, json_payload, sid)
+    started = time.monotonic()
+    try:
+      response = self.send(command, json_payload, request_headers)
+    except (http.client.HTTPException, OSError) as error:
+      api_cassette.record(self.ip_addr, command, json_payload, sid, time.monotonic() - started, error=error)
+      raise
+    api_cassette.record(self.ip_addr, command, json_payload, sid, time.monotonic() - started, response)
+    return response
+
+  def send(self, command, json_payload, request_headers):
+    with self.lock:
+      self.requests += 1
+    conn, reused = self.acquire()
+    retries = 0
+    try:
+      res, data, time_to_first_byte = send_api_request(conn, command, json_payload, request_headers)
+    except (http.client.HTTPException, OSError) as error:
+      conn.close()
+      #A timeout means the server is slow rather than that the connection went stale - retrying is left to api_call
+      if not reused or isinstance(error, socket.timeout):
+        raise
+      #The server closed the idle keep-alive connection - reconnect transparently and send the request once more
+      with self.lock:
+        self.reconnects += 1
+      retries += 1
+      conn = self.new_connection()
+      try:
+        res, data, time_to_first_byte = send_api_request(conn, command, json_payload, request_headers)
+      except (http.client.HTTPException, OSError):
+        conn.close()
+        raise
+
+    if res.will_close:
+      conn.close()
+    else:
+      self.release(conn)
+    wire_bytes = len(data)
+    if (res.getheader('Content-Encoding') or '').lower() == 'gzip':
+      data = gzip.decompress(data)
+    return ApiResponse(res.status, data, res.getheaders(), time_to_first_byte, retries, wire_bytes)
+
+  def close(self):
+    with self.lock:
+      idle_connections = self.idle_connections
+      self.idle_connections = []
+    for conn in idle_connections:
+      conn.close()
+
+def send_api_request(conn, command, json_payload, request_headers):
   #We have left the vX.X out of the API call to ensure it uses the latest version
+  started = time.monotonic()
+  #The connect timeout applies while connecting, the read timeout from then on
+  if conn.sock is None:
+    conn.connect()
+  conn.sock.settimeout(read_timeout)
   conn.request("POST", "/web_api/{}".format(command), json_payload, request_headers)
   res = conn.getresponse()
-  return res
+  time_to_first_byte = time.monotonic() - started
+  #Read the whole body so the connection is free for the next request
+  data = res.read()
+  return res, data, time_to_first_byte
+
+def get_connection_pool(ip_addr):
+  with connection_pools_lock:
+    if ip_addr not in connection_pools:
+      connection_pools[ip_addr] = ApiConnectionPool(ip_addr, max_idle_connections)
+    return connection_pools[ip_addr]
+
+def close_connection_pools():
+  with connection_pools_lock:
+    pools = list(connection_pools.values())
+    connection_pools.clear()
+  for pool in pools:
+    pool.close()
+    print(f"API connections to {pool.ip_addr}: {pool.handshakes} TLS handshakes for {pool.requests} requests, {pool.reused} handshakes avoided by keep-alive reuse, {pool.reconnects} stale connections reconnected")
+
+#rules is how many rules the response holds, its latency is compared per rule by the adaptive concurrency limit (see AdaptiveConcurrencyLimit).
+#None keeps the request's latency out of the limit
+def api_call(client, command, json_payload, sid, rules=1):
+  if command == 'login':
+    request_headers = {'Content-Type' : 'application/json'}
+  else:
+    sent_sid = client.sessions.current_sid(sid)
+    request_headers = {'Content-Type' : 'application/json', 'X-chkp-sid' : sent_sid}
+  if client.run.lean:
+    request_headers['Accept-Encoding'] = 'gzip'
+
+  response = send_with_retries(client, command, json_payload, request_headers, rules)
+  #Expired or otherwise rejected session - log in again and resend once with the new SID
+  if response.status != 200 and command not in ('login', 'logout') and b'generic_err_wrong_session_id' in response.data:
+    new_sid = client.sessions.reauthenticate(sid, sent_sid)
+    if new_sid is not None:
+      request_headers['X-chkp-sid'] = new_sid
+      response = send_with_retries(client, command, json_payload, request_headers, rules)
+  return response
+
+#Only read-only commands are retried - sending login, logout or a change twice is not safe
+def send_with_retries(client, command, json_payload, request_headers, rules=1):
+  ip_addr = client.server
+  attempts = api_retries + 1 if command.startswith('show-') or command == 'keepalive' else 1
+  for attempt in range(attempts):
+    last_attempt = attempt + 1 == attempts
+    retry_after = None
+    try:
+      response = timed_api_request(client, command, json_payload, request_headers, rules)
+    except (http.client.HTTPException, OSError) as error:
+      if last_attempt:
+        raise
+      print(f"API {command} to {ip_addr} failed ({error or type(error).__name__}), retrying")
+    else:
+      if response.status not in overload_statuses or last_attempt:
+        return response
+      print(f"API {command} to {ip_addr} returned {response.status}, retrying")
+      retry_after = dict((name.lower(), value) for name, value in response.headers).get('retry-after')
+    if api_metrics is not None:
+      api_metrics.record_retry(ip_addr, command)
+    time.sleep(retry_delay(attempt, retry_after))
+
+def retry_delay(attempt, retry_after=None):
+  if retry_after is not None and retry_after.isdigit():
+    return min(float(retry_after), retry_backoff_max)
+  #Full jitter, so requests that failed together do not all come back at the same moment
+  return random.uniform(0, min(retry_backoff_max, retry_backoff_base * 2 ** attempt))
+
+#Held to the client's share of the server's adaptive concurrency limit (see CollectionRun.concurrency_limit)
+def timed_api_request(client, command, json_payload, request_headers, rules=1):
+  ip_addr = client.server
+  concurrency_limit = client.concurrency_limit
+  concurrency_limit.acquire()
+  started = time.monotonic()
+  try:
+    response = get_connection_pool(ip_addr).request(command, json_payload, request_headers)
+  except (http.client.HTTPException, OSError):
+    concurrency_limit.release(command, time.monotonic() - started, True, rules)
+    if api_metrics is not None:
+      api_metrics.record_failure(ip_addr, command, time.monotonic() - started)
+    raise
+  concurrency_limit.release(command, time.monotonic() - started, response.status in overload_statuses, rules)
+  if api_metrics is not None:
+    api_metrics.record(ip_addr, command, response, time.monotonic() - started)
+  return response
+
+#Responses that mean the API daemon is struggling rather than that the request was wrong
+overload_statuses = (429, 500, 502, 503, 504)
+
+#AIMD limit on the requests in flight to one management server. The API daemon is shared with SmartConsole users, so rather than a fixed number
+#of parallel requests the limit grows by one for every limit's worth of healthy responses. It is halved when the server errors or fails to answer
+#and cut by a fifth when a command's recent latency (moving average) climbs to twice its best. Rulebase pages are compared per rule they hold,
+#against pages of about the same size (the same power of two), so a big page after small ones is not read as congestion. Pages whose number of
+#rules is not known (the first page of a layer) or that are not measured (the one rule pages sizing a layer) are left out. At most one cut per
+#two average response times, so a single slow burst does not collapse the limit
+class AdaptiveConcurrencyLimit:
+  #Latency below this is never treated as congestion, jitter on a fast link would otherwise look like a doubling
+  min_congested_seconds = 0.05
+
+  def __init__(self, ip_addr, max_limit):
+    self.ip_addr = ip_addr
+    self.max_limit = max_limit
+    self.limit = float(min(initial_in_flight, max_limit))
+    self.lowest_limit = self.limit
+    self.in_flight = 0
+    self.peak_in_flight = 0
+    self.condition = threading.Condition()
+    #(command, size class) -> [moving average latency per rule, best latency per rule seen, moving average latency]
+    self.latency = {}
+    self.last_decrease = 0.0
+    self.decreases = 0
+    self.waits = 0
+    self.wait_seconds = 0.0
+
+  def acquire(self):
+    with self.condition:
+      if self.in_flight >= int(self.limit):
+        started = time.monotonic()
+        while self.in_flight >= int(self.limit):
+          self.condition.wait()
+        self.waits += 1
+        self.wait_seconds += time.monotonic() - started
+      self.in_flight += 1
+      self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+  def release(self, command, seconds, overloaded, rules=1):
+    with self.condition:
+      self.in_flight -= 1
+      if rules is None and not overloaded:
+        self.condition.notify_all()
+        return
+      key = (command, int(rules or 1).bit_length())
+      average = self.record_latency(key, seconds, rules) if rules is not None else seconds
+      if overloaded or (rules is not None and self.congested(key)):
+        #Wait for the requests sent at the old limit to come back before cutting again
+        if time.monotonic() - self.last_decrease > 2 * average:
+          self.limit = max(1.0, self.limit * (0.5 if overloaded else 0.8))
+          self.lowest_limit = min(self.lowest_limit, self.limit)
+          self.last_decrease = time.monotonic()
+          self.decreases += 1
+      else:
+        self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+      self.condition.notify_all()
+
+  def record_latency(self, key, seconds, rules):
+    per_rule = seconds / max(1, rules)
+    latency = self.latency.get(key)
+    if latency is None:
+      latency = self.latency[key] = [per_rule, per_rule, seconds]
+    else:
+      latency[0] = 0.8 * latency[0] + 0.2 * per_rule
+      #The best latency drifts up slowly so a server that has become slower for good is not read as congested forever
+      latency[1] = min(per_rule, latency[1] * 1.001)
+      latency[2] = 0.8 * latency[2] + 0.2 * seconds
+    return latency[2]
+
+  def congested(self, key):
+    average, best, average_seconds = self.latency[key]
+    return average_seconds > self.min_congested_seconds and average > 2 * best
+
+#Page size for show-access-rulebase on one management server, shared by every layer of the run (see CollectionRun.page_size). The time to first byte of a page is the time the server took to build it,
+#so after each page the size is set to what would still come back within page_target_seconds at the latency measured per rule - at most double
+#the size, and only grown by full pages at the current size. The first page of a layer (the number of rules in it is not known yet, it may be a
+#small inline layer) can only cut the size. A page that timed out, failed or got a 429/5xx halves the size. The size is also held to page_max_bytes
+#of response at the bytes per rule seen, and cuts use the size a page was requested at so concurrent pages cut it once
+class AdaptivePageSize:
+  def __init__(self, ip_addr, initial_size, max_size):
+    self.ip_addr = ip_addr
+    self.initial_size = min(initial_size, max_size)
+    self.max_size = max_size
+    self.size = self.initial_size
+    self.smallest = self.largest = self.size
+    self.bytes_per_rule = 0.0
+    self.pages = 0
+    self.increases = 0
+    self.decreases = 0
+    self.lock = threading.Lock()
+
+  def current(self):
+    with self.lock:
+      return self.size
+
+  def record(self, limit, rules, seconds, response_bytes):
+    with self.lock:
+      self.pages += 1
+      if rules:
+        self.bytes_per_rule = max(self.bytes_per_rule, response_bytes / float(rules))
+      fitting = int((rules or limit) * page_target_seconds / max(seconds, 0.001))
+      if fitting < limit:
+        self.resize(min(self.size, fitting))
+      elif rules is not None and rules >= self.size:
+        self.resize(min(2 * self.size, fitting))
+
+  def record_failure(self, limit):
+    with self.lock:
+      self.pages += 1
+      self.resize(min(self.size, limit // 2))
+
+  def resize(self, size):
+    if self.bytes_per_rule:
+      size = min(size, int(page_max_bytes / self.bytes_per_rule))
+    size = max(min_page_size, min(self.max_size, size))
+    if size > self.size:
+      self.increases += 1
+    elif size < self.size:
+      self.decreases += 1
+    self.size = size
+    self.smallest = min(self.smallest, size)
+    self.largest = max(self.largest, size)
+
+  def print_stats(self):
+    with self.lock:
+      if self.pages:
+        print(f"Rulebase page size for {self.ip_addr}: {self.size} rules (started at {self.initial_size}, between {self.smallest} and {self.largest}, at most {self.max_size}), {self.increases} increases and {self.decreases} decreases over {self.pages} pages")
+
+#Decode an API response body, timing the JSON decode for the per-command metrics
+def load_api_json(command, data, server=None):
+  started = time.monotonic()
+  if orjson is not None and rulebase_json_decoder != 'json':
+    response_data = orjson.loads(data)
+  else:
+    response_data = json.loads(data.decode('utf-8'))
+  if api_metrics is not None:
+    api_metrics.record_decode(command, time.monotonic() - started, server)
+  return response_data
+
+#Per API command latency and payload metrics - wall time of every attempt (a retry is timed on its own, attempts that got no response included), time to first byte, response bytes, JSON decode time,
+#retries and errors. Written at the end of the run as a JSON summary and/or a Prometheus text format file for the node exporter textfile collector
+class ApiMetrics:
+  #Upper bounds in seconds of the request duration histogram buckets
+  duration_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.commands = {}
+
+  def command_metrics(self, server, command):
+    key = (server, command)
+    if key not in self.commands:
+      self.commands[key] = {"requests" : 0, "errors" : 0, "failures" : 0, "retries" : 0, "wall_seconds" : 0.0, "max_wall_seconds" : 0.0,
+        "time_to_first_byte_seconds" : 0.0, "response_bytes" : 0, "wire_bytes" : 0, "json_decode_seconds" : 0.0, "json_decodes" : 0,
+        "duration_buckets" : [0] * len(self.duration_buckets)}
+    return self.commands[key]
+
+  def record(self, server, command, response, elapsed):
+    with self.lock:
+      metrics = self.command_metrics(server, command)
+      metrics["requests"] += 1
+      if response.status != 200:
+        metrics["errors"] += 1
+      metrics["retries"] += response.retries
+      metrics["time_to_first_byte_seconds"] += response.time_to_first_byte
+      metrics["response_bytes"] += len(response.data)
+      metrics["wire_bytes"] += response.wire_bytes
+      self.observe_duration(metrics, elapsed)
+
+  def record_failure(self, server, command, elapsed):
+    #The request never got a response (connection refused, reset twice, ...)
+    with self.lock:
+      metrics = self.command_metrics(server, command)
+      metrics["failures"] += 1
+      self.observe_duration(metrics, elapsed)
+
+  #Wall time, its maximum and the histogram count the same attempts - those with a response and those without
+  def observe_duration(self, metrics, elapsed):
+    metrics["wall_seconds"] += elapsed
+    metrics["max_wall_seconds"] = max(metrics["max_wall_seconds"], elapsed)
+    for index, bound in enumerate(self.duration_buckets):
+      if elapsed <= bound:
+        metrics["duration_buckets"][index] += 1
+
+  def record_retry(self, server, command):
+    with self.lock:
+      self.command_metrics(server, command)["retries"] += 1
+
+  def record_decode(self, command, elapsed, server=None):
+    with self.lock:
+      metrics = self.command_metrics(server or mgmt_server, command)
+      metrics["json_decode_seconds"] += elapsed
+      metrics["json_decodes"] += 1
+
+  def summary(self):
+    with self.lock:
+      commands = []
+      for (server, command), metrics in sorted(self.commands.items()):
+        entry = {"server" : server, "command" : command}
+        entry.update({key : value for key, value in metrics.items() if key != "duration_buckets"})
+        attempts = metrics["requests"] + metrics["failures"]
+        entry["mean_wall_seconds"] = metrics["wall_seconds"] / attempts if attempts else 0.0
+        entry["mean_time_to_first_byte_seconds"] = metrics["time_to_first_byte_seconds"] / metrics["requests"] if metrics["requests"] else 0.0
+        commands.append(entry)
+    return {"run_started" : datetime.datetime.fromtimestamp(self.started).isoformat(), "run_seconds" : time.time() - self.started, "commands" : commands}
+
+  def print_summary(self):
+    commands = self.summary()["commands"]
+    #Each line says which server it is for once there is more than one
+    several_servers = len(set(entry['server'] for entry in commands)) > 1
+    for entry in commands:
+      print(f"API {entry['server'] + ' ' if several_servers else ''}{entry['command']}: {entry['requests']} calls, mean {entry['mean_wall_seconds'] * 1000:.0f} ms (first byte {entry['mean_time_to_first_byte_seconds'] * 1000:.0f} ms), max {entry['max_wall_seconds'] * 1000:.0f} ms, {entry['response_bytes']} bytes ({entry['wire_bytes']} on the wire), JSON decode {entry['json_decode_seconds']:.2f} s, {entry['retries']} retries, {entry['errors'] + entry['failures']} errors")
+
+  def write_json(self, path):
+    write_file_atomically(path, json.dumps(self.summary(), indent=2))
+
+  def write_prometheus(self, path):
+    lines = []
+    def metric(name, metric_type, help_text, samples):
+      lines.append(f"# HELP {name} {help_text}")
+      lines.append(f"# TYPE {name} {metric_type}")
+      for labels, value in samples:
+        lines.append("{}{{{}}} {}".format(name, ','.join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels), value))
+
+    with self.lock:
+      items = sorted(self.commands.items())
+      def per_command(field):
+        return [((("server", server), ("command", command)), metrics[field]) for (server, command), metrics in items]
+      metric("chkp_api_requests_total", "counter", "Management API requests that returned a response", per_command("requests"))
+      metric("chkp_api_request_errors_total", "counter", "Management API responses with a non-200 status", per_command("errors"))
+      metric("chkp_api_request_failures_total", "counter", "Management API requests that got no response", per_command("failures"))
+      metric("chkp_api_request_retries_total", "counter", "Management API requests sent again", per_command("retries"))
+      metric("chkp_api_response_bytes_total", "counter", "Management API response body bytes", per_command("response_bytes"))
+      metric("chkp_api_response_wire_bytes_total", "counter", "Management API response body bytes as received, before decompression", per_command("wire_bytes"))
+      metric("chkp_api_time_to_first_byte_seconds_total", "counter", "Time from sending a request to receiving the response headers", per_command("time_to_first_byte_seconds"))
+      metric("chkp_api_json_decode_seconds_total", "counter", "Time spent decoding response JSON", per_command("json_decode_seconds"))
+
+      lines.append("# HELP chkp_api_request_duration_seconds Management API request wall time, each attempt on its own, attempts that got no response included")
+      lines.append("# TYPE chkp_api_request_duration_seconds histogram")
+      for (server, command), metrics in items:
+        labels = 'server="{}",command="{}"'.format(server, command)
+        for bound, count in zip(self.duration_buckets, metrics["duration_buckets"]):
+          lines.append('chkp_api_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+        attempts = metrics["requests"] + metrics["failures"]
+        lines.append('chkp_api_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, attempts))
+        lines.append('chkp_api_request_duration_seconds_sum{{{}}} {}'.format(labels, metrics["wall_seconds"]))
+        lines.append('chkp_api_request_duration_seconds_count{{{}}} {}'.format(labels, attempts))
+
+    lines.append("# HELP chkp_hit_count_run_duration_seconds Duration of the hit count reporting run")
+    lines.append("# TYPE chkp_hit_count_run_duration_seconds gauge")
+    lines.append("chkp_hit_count_run_duration_seconds {}".format(time.time() - self.started))
+    lines.append("# HELP chkp_hit_count_run_timestamp_seconds Unix time the hit count reporting run finished")
+    lines.append("# TYPE chkp_hit_count_run_timestamp_seconds gauge")
+    lines.append("chkp_hit_count_run_timestamp_seconds {}".format(time.time()))
+    write_file_atomically(path, '\n'.join(lines) + '\n')
+
+#Write to a temporary file and rename it into place so cron jobs and the textfile collector never read half a file
+def write_file_atomically(path, content):
+  temporary_path = path + '.tmp'
+  with open(temporary_path, 'w') as file:
+    file.write(content)
+  os.replace(temporary_path, path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
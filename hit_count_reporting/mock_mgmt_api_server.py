@@ -0,0 +1,395 @@
+from __future__ import print_function
+import json, ssl, gzip
+import sys, os, time, random, uuid
+import argparse, subprocess, tempfile, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Author: Joe Audet
+Date Created: 2026OCT18
+Last Modified: 2026OCT18
+Ver: 0.1
+
+Usage:
+Local stand-in for the Check Point Management API used to develop and benchmark the hit count reporting scripts without a production
+management server. Serves login, logout, keepalive, show-mdss, show-domains, show-access-layers, show-last-published-session and
+show-access-rulebase with the same paging behaviour as the real API over HTTPS (self signed certificate generated at startup with openssl)
+
+Synthetic rulebases are generated from a seed so every run serves the same data:
+  python3 mock_mgmt_api_server.py --port 8443 --rules 10000 --domains 20 --inline-every 25 --shared-layers 2 --latency-ms 40
+
+Point the scripts at it with a server of 127.0.0.1:8443 (any username / password is accepted). The extra mock-stats command returns request,
+connection, byte and open session counters for benchmarking, and mock-publish (payload {"domain" : name}) moves a domain's last publish time to now
+"""
+
+#Largest page show-access-rulebase will return, matches the management API limit
+max_page_limit = 500
+wrong_sid_message = {"code" : "generic_err_wrong_session_id", "message" : "Wrong session id. Session may be expired. Please check session id and resend the request"}
+
+def iso_date(posix_seconds):
+  return {"posix" : posix_seconds * 1000, "iso-8601" : time.strftime('%Y-%m-%dT%H:%M%z', time.gmtime(posix_seconds))}
+
+def new_uid(rng):
+  return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+class MockEstate:
+  #Holds the synthetic domains, layers and rules, built once at startup from the command line options
+  def __init__(self, options):
+    self.options = options
+    self.rng = random.Random(options.seed)
+    self.now = int(time.time())
+    self.layers = {}
+    self.domains = []
+    self.domain_layers = {}
+    #Last publish time (posix seconds) of each domain, 'MDS' for the MDS itself
+    self.published = {}
+    self.objects = [{"uid" : new_uid(self.rng), "name" : "host_{}".format(n), "type" : "host", "ipv4-address" : "10.{}.{}.{}".format(n // 65536 % 256, n // 256 % 256, n % 256)} for n in range(200)]
+    self.actions = [{"uid" : new_uid(self.rng), "name" : name, "type" : "RulebaseAction"} for name in ("Accept", "Drop", "Inline Layer")]
+    self.objects_by_uid = {obj["uid"] : obj for obj in self.objects + self.actions}
+
+    shared_layer_uids = [self.build_layer("Shared_Layer_{}".format(n), options.shared_rules, shared=True) for n in range(options.shared_layers)]
+
+    domain_names = ["Domain_{:03d}".format(n) for n in range(options.domains)] if options.domains else ['']
+    for domain_number, domain_name in enumerate(domain_names):
+      self.domains.append({"name" : domain_name, "uid" : new_uid(self.rng), "type" : "domain"})
+      layer_uids = []
+      for layer_number in range(options.layers):
+        #Vary layer sizes so the biggest-first scheduling has something to do
+        rule_count = max(1, int(options.rules * (1.0 - 0.5 * ((domain_number + layer_number) % 3) / 2)))
+        layer_uids.append(self.build_layer("Policy_{} Network".format(layer_number), rule_count, shared_layer_uids=shared_layer_uids))
+      self.domain_layers[domain_name] = layer_uids + shared_layer_uids
+      self.published[domain_name] = self.now
+    self.published['MDS'] = self.now
+
+  def build_layer(self, name, rule_count, shared=False, parent_layer=None, depth=0, shared_layer_uids=()):
+    options = self.options
+    layer_uid = new_uid(self.rng)
+    rules = []
+    inline_layers = []
+    for number in range(1, rule_count + 1):
+      rule = self.build_rule(number)
+      if options.inline_every and number % options.inline_every == 0 and depth < options.inline_depth:
+        if shared_layer_uids and (number // options.inline_every) % 2 == 0:
+          rule["inline-layer"] = shared_layer_uids[(number // options.inline_every) % len(shared_layer_uids)]
+        else:
+          inline_uid = self.build_layer("{} inline {}".format(name, number), options.inline_rules, parent_layer=layer_uid, depth=depth + 1)
+          rule["inline-layer"] = inline_uid
+          inline_layers.append(inline_uid)
+        rule["action"] = self.actions[2]["uid"]
+      rules.append(rule)
+
+    sections = []
+    if options.section_every:
+      for start in range(0, rule_count, options.section_every):
+        sections.append({"uid" : new_uid(self.rng), "name" : "Section {}".format(len(sections) + 1), "start" : start, "end" : min(rule_count, start + options.section_every)})
+
+    self.layers[layer_uid] = {"uid" : layer_uid, "name" : name, "shared" : shared, "parent-layer" : parent_layer, "rules" : rules, "sections" : sections, "inline-layers" : inline_layers}
+    return layer_uid
+
+  def build_rule(self, number):
+    rng = self.rng
+    modified = self.now - rng.randint(0, 3 * 365) * 86400
+    hit_value = 0 if rng.random() < 0.3 else int(rng.paretovariate(1.2) * 10)
+    hits = {"value" : hit_value, "percentage" : "0%", "level" : "zero" if hit_value == 0 else "low"}
+    if hit_value:
+      last_hit = self.now - rng.randint(0, 400) * 86400
+      hits["first-date"] = iso_date(last_hit - rng.randint(0, 400) * 86400)
+      hits["last-date"] = iso_date(last_hit)
+    rule = {
+      "uid" : new_uid(rng),
+      "type" : "access-rule",
+      "rule-number" : number,
+      "enabled" : rng.random() > 0.05,
+      "hits" : hits,
+      "meta-info" : {"lock" : "unlocked", "validation-state" : "ok", "last-modify-time" : iso_date(modified), "last-modifier" : rng.choice(["admin", "jaudet", "secops", "System"]), "creation-time" : iso_date(modified - 86400), "creator" : "admin"},
+      "source" : [obj["uid"] for obj in rng.sample(self.objects, 3)],
+      "destination" : [obj["uid"] for obj in rng.sample(self.objects, 3)],
+      "service" : [obj["uid"] for obj in rng.sample(self.objects, 2)],
+      "action" : self.actions[rng.randint(0, 1)]["uid"],
+      "track" : {"type" : "Log", "per-session" : False, "per-connection" : True, "accounting" : False, "alert" : "none"},
+      "comments" : "",
+    }
+    if rng.random() > 0.1:
+      rule["name"] = "Rule {}".format(number)
+    return rule
+
+  def rulebase_page(self, layer, offset, limit, payload):
+    #Build one page the way the API does: rules are counted across sections and a section split over pages appears partially in each
+    rules = layer["rules"]
+    end = min(len(rules), offset + limit)
+    show_hits = payload.get("show-hits", False)
+    details_level = payload.get("details-level", "standard")
+    object_dictionary = details_level != "uid" and payload.get("use-object-dictionary", True)
+    page_rules = [self.render_rule(rule, show_hits, details_level, object_dictionary) for rule in rules[offset:end]]
+
+    rulebase = []
+    if layer["sections"]:
+      for section in layer["sections"]:
+        start = max(section["start"], offset)
+        stop = min(section["end"], end)
+        if start >= stop:
+          continue
+        rulebase.append({"uid" : section["uid"], "name" : section["name"], "type" : "access-section", "from" : start + 1, "to" : stop, "rulebase" : page_rules[start - offset:stop - offset]})
+    else:
+      rulebase = page_rules
+
+    data = {"uid" : layer["uid"], "name" : layer["name"], "rulebase" : rulebase, "from" : offset + 1 if end > offset else 0, "to" : end, "total" : len(rules)}
+    if object_dictionary:
+      data["objects-dictionary"] = self.objects + self.actions
+    return data
+
+  #As the API does it - the uid details level is just the rule's UID, and without the objects-dictionary (or at the full details level) the
+  #objects a rule uses are written out in the rule
+  def render_rule(self, rule, show_hits, details_level, object_dictionary=True):
+    if details_level == "uid":
+      return rule["uid"]
+    rendered = dict(rule)
+    if not show_hits:
+      del rendered["hits"]
+    if details_level == "full" or not object_dictionary:
+      for column in ("source", "destination", "service"):
+        rendered[column] = [self.objects_by_uid[uid] for uid in rule[column]]
+      rendered["action"] = self.objects_by_uid[rule["action"]]
+    return rendered
+
+class MockApiHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  #Headers and body go out in separate writes, without this delayed ACKs add ~40 ms to every response
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    super().setup()
+    self.server.stats_add("connections", 1)
+
+  def log_message(self, format, *args):
+    if self.server.options.verbose:
+      super().log_message(format, *args)
+
+  def do_POST(self):
+    length = int(self.headers.get('Content-Length', 0))
+    body = self.rfile.read(length) if length else b'{}'
+    try:
+      payload = json.loads(body.decode('utf-8') or '{}')
+    except ValueError:
+      return self.send_json(400, {"code" : "generic_err_invalid_syntax", "message" : "Request body is not valid JSON"})
+
+    command = self.path.rstrip('/').split('/')[-1]
+    #mock-stats is not part of the API and is left out of the counters it reports
+    if command == 'mock-stats':
+      return self.send_json(200, self.server.stats_snapshot(), count_bytes=False)
+    if command == 'mock-publish':
+      self.server.estate.published[payload.get("domain", '') or ('MDS' if self.server.options.domains else '')] = int(time.time())
+      return self.send_json(200, {"message" : "OK"}, count_bytes=False)
+    self.server.stats_add("requests", 1)
+    self.server.stats_add("command:" + command, 1)
+    in_flight = self.server.track_in_flight(1)
+    try:
+      self.dispatch(command, payload, in_flight)
+    finally:
+      self.server.track_in_flight(-1)
+
+  def dispatch(self, command, payload, in_flight):
+    self.in_flight = in_flight
+    if command == 'login':
+      return self.handle_login(payload)
+
+    session = self.server.check_session(self.headers.get('X-chkp-sid', ''))
+    if session is None:
+      return self.send_json(400, wrong_sid_message)
+
+    handler = getattr(self, 'handle_' + command.replace('-', '_'), None)
+    if handler is None:
+      return self.send_json(404, {"code" : "generic_err_command_not_found", "message" : "Unknown command: {}".format(command)})
+    handler(payload, session)
+
+  def handle_login(self, payload):
+    estate = self.server.estate
+    domain = payload.get("domain", '') or ''
+    if domain and domain not in estate.domain_layers:
+      return self.send_json(400, {"code" : "err_login_failed", "message" : "Domain {} does not exist".format(domain)})
+    if not domain and estate.options.domains:
+      domain = 'MDS'
+    self.delay(self.server.options.login_latency_ms)
+    sid = uuid.uuid4().hex
+    self.server.sessions[sid] = {"domain" : domain, "last-used" : time.time(), "requests" : 0}
+    with self.server.stats_lock:
+      self.server.stats["peak-open-sessions"] = max(self.server.stats.get("peak-open-sessions", 0), len(self.server.sessions))
+    self.send_json(200, {"sid" : sid, "url" : "https://127.0.0.1/web_api", "session-timeout" : self.server.options.session_timeout, "api-server-version" : "1.9"})
+
+  def handle_logout(self, payload, session):
+    sid = self.headers.get('X-chkp-sid', '')
+    self.server.sessions.pop(sid, None)
+    self.send_json(200, {"message" : "OK"})
+
+  def handle_keepalive(self, payload, session):
+    self.send_json(200, {"message" : "OK"})
+
+  def handle_show_mdss(self, payload, session):
+    if not self.server.estate.options.domains:
+      return self.send_json(404, {"code" : "generic_err_command_not_found", "message" : "Command show-mdss is available on Multi-Domain Server only"})
+    self.send_json(200, {"objects" : [{"name" : "mds", "uid" : "mds-uid", "type" : "checkpoint-host"}], "from" : 1, "to" : 1, "total" : 1})
+
+  def handle_show_domains(self, payload, session):
+    self.delay(self.server.options.metadata_latency_ms)
+    domains = self.server.estate.domains if self.server.estate.options.domains else []
+    self.send_json(200, {"objects" : domains, "from" : 1 if domains else 0, "to" : len(domains), "total" : len(domains)})
+
+  def handle_show_access_layers(self, payload, session):
+    estate = self.server.estate
+    if session["domain"] == 'MDS':
+      return self.send_json(400, {"code" : "generic_err_invalid_parameter", "message" : "Log in to a domain to show access layers"})
+    self.delay(self.server.options.metadata_latency_ms)
+    visible = []
+    pending = list(estate.domain_layers.get(session["domain"], []))
+    while pending:
+      layer = estate.layers[pending.pop(0)]
+      entry = {"uid" : layer["uid"], "name" : layer["name"], "type" : "access-layer", "shared" : layer["shared"], "meta-info" : {"last-modify-time" : iso_date(estate.now)}}
+      if layer["parent-layer"]:
+        entry["parent-layer"] = layer["parent-layer"]
+      visible.append(entry)
+      pending.extend(layer["inline-layers"])
+    self.send_json(200, {"access-layers" : visible, "from" : 1, "to" : len(visible), "total" : len(visible)})
+
+  def handle_show_last_published_session(self, payload, session):
+    published = self.server.estate.published[session["domain"]]
+    self.send_json(200, {"uid" : new_uid(random.Random(published)), "type" : "session", "publish-time" : iso_date(published)})
+
+  def handle_show_access_rulebase(self, payload, session):
+    estate = self.server.estate
+    layer = estate.layers.get(payload.get("uid", ''))
+    if layer is None:
+      layer = next((candidate for candidate in estate.layers.values() if candidate["name"] == payload.get("name")), None)
+    if layer is None:
+      return self.send_json(404, {"code" : "generic_err_object_not_found", "message" : "Requested object not found"})
+    #Injected faults - a busy daemon answering 503, or a page that hangs far longer than the rest
+    if self.server.options.error_rate and random.random() < self.server.options.error_rate:
+      self.server.stats_add("injected-errors", 1)
+      return self.send_json(503, {"code" : "generic_server_error", "message" : "Management server is busy, please try again later"})
+    if self.server.options.stall_rate and random.random() < self.server.options.stall_rate:
+      self.server.stats_add("injected-stalls", 1)
+      self.delay(self.server.options.stall_seconds * 1000)
+    limit = min(int(payload.get("limit", 50)), max_page_limit)
+    offset = int(payload.get("offset", 0))
+    data = estate.rulebase_page(layer, offset, limit, payload)
+    #An overloaded API daemon - every request in progress beyond --overload-above slows each page down further
+    overload = max(0, self.in_flight - self.server.options.overload_above) * self.server.options.overload_latency_ms if self.server.options.overload_above else 0
+    self.delay(self.server.options.latency_ms + self.server.options.latency_per_rule_ms * max(0, data["to"] - offset) + overload)
+    self.send_json(200, data)
+
+  def delay(self, milliseconds):
+    if milliseconds > 0:
+      time.sleep(milliseconds / 1000.0)
+
+  def send_json(self, status, data, count_bytes=True):
+    body = json.dumps(data).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+      body = gzip.compress(body, 5)
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    if count_bytes:
+      self.server.stats_add("bytes", len(body))
+
+class MockApiServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, options):
+    super().__init__(address, MockApiHandler)
+    self.options = options
+    self.estate = MockEstate(options)
+    self.sessions = {}
+    self.stats = {}
+    self.stats_lock = threading.Lock()
+    self.in_flight = 0
+
+  #Returns the number of requests in progress including this one, and records the peak
+  def track_in_flight(self, change):
+    with self.stats_lock:
+      self.in_flight += change
+      self.stats["peak-in-flight"] = max(self.stats.get("peak-in-flight", 0), self.in_flight)
+      return self.in_flight
+
+  def stats_add(self, key, value):
+    with self.stats_lock:
+      self.stats[key] = self.stats.get(key, 0) + value
+
+  def stats_snapshot(self):
+    with self.stats_lock:
+      stats = dict(self.stats)
+    stats["open-sessions"] = len(self.sessions)
+    return stats
+
+  #Sessions expire after session-timeout seconds idle like on a real server, or after --session-max-requests to test re-authentication
+  def check_session(self, sid):
+    session = self.sessions.get(sid)
+    if session is None:
+      return None
+    session["requests"] += 1
+    if time.time() - session["last-used"] > self.options.session_timeout or (self.options.session_max_requests and session["requests"] > self.options.session_max_requests):
+      self.sessions.pop(sid, None)
+      self.stats_add("expired-sessions", 1)
+      return None
+    session["last-used"] = time.time()
+    return session
+
+def create_self_signed_context():
+  #Generate a throw away certificate so the scripts talk HTTPS exactly as they do to a real management server
+  cert_dir = tempfile.mkdtemp(prefix='mock_mgmt_api_')
+  cert_file = os.path.join(cert_dir, 'cert.pem')
+  key_file = os.path.join(cert_dir, 'key.pem')
+  subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key_file, '-out', cert_file, '-days', '2', '-subj', '/CN=mock-mgmt'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.load_cert_chain(cert_file, key_file)
+  return context
+
+def parse_arguments(argv=None):
+  parser = argparse.ArgumentParser(description="Mock Check Point Management API server for hit count reporting development")
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8443)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--domains', type=int, default=0, help="Number of MDS domains, 0 serves a SMS")
+  parser.add_argument('--layers', type=int, default=2, help="Ordered access layers per domain")
+  parser.add_argument('--rules', type=int, default=1000, help="Rules in the largest layer of each domain")
+  parser.add_argument('--section-every', type=int, default=20, help="Rules per access-section, 0 for no sections")
+  parser.add_argument('--inline-every', type=int, default=50, help="Every Nth rule has an inline layer, 0 for none")
+  parser.add_argument('--inline-rules', type=int, default=10, help="Rules in each inline layer")
+  parser.add_argument('--inline-depth', type=int, default=2, help="Maximum nesting of inline layers")
+  parser.add_argument('--shared-layers', type=int, default=1, help="Shared layers referenced from every domain's policies")
+  parser.add_argument('--shared-rules', type=int, default=30, help="Rules in each shared layer")
+  parser.add_argument('--latency-ms', type=float, default=0, help="Latency added to every show-access-rulebase page")
+  parser.add_argument('--latency-per-rule-ms', type=float, default=0, help="Additional latency per rule returned")
+  parser.add_argument('--overload-above', type=int, default=0, help="Requests in progress the server handles without slowing down, 0 for no limit")
+  parser.add_argument('--overload-latency-ms', type=float, default=50, help="Latency added to a page for every request in progress above --overload-above")
+  parser.add_argument('--error-rate', type=float, default=0, help="Fraction of show-access-rulebase requests answered with 503")
+  parser.add_argument('--stall-rate', type=float, default=0, help="Fraction of show-access-rulebase requests that hang for --stall-seconds first")
+  parser.add_argument('--stall-seconds', type=float, default=30)
+  parser.add_argument('--metadata-latency-ms', type=float, default=0, help="Latency added to show-domains and show-access-layers, e.g. for a large MDS")
+  parser.add_argument('--login-latency-ms', type=float, default=0, help="Latency added to every login")
+  parser.add_argument('--session-timeout', type=int, default=600, help="Seconds a session may be idle before it expires")
+  parser.add_argument('--session-max-requests', type=int, default=0, help="Expire each session after this many requests, 0 for never")
+  parser.add_argument('--verbose', action='store_true')
+  return parser.parse_args(argv)
+
+def start_server(options):
+  server = MockApiServer((options.host, options.port), options)
+  server.socket = create_self_signed_context().wrap_socket(server.socket, server_side=True)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
+
+def main():
+  options = parse_arguments()
+  server = start_server(options)
+  rule_total = sum(len(layer["rules"]) for layer in server.estate.layers.values())
+  print(f"Mock management API listening on https://{options.host}:{server.server_address[1]} - {len(server.estate.layers)} layers, {rule_total} rules, {options.domains} domains")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,103 @@
+import csv, json, os, sys, subprocess, tempfile, unittest, collections, glob
+
+"""
+Checks of the MDS v2 script against the mock management API server, run with:
+  python3 -m pytest -q hit_count_reporting
+The mock servers run in this process, the script as it runs from cron in its own
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_mgmt_api_server
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chkp_hit_count_to_csv_reporting_MDS_v2.py')
+password = 'mock-password'
+
+#A SMS with one policy layer of 200 rules, every 10th rule using an inline layer - every other one the shared layer, so each of its rules is
+#in the report ten times
+def start_mock_server():
+  options = mock_mgmt_api_server.parse_arguments(['--port', '0', '--layers', '1', '--rules', '200', '--inline-every', '10', '--section-every', '0', '--shared-layers', '1'])
+  server = mock_mgmt_api_server.start_server(options)
+  return server, f"127.0.0.1:{server.server_address[1]}"
+
+def run_script(directory, *arguments):
+  os.makedirs(directory, exist_ok=True)
+  completed = subprocess.run([sys.executable, script] + list(arguments), cwd=directory, env=dict(os.environ, CHKP_API_PASSWORD=password),
+    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=300)
+  if completed.returncode != 0:
+    raise AssertionError(f"script exited with {completed.returncode}:\n{completed.stdout}")
+  return completed.stdout
+
+def read_report(directory, report_type):
+  file_names = glob.glob(os.path.join(directory, f"*_{report_type}_*.csv"))
+  if len(file_names) != 1:
+    raise AssertionError(f"expected one {report_type} in {directory}, found {file_names}")
+  with open(file_names[0], newline='') as file:
+    return list(csv.DictReader(file))
+
+def shared_layer(server):
+  return next(layer for layer in server.estate.layers.values() if layer["shared"])
+
+class DeltaReportTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='hit_count_test_')
+    self.snapshot_db = os.path.join(self.directory, 'snapshots.db')
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+
+  def mock_server(self):
+    server, address = start_mock_server()
+    self.servers.append(server)
+    return server, address
+
+  def delta_run(self, name, address):
+    run_script(os.path.join(self.directory, name), '--server', address, '--user', 'admin', '--all-domains', '--delta', '--snapshot-db', self.snapshot_db)
+    return read_report(os.path.join(self.directory, name), 'hit_count_delta')
+
+  #Every use of a shared layer rule is compared with the snapshot the run started from, wherever the writer batches happen to be cut
+  def test_shared_layer_rules_in_delta(self):
+    server, address = self.mock_server()
+    run_script(os.path.join(self.directory, 'full'), '--server', address, '--user', 'admin', '--all-domains')
+    full = read_report(os.path.join(self.directory, 'full'), 'hit_count_report')
+    uses = collections.Counter(row["RULE_UID"] for row in full)
+    shared_rule = shared_layer(server)["rules"][0]
+    self.assertEqual(uses[shared_rule["uid"]], 10)
+
+    first = self.delta_run('first', address)
+    self.assertEqual(collections.Counter(row["RULE_UID"] for row in first), uses)
+    self.assertEqual(set(row["CHANGE"] for row in first), {"NEW"})
+
+    shared_rule["hits"]["value"] += 7
+    second = self.delta_run('second', address)
+    self.assertEqual([(row["RULE_UID"], row["CHANGE"], row["HIT_COUNT_INCREASE"]) for row in second], [(shared_rule["uid"], "HITS", "7")] * 10)
+
+    third = self.delta_run('third', address)
+    self.assertEqual(third, [])
+
+  #Two servers with the same rule UIDs (the mock builds both from one seed) share a snapshot store without overwriting each other's snapshots
+  def test_fleet_servers_keep_their_own_snapshots(self):
+    servers = [self.mock_server() for number in range(2)]
+    inventory = os.path.join(self.directory, 'inventory.json')
+    with open(inventory, 'w') as file:
+      json.dump({"defaults" : {"user" : "admin", "password-env" : "CHKP_API_PASSWORD"},
+        "servers" : [{"name" : f"sms{number}", "server" : address, "output-directory" : f"sms{number}"} for number, (server, address) in enumerate(servers)]}, file)
+
+    def fleet_run(name):
+      run_script(os.path.join(self.directory, name), '--inventory', inventory, '--delta', '--snapshot-db', self.snapshot_db)
+      return [read_report(os.path.join(self.directory, name, f"sms{number}"), 'hit_count_delta') for number in range(len(servers))]
+
+    first = fleet_run('first')
+    self.assertEqual(len(first[0]), len(first[1]))
+    self.assertEqual(set(row["CHANGE"] for rows in first for row in rows), {"NEW"})
+
+    rule = next(layer for layer in servers[0][0].estate.layers.values() if not layer["shared"] and not layer["parent-layer"])["rules"][0]
+    rule["hits"]["value"] += 3
+    second = fleet_run('second')
+    self.assertEqual([(row["RULE_UID"], row["CHANGE"], row["HIT_COUNT_INCREASE"]) for row in second[0]], [(rule["uid"], "HITS", "3")])
+    self.assertEqual(second[1], [])
+
+if __name__ == "__main__":
+  unittest.main()